@@ -1,17 +1,37 @@
 """Flask App for RICH CITY STOPS."""
 
+import mimetypes
 import os
 
 from flask import Flask, render_template, redirect, flash, url_for, session, \
-    g, jsonify, request
+    g, jsonify, request, send_file, Response, stream_with_context
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
-from werkzeug.exceptions import Unauthorized
+from sqlalchemy.orm import joinedload, raiseload
+from werkzeug.exceptions import Unauthorized, BadRequest, NotFound
 
-from models import db, connect_db, Neighborhood, Stop, User, DEFAULT_IMG_URL, \
+from models import db, connect_db, Stop, User, Like, DEFAULT_IMG_URL, \
     DEFAULT_STOP_URL
 from forms import StopAddEditForm, CSRFProtectionForm, SignUpForm, LoginForm, \
     ProfileEditForm, FilterForm
+from commands import jobs_cli, maps_cli, likes_cli, assets_cli, data_cli
+from identity import load_identity, remember, forget
+from passwords import PasswordPoolBusy
+from query_guard import check_query_count
+import replicas
+import metrics
+from refdata import neighborhoods
+from search import search_stops
+from spatial import stop_locations
+from fragments import stop_card, invalidate_stop_card
+from pagination import STOP_SORTS, keyset_page, InvalidCursor, \
+    DEFAULT_PAGE_SIZE
+from conditional import conditional, make_etag, page_etag
+from exporter import EXPORTS, FORMATS as EXPORT_FORMATS, export_chunks
+from assets import assets, parse_fingerprint, IMMUTABLE
+from mapping import map_srcset, map_name
+from images import thumbnail_url, thumbnail_srcset, get_thumbnail, \
+    decode_url, verify, ImageProxyError, IMAGE_WIDTHS
 
 
 app = Flask(__name__)
@@ -27,8 +47,29 @@ app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
 toolbar = DebugToolbarExtension(app)
 
+replicas.configure(app)
 connect_db(app)
 
+# first, so the before_request hooks below are timed too
+metrics.init_app(app)
+
+app.jinja_env.globals['hood_name'] = neighborhoods.name
+app.jinja_env.globals['stop_card'] = stop_card
+app.jinja_env.globals['asset_url'] = assets.url
+app.jinja_env.globals['thumbnail_url'] = thumbnail_url
+app.jinja_env.globals['thumbnail_srcset'] = thumbnail_srcset
+app.jinja_env.globals['map_srcset'] = map_srcset
+app.jinja_env.globals['map_name'] = map_name
+
+app.cli.add_command(jobs_cli)
+app.cli.add_command(maps_cli)
+app.cli.add_command(likes_cli)
+app.cli.add_command(assets_cli)
+app.cli.add_command(data_cli)
+
+app.after_request(check_query_count)
+app.after_request(replicas.pin_after_write)
+
 #######################################
 # auth & auth routes
 
@@ -37,11 +78,12 @@ NOT_LOGGED_IN_MSG = "You are not logged in."
 
 
 @app.before_request
+@metrics.timed
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_identity(session, session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -60,10 +102,22 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 
+@app.errorhandler(PasswordPoolBusy)
+def password_pool_busy(e):
+    """ Too many logins/signups in flight: ask the client to retry """
+
+    return (
+        'Too many sign-ins right now, please try again in a moment.',
+        503,
+        {'Retry-After': '1'}
+    )
+
+
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    remember(session, user)
 
 
 def do_logout():
@@ -71,6 +125,7 @@ def do_logout():
 
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
+    forget(session)
 
 
 #######################################
@@ -83,64 +138,220 @@ def homepage():
     return render_template("homepage.html")
 
 
+#######################################
+# fingerprinted static assets
+
+
+@app.get('/assets/<path:filename>')
+def fingerprinted_asset(filename):
+    """ Serve a static file by its fingerprinted URL (see assets.py),
+        precompressed if the client accepts it; cacheable forever
+    """
+
+    parsed = parse_fingerprint(filename)
+    if parsed is None:
+        raise NotFound()
+
+    path, digest = parsed
+    current = assets.digest(path)
+
+    if current is None:
+        raise NotFound()
+
+    # the file changed since this URL was handed out
+    if digest != current:
+        return redirect(assets.url(path))
+
+    encoding, full = assets.variant(path, request.accept_encodings)
+
+    response = send_file(
+        full,
+        mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream',
+        etag=f'{digest}-{encoding}' if encoding else digest,
+    )
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.vary.add('Accept-Encoding')
+
+    if encoding:
+        response.content_encoding = encoding
+
+    return response
+
+
+@app.get('/images/<sig>/<int:width>/<encoded>')
+def proxied_image(sig, width, encoded):
+    """ Serve a cached thumbnail of a signed external image URL (see
+        images.py); falls back to redirecting to the original
+    """
+
+    try:
+        url = decode_url(encoded)
+    except ValueError:
+        raise NotFound()
+
+    if width not in IMAGE_WIDTHS or not verify(sig, url):
+        raise NotFound()
+
+    try:
+        path = get_thumbnail(url, width)
+    except ImageProxyError as exc:
+        app.logger.warning('Image proxy: %s', exc)
+        return redirect(url)
+
+    response = send_file(path, mimetype='image/webp')
+    response.headers['Cache-Control'] = 'public, max-age=2592000'
+
+    return response
+
+
 #######################################
 # spots
 
 
-@app.route('/stops', methods=['GET', 'POST'])
-def stops_list():
-    """Return list of all stops."""
+def filter_stops(query, hood_codes):
+    """ Restrict query to stops in any of hood_codes (all if empty) """
+
+    if hood_codes:
+        query = query.filter(Stop.hood_code.in_(hood_codes))
+
+    return query
+
+
+def stops_page(query, default_sort='name'):
+    """ Page of query per the request's sort, cursor and limit args """
+
+    sort = request.args.get('sort') or default_sort
+    if sort not in STOP_SORTS:
+        raise BadRequest(f'Unknown sort "{sort}"')
+
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        page = keyset_page(
+            query,
+            STOP_SORTS[sort],
+            cursor=request.args.get('cursor'),
+            limit=limit
+        )
+    except (ValueError, InvalidCursor):
+        raise BadRequest('Invalid cursor or limit')
+
+    return sort, page
+
+
+def page_versions(stops):
+    """ What a page of stops looks like, for its ETag """
+
+    return [(stop.id, stop.version, stop.like_count) for stop in stops]
+
+
+def likes_etag(stop_ids):
+    """ ETag for the current user's like state of stop_ids """
+
+    likes_version = db.session.scalar(
+        db.select(User.likes_version).where(User.id == g.user.id))
+
+    return make_etag('likes', g.user.id, likes_version, stop_ids)
+
+
+def render_stops_list(default_sort):
+    """ Stop list page for the request's filters, search, sort and cursor,
+        shared by /stops and /stops/popular
+    """
 
     if not g.user:
         flash('Please log in or Sign up!', 'danger')
         return redirect(url_for('homepage'))
 
-    form = FilterForm()
+    form = FilterForm(formdata=request.args)
+    form.hood.choices = neighborhoods.choices()
 
-    if form.validate_on_submit():
-        hood_name = form.opts.data.name
+    # drop hood codes that no longer exist (e.g. old bookmarks) rather
+    # than the whole filter
+    known = {code for code, _ in form.hood.choices}
+    requested = form.hood.data or []
+    unknown = [code for code in requested if code not in known]
+    if unknown:
+        form.hood.data = [code for code in requested if code in known]
+        flash(f'Unknown neighborhood: {", ".join(unknown)}', 'warning')
 
-        if hood_name == 'All neighborhoods':
-            stops = Stop.query.order_by('name').all()
+    if not form.validate():
+        raise BadRequest('; '.join(
+            error for errors in form.errors.values() for error in errors))
 
-            return render_template(
-                'stop/list.html',
-                stops=stops,
-                form=form
-            )
+    hoods = form.hood.data
+    q = form.q.data.strip() if form.q.data else ''
 
-        filtered_hood = Neighborhood.query.filter_by(name=hood_name).first()
-        hood_code = filtered_hood.code
-        stops = Stop.query.filter_by(hood_code=hood_code).all()
+    if q:
+        results = search_stops(
+            q, hoods, offset=request.args.get('offset', 0, type=int))
 
         return render_template(
             'stop/list.html',
-            stops=stops,
+            stops=[hit.stop for hit in results.hits],
+            hits={hit.stop.id: hit for hit in results.hits},
+            next_offset=results.next_offset,
+            q=q,
+            hoods=hoods,
             form=form
         )
 
-    stops = Stop.query.order_by('name').all()
+    sort, page = stops_page(filter_stops(Stop.query, hoods), default_sort)
+
+    etag = page_etag(
+        g.user.id, g.user.version, g.user.admin, sort, hoods, unknown,
+        form.hood.choices, page.next_cursor, page_versions(page.items))
 
-    return render_template(
+    return conditional(etag, lambda: render_template(
         'stop/list.html',
-        stops=stops,
+        stops=page.items,
+        next_cursor=page.next_cursor,
+        sort=sort,
+        sorts=STOP_SORTS,
+        hoods=hoods,
         form=form
-    )
+    ), weak=True)
+
+
+@app.get('/stops')
+@replicas.read_only
+def stops_list():
+    """Return a page of stops in the ?hood= neighborhoods (repeatable),
+        sorted by ?sort= and starting at ?cursor=
+    """
+
+    return render_stops_list('name')
+
+
+@app.get('/stops/popular')
+@replicas.read_only
+def popular_stops():
+    """Return stops ranked by likes, most liked first."""
+
+    return render_stops_list('popular')
 
 
 @app.get('/stops/<int:stop_id>')
+@replicas.read_only
 def stop_detail(stop_id):
     """Show detail for stop."""
     if not g.user:
         flash('Please log in or Sign up!', 'danger')
         return redirect(url_for('homepage'))
 
-    stop = Stop.query.get_or_404(stop_id)
+    # everything the page shows is a stop column or comes from refdata, so
+    # any relationship load here would be an unplanned extra query
+    stop = Stop.query.options(raiseload('*')).get_or_404(stop_id)
+    liked = Like.exists(g.user.id, stop.id)
 
-    return render_template(
+    etag = page_etag(
+        g.user.id, g.user.version, g.user.admin, liked,
+        neighborhoods.name(stop.hood_code), page_versions([stop]))
+
+    return conditional(etag, lambda: render_template(
         'stop/detail.html',
         stop=stop,
-    )
+        liked=liked,
+    ), weak=True)
 
 
 @app.route('/stops/add', methods=['GET', 'POST'])
@@ -155,8 +366,7 @@ def add_stop():
     if g.user.admin:
         form = StopAddEditForm()
 
-        hoods = [(n.code, n.name) for n in Neighborhood.query.all()]
-        form.hood_code.choices = hoods
+        form.hood_code.choices = neighborhoods.choices()
 
         if form.validate_on_submit():
 
@@ -169,9 +379,10 @@ def add_stop():
                 image_url=form.image_url.data or DEFAULT_STOP_URL
             )
             db.session.add(stop)
-            db.session.commit()
+            db.session.flush()
 
-            stop.save_map()
+            stop.queue_map()
+            db.session.commit()
 
             flash(f'{stop.name} added', 'success')
             return redirect(url_for('stop_detail', stop_id=stop.id))
@@ -195,17 +406,17 @@ def edit_stop(stop_id):
         stop = Stop.query.get_or_404(stop_id)
         form = StopAddEditForm(obj=stop)
 
-        hoods = [(n.code, n.name) for n in Neighborhood.query.all()]
-        form.hood_code.choices = hoods
+        form.hood_code.choices = neighborhoods.choices()
 
         if form.validate_on_submit():
-            if form.address.data:
-                form.populate_obj(stop)
-                db.session.flush()
-                stop.save_map()
-
             form.populate_obj(stop)
+
+            # a failed render is retried even if the address came back
+            if stop.map_status != 'ready' or not stop.map_is_current():
+                stop.queue_map()
+
             db.session.commit()
+            invalidate_stop_card(stop.id)
 
             flash(f'{stop.name} edited', 'success')
             return redirect(url_for('stop_detail', stop_id=stop.id))
@@ -229,6 +440,7 @@ def delete_stop(stop_id):
         g.user.liked_stops.remove(stop)
     db.session.delete(stop)
     db.session.commit()
+    invalidate_stop_card(stop_id)
 
     return redirect(url_for('stops_list'))
 
@@ -288,6 +500,8 @@ def login():
             form.password.data
         )
         if user:
+            # saves an upgraded password hash, if any
+            db.session.commit()
             do_login(user)
 
             flash(f'Hello, {user.username}', 'success')
@@ -312,6 +526,7 @@ def logout():
 
 
 @app.get('/users/<int:user_id>')
+@replicas.read_only
 def show_user_profile(user_id):
     """ Show profile page about user """
 
@@ -319,7 +534,14 @@ def show_user_profile(user_id):
         flash('Access unauthorized', 'danger')
         return redirect(url_for('homepage'))
 
-    user = User.query.get_or_404(user_id)
+    query = User.query
+    if user_id == g.user.id:
+        # the page lists the viewer's liked stops; fetch them in the same
+        # query (their cards only use stop columns)
+        query = query.options(joinedload(User.liked_stops))
+
+    user = query.filter_by(id=user_id).first_or_404()
+
     return render_template('profile/detail.html', user=user)
 
 
@@ -340,16 +562,126 @@ def edit_user(user_id):
         form.populate_obj(user)
 
         db.session.commit()
+
+        if user.id == g.user.id:
+            remember(session, user)
+
         flash(f'Profile edited', 'success')
         return redirect(url_for('show_user_profile', user_id=user_id))
 
     return render_template('profile/edit-form.html', form=form)
 
+#######################################
+# stops api
+
+
+@app.get('/api/stops')
+@replicas.read_only
+def list_stops_api():
+    """ Page of stops for infinite scroll, same args as /stops
+        Return JSON: {"stops": [{id, name, ..., thumbnail_url,
+            thumbnail_srcset}, ...], "next_cursor": str|null}
+    """
+
+    if not g.user:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    _, page = stops_page(
+        filter_stops(Stop.query, request.args.getlist('hood')))
+
+    etag = make_etag('stops', page.next_cursor, page_versions(page.items))
+
+    return conditional(etag, lambda: jsonify({
+        'stops': [{
+            **stop.serialize(),
+            'thumbnail_url': thumbnail_url(stop.image_url),
+            'thumbnail_srcset': thumbnail_srcset(stop.image_url),
+        } for stop in page.items],
+        'next_cursor': page.next_cursor,
+    }))
+
+
+@app.get('/api/stops/search')
+def search_stops_api():
+    """ Full-text search: ?q= (required), ?hood= (repeatable), ?limit=,
+        ?offset=
+        Return JSON: {"results": [{id, name, ..., "rank": 0.1,
+            "name_html": str, "snippet_html": str}], "next_offset": int|null}
+    """
+
+    if not g.user:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'error': 'q required'}), 400
+
+    results = search_stops(
+        q,
+        request.args.getlist('hood'),
+        limit=request.args.get('limit', DEFAULT_PAGE_SIZE, type=int),
+        offset=request.args.get('offset', 0, type=int)
+    )
+
+    return jsonify({
+        'results': [
+            {
+                **hit.stop.serialize(),
+                'rank': hit.rank,
+                'name_html': str(hit.name),
+                'snippet_html': str(hit.snippet),
+            }
+            for hit in results.hits
+        ],
+        'next_offset': results.next_offset,
+    })
+
+
+MAX_NEARBY = 100
+
+
+@app.get('/api/stops/near')
+def nearby_stops_api():
+    """ Stops closest to ?lat=&lng=, optionally within ?radius_km=
+        (?limit= up to 100, default 10). Served from the in-process index
+        Return JSON: {"stops": [{id, name, latitude, longitude,
+            distance_km}, ...]}
+    """
+
+    if not g.user:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    limit = request.args.get('limit', 10, type=int)
+    radius_km = request.args.get('radius_km', type=float)
+
+    if (
+        lat is None or lng is None
+        or not -90 <= lat <= 90 or not -180 <= lng <= 180
+    ):
+        return jsonify({'error': 'lat and lng required'}), 400
+
+    if radius_km is not None and not radius_km >= 0:
+        return jsonify({'error': 'radius_km must not be negative'}), 400
+
+    nearby = stop_locations.nearest(
+        lat, lng, limit=max(1, min(limit, MAX_NEARBY)), radius_km=radius_km)
+
+    return jsonify({
+        'stops': [
+            {**near.stop._asdict(), 'distance_km': round(near.distance_km, 3)}
+            for near in nearby
+        ]
+    })
+
+
 #######################################
 # likes
 
 
 @app.get('/api/likes')
+@replicas.read_only
 def check_like():
     """ Given stop id does user like stop
         Return JSON: {"likes": true|false}
@@ -358,18 +690,90 @@ def check_like():
     if not g.user:
         return jsonify({'error': 'Not logged in'}), 401
 
-    stop_id = int(request.args.get('stop_id'))
-    stop = Stop.query.get_or_404(stop_id)
+    stop_id = request.args.get('stop_id', type=int)
+    if stop_id is None:
+        return jsonify({'error': 'stop_id required'}), 400
+
+    return conditional(likes_etag([stop_id]), lambda: jsonify({
+        'likes': 'true' if Like.exists(g.user.id, stop_id) else 'false'
+    }))
+
+
+MAX_BATCH_LIKES = 500
+
+
+@app.get('/api/likes/batch')
+@replicas.read_only
+def check_likes_batch():
+    """ Given stop ids (?stop_id=1&stop_id=2...), which does user like
+        Return JSON: {"likes": {"1": true, "2": false, ...}}
+    """
+
+    if not g.user:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    try:
+        stop_ids = [int(id) for id in request.args.getlist('stop_id')]
+    except ValueError:
+        return jsonify({'error': 'stop_id must be integers'}), 400
+
+    if len(stop_ids) > MAX_BATCH_LIKES:
+        return jsonify(
+            {'error': f'At most {MAX_BATCH_LIKES} stop ids per request'}), 400
+
+    def render():
+        liked = Like.liked_stop_ids(g.user.id, stop_ids)
 
-    if stop in g.user.liked_stops:
-        return jsonify({
-            'likes': 'true'
-        })
-    else:
         return jsonify({
-            'likes': 'false'
+            'likes': {str(id): id in liked for id in stop_ids}
         })
 
+    return conditional(likes_etag(stop_ids), render)
+
+
+def set_like(stop_id, liked):
+    """ Make current user like or unlike stop, idempotently, and commit.
+        Return (liked, like_count); raise NotFound if no such stop
+    """
+
+    try:
+        if liked:
+            Like.add(g.user.id, stop_id)
+        else:
+            Like.remove(g.user.id, stop_id)
+
+        like_count = db.session.scalar(
+            db.select(Stop.like_count).where(Stop.id == stop_id))
+        db.session.commit()
+
+    except IntegrityError:
+        # foreign key violation: the stop does not exist
+        db.session.rollback()
+        raise NotFound()
+
+    if like_count is None:
+        raise NotFound()
+
+    return liked, like_count
+
+
+@app.route('/api/stops/<int:stop_id>/like', methods=['PUT', 'DELETE'])
+def put_or_delete_like(stop_id):
+    """ PUT likes the stop, DELETE unlikes it; repeating either is harmless
+        Return JSON {"stop_id": 1, "liked": true|false, "like_count": 3}
+    """
+
+    if not g.user:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    liked, like_count = set_like(stop_id, request.method == 'PUT')
+
+    return jsonify({
+        'stop_id': stop_id,
+        'liked': liked,
+        'like_count': like_count,
+    })
+
 
 @app.post('/api/like')
 def user_likes_stop():
@@ -382,10 +786,7 @@ def user_likes_stop():
 
     data = request.json
     stop_id = int(data.get('stop_id'))
-    stop = Stop.query.get_or_404(stop_id)
-
-    g.user.liked_stops.append(stop)
-    db.session.commit()
+    set_like(stop_id, True)
 
     return jsonify({"liked": stop_id}), 201
 
@@ -401,9 +802,54 @@ def user_unlike_stop():
 
     data = request.json
     stop_id = int(data.get('stop_id'))
-    stop = Stop.query.get_or_404(stop_id)
-
-    g.user.liked_stops.remove(stop)
-    db.session.commit()
+    set_like(stop_id, False)
 
     return jsonify({"unliked": stop_id}), 201
+
+
+#######################################
+# export api
+
+
+@app.get('/api/export/<kind>')
+def export_api(kind):
+    """ Admin only: stream every neighborhood, stop, user or like as
+        ?format=ndjson (default) or csv, as a file download
+    """
+
+    if not g.user:
+        return jsonify({'error': 'Not logged in'}), 401
+    if not g.user.admin:
+        return jsonify({'error': 'Admins only'}), 403
+
+    fmt = request.args.get('format', 'ndjson')
+
+    if kind not in EXPORTS:
+        raise NotFound()
+    if fmt not in EXPORT_FORMATS:
+        raise BadRequest(f'format must be one of {", ".join(EXPORT_FORMATS)}')
+
+    # stream_with_context keeps the app context (and db session) alive
+    # while the body is sent
+    resp = Response(stream_with_context(export_chunks(kind, fmt)),
+                    mimetype=EXPORT_FORMATS[fmt])
+    resp.headers['Content-Disposition'] = \
+        f'attachment; filename="{kind}.{fmt}"'
+    resp.headers['Cache-Control'] = 'no-store'
+
+    return resp
+
+
+#######################################
+# metrics
+
+
+@app.get('/metrics')
+def metrics_endpoint():
+    """ Prometheus metrics, for internal scrapers only"""
+
+    if not metrics.scrape_allowed():
+        raise NotFound()
+
+    return Response(metrics.registry.render(),
+                    content_type=metrics.CONTENT_TYPE)
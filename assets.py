@@ -0,0 +1,169 @@
+"""Fingerprinted static assets for Rich City Stops.
+
+asset_url('css/style.css') returns /assets/css/style.<hash>.css, where hash
+is taken from the file's contents, so the URL changes whenever the file
+does and responses can be cached forever. Digests are computed lazily and
+kept per (mtime, size), so regenerated files like maps get a new URL
+without a build step.
+
+`flask assets compress` writes .gz (and .br, if the optional brotli
+package is installed) next to text assets; they're served to clients that
+accept them.
+"""
+
+import gzip
+import hashlib
+import os
+import re
+import threading
+from stat import S_ISREG
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+STATIC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'static'))
+
+DIGEST_LENGTH = 12
+
+# /assets/<name>.<digest><ext>
+FINGERPRINT_RE = re.compile(
+    r'^(?P<name>.+)\.(?P<digest>[0-9a-f]{%d})(?P<ext>\.[^./]+)$'
+    % DIGEST_LENGTH)
+
+# worth precompressing; images are compressed already
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+
+# preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+class AssetManifest:
+    """ Content digests of files under directory """
+
+    def __init__(self, directory):
+        self.directory = directory
+        # path -> ((mtime_ns, size), digest)
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def full_path(self, path):
+        """ Absolute path for path, or None if it escapes directory"""
+
+        full = os.path.abspath(os.path.join(self.directory, path))
+
+        if not full.startswith(self.directory + os.sep):
+            return None
+
+        return full
+
+    def digest(self, path):
+        """ Return content digest of path, or None if it doesn't exist"""
+
+        full = self.full_path(path)
+
+        try:
+            stat = os.stat(full) if full else None
+        except (FileNotFoundError, NotADirectoryError):
+            stat = None
+
+        if stat is None or not S_ISREG(stat.st_mode):
+            return None
+
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        cached = self._digests.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+
+        sha = hashlib.sha256()
+        with open(full, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                sha.update(chunk)
+
+        digest = sha.hexdigest()[:DIGEST_LENGTH]
+
+        with self._lock:
+            self._digests[path] = (stamp, digest)
+
+        return digest
+
+    def url(self, path):
+        """ Fingerprinted URL for path, or its plain /static/ URL if the
+            file doesn't exist (yet)
+        """
+
+        digest = self.digest(path)
+        if digest is None:
+            return f'/static/{path}'
+
+        name, ext = os.path.splitext(path)
+        return f'/assets/{name}.{digest}{ext}'
+
+    def variant(self, path, accept_encodings):
+        """ Return (encoding, full path) of the best precompressed variant
+            of path the client accepts, or (None, full path)
+        """
+
+        full = self.full_path(path)
+        source_mtime = os.stat(full).st_mtime_ns
+
+        for encoding, suffix in ENCODINGS:
+            if not accept_encodings.quality(encoding):
+                continue
+
+            try:
+                # skip variants older than the file they were made from
+                if os.stat(full + suffix).st_mtime_ns >= source_mtime:
+                    return encoding, full + suffix
+            except FileNotFoundError:
+                pass
+
+        return None, full
+
+
+def parse_fingerprint(filename):
+    """ Split 'css/style.<digest>.css' into ('css/style.css', digest), or
+        return None if it isn't fingerprinted
+    """
+
+    match = FINGERPRINT_RE.match(filename)
+    if not match:
+        return None
+
+    return match['name'] + match['ext'], match['digest']
+
+
+def compress_file(full):
+    """ Write full.gz (and full.br if brotli is available). Return the
+        paths written
+    """
+
+    with open(full, 'rb') as f:
+        data = f.read()
+
+    variants = [(full + '.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append((full + '.br', brotli.compress(data)))
+
+    for path, compressed in variants:
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(compressed)
+        os.replace(tmp, path)
+
+    return [path for path, _ in variants]
+
+
+def compressible_files(directory):
+    """ Yield full paths of files under directory worth precompressing"""
+
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith(COMPRESSIBLE):
+                yield os.path.join(root, name)
+
+
+assets = AssetManifest(STATIC_DIR)
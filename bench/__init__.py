@@ -0,0 +1,21 @@
+"""Load-test harness for Rich City Stops.
+
+Everything runs locally: a throwaway Postgres database, a stub standing in
+for MapQuest, the app under a real WSGI server, and a load driver. Run
+from the repository root:
+
+    createdb rich_city_bench
+    export DATABASE_URL=postgresql:///rich_city_bench FLASK_DEBUG=0 \\
+        MAPQUEST_API_KEY=stub MAPQUEST_BASE_URL=http://127.0.0.1:8089
+
+    python -m bench.stub_provider --port 8089 &
+    python -m bench.dataset --stops 100000 --users 2000 --likes 1000000
+    flask run --port 5000 --with-threads &    # or gunicorn -w 4 app:app
+    python -m bench.load --base-url http://127.0.0.1:5000 \\
+        --concurrency 32 --duration 60 --mix browse
+
+bench.dataset writes bench-dataset.json describing what it generated;
+bench.load reads it to pick real stop ids and log in as generated users.
+Both take --seed, so runs are repeatable. `flask jobs work` or `flask maps
+warm` render maps through the stub if a run needs them.
+"""
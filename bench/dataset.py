@@ -0,0 +1,243 @@
+"""Generate a large synthetic dataset for load tests.
+
+Wipes the configured database and fills it with neighborhoods, stops,
+users and likes using COPY, then fixes up like counts and sequences and
+runs ANALYZE. Stop popularity is skewed (a few stops get most likes) and
+stops are spread over the city with coordinates, like real data.
+
+Every user's password is the same (--password), hashed once.
+
+    python -m bench.dataset --stops 100000 --users 2000 --likes 1000000
+"""
+
+import csv
+import io
+import json
+import random
+import time
+
+import click
+
+from app import app
+from mapping import normalize_address
+from models import db, Stop, DEFAULT_IMG_URL
+from geocoding import RICHMOND_BOUNDS
+from passwords import hash_password
+
+# rows per COPY
+CHUNK_SIZE = 50_000
+
+STREETS = (
+    'Macdonald Ave', 'Cutting Blvd', 'San Pablo Ave', 'Barrett Ave',
+    'Marina Way', 'Harbour Way', 'Carlson Blvd', 'Potrero Ave',
+    'Key Blvd', 'Garrard Blvd', 'Washington Ave', 'Richmond Pkwy',
+)
+
+WORDS = (
+    'bay', 'trail', 'views', 'historic', 'park', 'murals', 'tacos', 'beach',
+    'birds', 'sunset', 'ferry', 'garden', 'coffee', 'hike', 'shoreline',
+    'market', 'museum', 'pier', 'bakery', 'wetlands',
+)
+
+IMAGE_URLS = (
+    'https://www.nps.gov/subjects/urban/images/richmond.PNG',
+    'https://images.example.com/stops/one.jpg',
+    'https://images.example.com/stops/two.jpg',
+    'https://images.example.com/stops/three.jpg',
+)
+
+
+def copy_rows(table, columns, rows):
+    """ COPY an iterable of row tuples into table, CHUNK_SIZE at a time"""
+
+    cursor = db.session.connection().connection.cursor()
+    sql = f'COPY {table} ({", ".join(columns)}) FROM STDIN (FORMAT csv)'
+    count = 0
+
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            count += _copy_chunk(cursor, sql, chunk)
+            chunk = []
+
+    if chunk:
+        count += _copy_chunk(cursor, sql, chunk)
+
+    return count
+
+
+def _copy_chunk(cursor, sql, rows):
+    data = io.StringIO()
+    csv.writer(data).writerows(rows)
+    data.seek(0)
+    cursor.copy_expert(sql, data)
+
+    return len(rows)
+
+
+def description(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(8, 30)))
+
+
+def stop_rows(rng, stops, hoods):
+    south, west, north, east = RICHMOND_BOUNDS
+
+    for id in range(1, stops + 1):
+        # the number keeps every address unique
+        address = f'{id} {rng.choice(STREETS)}'
+
+        yield (
+            id, f'Stop {id}', description(rng), f'https://example.com/{id}',
+            address, rng.choice(hoods), rng.choice(IMAGE_URLS), 'pending', 0,
+            1, round(rng.uniform(south, north), 6),
+            round(rng.uniform(west, east), 6), normalize_address(address),
+        )
+
+
+def user_rows(users, hashed_password):
+    for id in range(1, users + 1):
+        yield (
+            id, f'user{id}', f'user{id}@bench.test', 'Bench', f'User {id}',
+            'Generated for load tests.', DEFAULT_IMG_URL,
+            hashed_password, False, 1, 1,
+        )
+
+
+def popular_stop(rng, stops):
+    """ A stop id, skewed so low ids get most likes"""
+
+    return 1 + int(stops * rng.random() ** 3)
+
+
+def like_rows(rng, users, stops, likes):
+    """ About likes (user_id, stop_id) pairs with no duplicates; some
+        users like far more stops than others
+    """
+
+    weights = [rng.paretovariate(1.5) for _ in range(users)]
+    scale = likes / sum(weights)
+
+    for user_id, weight in enumerate(weights, start=1):
+        wanted = min(stops, max(1, round(weight * scale)))
+        liked = set()
+
+        # sample with the popularity skew, then fill up evenly so heavy
+        # users don't spin on the same popular stops
+        for _ in range(wanted * 2):
+            liked.add(popular_stop(rng, stops))
+            if len(liked) >= wanted:
+                break
+
+        while len(liked) < wanted:
+            liked.add(rng.randint(1, stops))
+
+        for stop_id in sorted(liked):
+            yield (user_id, stop_id)
+
+
+def generate(hoods, stops, users, likes, password, seed):
+    """ Replace the database contents with a generated dataset. Return a
+        manifest describing it
+    """
+
+    rng = random.Random(seed)
+    timings = {}
+
+    def phase(name, fn):
+        start = time.perf_counter()
+        result = fn()
+        timings[name] = round(time.perf_counter() - start, 2)
+        click.echo(f'{name}: {timings[name]}s')
+        return result
+
+    phase('schema', lambda: (db.drop_all(), db.create_all()))
+
+    hood_codes = [f'hood{i}' for i in range(1, hoods + 1)]
+    phase('neighborhoods', lambda: copy_rows(
+        'neighborhoods', ('code', 'name'),
+        ((code, f'Neighborhood {code[4:]}') for code in hood_codes)))
+
+    hashed = hash_password(password)
+    phase('users', lambda: copy_rows(
+        'users',
+        ('id', 'username', 'email', 'first_name', 'last_name', 'description',
+         'image_url', 'hashed_password', 'admin', 'version', 'likes_version'),
+        user_rows(users, hashed)))
+
+    phase('stops', lambda: copy_rows(
+        'stops',
+        ('id', 'name', 'description', 'url', 'address', 'hood_code',
+         'image_url', 'map_status', 'like_count', 'version', 'latitude',
+         'longitude', 'geocoded_address'),
+        stop_rows(rng, stops, hood_codes)))
+
+    like_count = phase('likes', lambda: copy_rows(
+        'likes', ('user_id', 'stop_id'),
+        like_rows(rng, users, stops, likes)))
+
+    def finish():
+        Stop.reconcile_like_counts()
+        # ids were given explicitly, so move the sequences past them
+        for table in ('users', 'stops'):
+            db.session.execute(db.text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"(SELECT coalesce(max(id), 0) + 1 FROM {table}), false)"))
+        db.session.commit()
+
+    phase('like counts', finish)
+
+    def analyze():
+        # fresh planner statistics, or the first queries plan for empty
+        # tables
+        with db.engine.connect() as conn:
+            conn.execute(db.text('ANALYZE'))
+            conn.commit()
+
+    phase('analyze', analyze)
+
+    return {
+        'neighborhoods': hood_codes,
+        'stops': stops,
+        'users': users,
+        'likes': like_count,
+        'username_prefix': 'user',
+        'password': password,
+        'seed': seed,
+        'timings': timings,
+    }
+
+
+@click.command()
+@click.option('--hoods', default=20, show_default=True)
+@click.option('--stops', default=100_000, show_default=True)
+@click.option('--users', default=2_000, show_default=True)
+@click.option('--likes', default=1_000_000, show_default=True,
+              help='Approximate total likes.')
+@click.option('--password', default='bench-password', show_default=True,
+              help='Password for every generated user.')
+@click.option('--seed', default=1, show_default=True)
+@click.option('--manifest', default='bench-dataset.json', show_default=True,
+              type=click.Path(dir_okay=False),
+              help='Where to write the description of the dataset.')
+@click.option('--yes', is_flag=True, help="Don't ask before wiping.")
+def main(hoods, stops, users, likes, password, seed, manifest, yes):
+    """Wipe the app's database and fill it with a synthetic dataset."""
+
+    url = app.config['SQLALCHEMY_DATABASE_URI']
+    if not yes:
+        click.confirm(f'This drops every table in {url}. Continue?',
+                      abort=True)
+
+    info = generate(hoods, stops, users, likes, password, seed)
+    info['database'] = url
+
+    with open(manifest, 'w') as file:
+        json.dump(info, file, indent=2)
+
+    click.echo(f'{stops} stops, {users} users, {info["likes"]} likes; '
+               f'wrote {manifest}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+"""Concurrent HTTP load driver for Rich City Stops.
+
+Each virtual user is a thread with its own cookie session. It logs in as
+one of the generated users, then picks actions from a weighted mix until
+the run ends. Like a browser, it revalidates pages it has seen with
+If-None-Match (turn off with --no-etags). Latency is recorded per action;
+the report gives throughput and p50/p95/p99 for each.
+
+    python -m bench.load --base-url http://127.0.0.1:5000 \\
+        --concurrency 32 --duration 60 --mix browse
+
+The driver is plain Python threads, so check its own CPU use on big runs;
+run more than one driver process if it's the bottleneck.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlencode
+
+import click
+import requests
+
+CSRF_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+SORTS = ('name', 'newest', 'neighborhood', 'popular')
+
+SEARCH_WORDS = ('bay', 'trail', 'murals', 'tacos', 'park', 'ferry', 'pier')
+
+# cards per page, for /api/likes/batch
+PAGE_SIZE = 24
+
+# action -> weight
+MIXES = {
+    # a logged-in user looking around
+    'browse': {
+        'stops_list': 25,
+        'stops_api': 10,
+        'stop_detail': 30,
+        'check_like': 10,
+        'likes_batch': 10,
+        'search': 5,
+        'nearby': 5,
+        'toggle_like': 4,
+        'login': 1,
+    },
+    # mostly like/unlike traffic
+    'likes': {
+        'check_like': 30,
+        'likes_batch': 30,
+        'toggle_like': 30,
+        'stop_detail': 10,
+    },
+    'login': {
+        'login': 1,
+    },
+}
+
+
+class LoadError(Exception):
+    """ A request got an unexpected status """
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of a sorted list"""
+
+    if not values:
+        return 0.0
+
+    rank = max(1, round(pct / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+class VirtualUser:
+    """ One simulated browser: a session, a generated user, and state """
+
+    def __init__(self, base_url, dataset, rng, etags=True, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.dataset = dataset
+        self.rng = rng
+        self.etags = etags
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.seen = {}
+
+    def request(self, method, path, expect=(200,), params=None, **kwargs):
+        url = self.base_url + path
+        if params:
+            url += '?' + urlencode(params, doseq=True)
+
+        headers = kwargs.pop('headers', {})
+
+        if method == 'GET' and self.etags and url in self.seen:
+            headers['If-None-Match'] = self.seen[url]
+
+        resp = self.session.request(
+            method, url, headers=headers, allow_redirects=False,
+            timeout=self.timeout, **kwargs)
+
+        if resp.status_code == 304:
+            return resp
+
+        if resp.status_code not in expect:
+            raise LoadError(f'{method} {path} returned {resp.status_code}')
+
+        if method == 'GET' and 'ETag' in resp.headers:
+            self.seen[url] = resp.headers['ETag']
+
+        return resp
+
+    def stop_id(self):
+        # likes are skewed to low ids, so traffic is too
+        return 1 + int(self.dataset['stops'] * self.rng.random() ** 3)
+
+    def hood_args(self):
+        if self.rng.random() < 0.3:
+            return {'hood': self.rng.choice(self.dataset['neighborhoods'])}
+        return {}
+
+    # actions
+
+    def login(self):
+        user = self.rng.randint(1, self.dataset['users'])
+        page = self.request('GET', '/login')
+        token = CSRF_RE.search(page.text)
+
+        self.request('POST', '/login', expect=(302,), data={
+            'username': f'{self.dataset["username_prefix"]}{user}',
+            'password': self.dataset['password'],
+            'csrf_token': token.group(1) if token else '',
+        })
+
+    def stops_list(self):
+        self.request('GET', '/stops', params={
+            'sort': self.rng.choice(SORTS), **self.hood_args()})
+
+    def stops_api(self):
+        params = {'sort': self.rng.choice(SORTS), **self.hood_args()}
+        resp = self.request('GET', '/api/stops', params=params)
+
+        # and scroll one page further, like infinite scroll; both count
+        # toward this action's latency
+        cursor = resp.json().get('next_cursor') if resp.status_code == 200 \
+            else None
+        if cursor:
+            self.request('GET', '/api/stops',
+                         params={**params, 'cursor': cursor})
+
+    def stop_detail(self):
+        self.request('GET', f'/stops/{self.stop_id()}')
+
+    def check_like(self):
+        self.request('GET', '/api/likes', params={'stop_id': self.stop_id()})
+
+    def likes_batch(self):
+        start = self.rng.randint(1, max(1, self.dataset['stops'] - PAGE_SIZE))
+        ids = range(start, start + PAGE_SIZE)
+        self.request('GET', '/api/likes/batch',
+                     params=[('stop_id', id) for id in ids])
+
+    def search(self):
+        self.request('GET', '/stops', params={
+            'q': self.rng.choice(SEARCH_WORDS)})
+
+    def nearby(self):
+        self.request('GET', '/api/stops/near', params={
+            'lat': round(self.rng.uniform(37.90, 37.99), 5),
+            'lng': round(self.rng.uniform(-122.42, -122.30), 5),
+        })
+
+    def toggle_like(self):
+        method = self.rng.choice(('PUT', 'DELETE'))
+        self.request(method, f'/api/stops/{self.stop_id()}/like')
+
+
+class Results:
+    """ Latencies and errors per action, shared by all virtual users """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.error_samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, action, elapsed, error=None):
+        with self._lock:
+            if error is None:
+                self.latencies[action].append(elapsed)
+            else:
+                self.errors[action] += 1
+                self.error_samples.setdefault(action, repr(error))
+
+    def summary(self, duration):
+        rows = {}
+
+        for action in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies[action])
+            rows[action] = {
+                'count': len(values),
+                'errors': self.errors[action],
+                'rps': round(len(values) / duration, 1),
+                **{f'p{pct}_ms': round(percentile(values, pct) * 1000, 1)
+                   for pct in (50, 95, 99)},
+                'max_ms': round((values[-1] if values else 0) * 1000, 1),
+            }
+
+        total = sum(row['count'] for row in rows.values())
+        return {
+            'duration': round(duration, 1),
+            'requests': total,
+            'errors': sum(row['errors'] for row in rows.values()),
+            'rps': round(total / duration, 1),
+            'actions': rows,
+            'error_samples': self.error_samples,
+        }
+
+
+def run_user(user, mix, results, warmup_until, stop_at):
+    actions, weights = zip(*mix.items())
+
+    try:
+        user.login()
+    except Exception as exc:
+        results.record('login', 0, exc)
+        return
+
+    while time.monotonic() < stop_at:
+        action = user.rng.choices(actions, weights)[0]
+        start = time.perf_counter()
+
+        try:
+            getattr(user, action)()
+            error = None
+        except Exception as exc:
+            error = exc
+
+        if time.monotonic() >= warmup_until:
+            results.record(action, time.perf_counter() - start, error)
+
+
+def run(base_url, dataset, mix, concurrency, duration, warmup=0, seed=1,
+        etags=True):
+    """ Drive load for warmup + duration seconds; return the summary"""
+
+    results = Results()
+    start = time.monotonic()
+    warmup_until = start + warmup
+    stop_at = warmup_until + duration
+
+    threads = [
+        threading.Thread(
+            target=run_user,
+            args=(VirtualUser(base_url, dataset, random.Random(seed + i),
+                              etags=etags),
+                  mix, results, warmup_until, stop_at),
+            daemon=True,
+        )
+        for i in range(concurrency)
+    ]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results.summary(duration)
+
+
+def format_report(summary):
+    lines = [
+        f'{summary["requests"]} requests in {summary["duration"]}s, '
+        f'{summary["rps"]} req/s, {summary["errors"]} errors',
+        '',
+        f'{"action":<14}{"count":>8}{"errors":>8}{"req/s":>9}'
+        f'{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"max ms":>9}',
+    ]
+
+    for action, row in summary['actions'].items():
+        lines.append(
+            f'{action:<14}{row["count"]:>8}{row["errors"]:>8}'
+            f'{row["rps"]:>9}{row["p50_ms"]:>9}{row["p95_ms"]:>9}'
+            f'{row["p99_ms"]:>9}{row["max_ms"]:>9}')
+
+    for action, sample in summary['error_samples'].items():
+        lines.append(f'first {action} error: {sample}')
+
+    return '\n'.join(lines)
+
+
+@click.command()
+@click.option('--base-url', default='http://127.0.0.1:5000',
+              show_default=True)
+@click.option('--dataset', 'dataset_path', default='bench-dataset.json',
+              show_default=True, type=click.Path(exists=True),
+              help='Manifest written by bench.dataset.')
+@click.option('--mix', type=click.Choice(list(MIXES)), default='browse',
+              show_default=True)
+@click.option('--concurrency', default=16, show_default=True,
+              help='Virtual users.')
+@click.option('--duration', default=30.0, show_default=True,
+              help='Seconds to measure.')
+@click.option('--warmup', default=5.0, show_default=True,
+              help='Seconds to run before measuring.')
+@click.option('--seed', default=1, show_default=True)
+@click.option('--etags/--no-etags', default=True, show_default=True,
+              help='Revalidate seen pages with If-None-Match.')
+@click.option('--json', 'json_path', type=click.Path(dir_okay=False),
+              help='Also write the summary as JSON.')
+def main(base_url, dataset_path, mix, concurrency, duration, warmup, seed,
+         etags, json_path):
+    """Run a load test against a running Rich City Stops server."""
+
+    with open(dataset_path) as file:
+        dataset = json.load(file)
+
+    summary = run(base_url, dataset, MIXES[mix], concurrency, duration,
+                  warmup=warmup, seed=seed, etags=etags)
+    summary.update(mix=mix, concurrency=concurrency, base_url=base_url)
+
+    click.echo(format_report(summary))
+
+    if json_path:
+        with open(json_path, 'w') as file:
+            json.dump(summary, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
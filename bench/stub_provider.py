@@ -0,0 +1,125 @@
+"""Stand-in for the MapQuest static map and geocoding APIs.
+
+Serves the two endpoints the app calls, with an optional fixed delay, so
+map renders and geocoding can run under load without touching MapQuest.
+Point the app at it with MAPQUEST_BASE_URL=http://127.0.0.1:<port>.
+
+    python -m bench.stub_provider --port 8089 --latency 0.05
+"""
+
+import hashlib
+import io
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import click
+from PIL import Image, ImageDraw
+
+from geocoding import RICHMOND_BOUNDS
+
+MAP_PATH = '/staticmap/v5/map'
+GEOCODE_PATH = '/geocoding/v1/address'
+
+
+def map_png(width=1200, height=800):
+    """ A plausible map-sized PNG (not a flat color, so it compresses like
+        a real one)
+    """
+
+    image = Image.new('RGB', (width, height), (232, 228, 218))
+    draw = ImageDraw.Draw(image)
+
+    for x in range(0, width, 60):
+        draw.line([(x, 0), (x, height)], fill=(255, 255, 255), width=6)
+    for y in range(0, height, 45):
+        draw.line([(0, y), (width, y)], fill=(255, 255, 255), width=6)
+    draw.ellipse([width // 2 - 12, height // 2 - 12,
+                  width // 2 + 12, height // 2 + 12], fill=(200, 40, 40))
+
+    out = io.BytesIO()
+    image.save(out, 'PNG')
+    return out.getvalue()
+
+
+def lat_lng(location):
+    """ A stable point in Richmond for a location string"""
+
+    digest = hashlib.sha256(location.lower().encode('utf-8')).digest()
+    south, west, north, east = RICHMOND_BOUNDS
+
+    return (
+        round(south + (north - south) * digest[0] / 255, 6),
+        round(west + (east - west) * digest[1] / 255, 6),
+    )
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # set by make_server
+    latency = 0
+    png = b''
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        args = parse_qs(url.query)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if url.path == MAP_PATH:
+            self.reply(200, 'image/png', self.png)
+
+        elif url.path == GEOCODE_PATH:
+            location = args.get('location', [''])[0]
+            lat, lng = lat_lng(location)
+            body = {'results': [{'locations': [
+                {'latLng': {'lat': lat, 'lng': lng}}]}]}
+            self.reply(200, 'application/json', json.dumps(body).encode())
+
+        else:
+            self.reply(404, 'text/plain', b'not found')
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host='127.0.0.1', port=0, latency=0):
+    """ Return a ThreadingHTTPServer serving the stub (port 0 picks a free
+        port; see server.server_address)
+    """
+
+    handler = type('Handler', (StubHandler,),
+                   {'latency': latency, 'png': map_png()})
+
+    return ThreadingHTTPServer((host, port), handler)
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', default=8089, show_default=True)
+@click.option('--latency', default=0.0, show_default=True,
+              help='Seconds to wait before each response.')
+def main(host, port, latency):
+    """Serve fake MapQuest static maps and geocoding."""
+
+    server = make_server(host, port, latency)
+    click.echo(f'Stub map provider on http://{host}:{port}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
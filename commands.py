@@ -0,0 +1,238 @@
+"""Flask CLI commands for Rich City Stops."""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import click
+from flask.cli import AppGroup
+
+import assets
+import exporter
+import importer
+import jobs
+import mapping
+from geocoding import geocoder
+from models import db, Stop
+
+jobs_cli = AppGroup('jobs', help='Background job queue.')
+maps_cli = AppGroup('maps', help='Static map images.')
+likes_cli = AppGroup('likes', help='Stop likes.')
+assets_cli = AppGroup('assets', help='Fingerprinted static assets.')
+data_cli = AppGroup('data', help='Bulk data import and export.')
+
+WARM_COMMIT_EVERY = 50
+
+logger = logging.getLogger(__name__)
+
+
+@jobs_cli.command('work')
+@click.option('--burst', is_flag=True,
+              help='Exit once the queue is empty instead of polling.')
+@click.option('--poll-interval', default=1.0, show_default=True,
+              help='Seconds to sleep when the queue is empty.')
+def work_command(burst, poll_interval):
+    """Run a worker that processes queued jobs."""
+
+    count = jobs.work(burst=burst, poll_interval=poll_interval)
+    click.echo(f'Processed {count} jobs')
+
+
+def stops_needing_maps(stops, force=False):
+    """ Return (id, address, key) for stops whose map files are missing or
+        were rendered from a different address
+    """
+
+    todo = []
+
+    for stop in stops:
+        key = mapping.map_key(stop.address)
+        paths = mapping.map_paths(stop.id).values()
+
+        if (force or stop.map_key != key
+                or not all(os.path.exists(path) for path in paths)):
+            todo.append((stop.id, stop.address, key))
+
+    return todo
+
+
+def geocode_and_render(stop_id, address, lat_lng, geocoded_address):
+    """ Look up coordinates unless already done for this address, then
+        render the map. Return (path or None, (lat, lng) to store or None)
+    """
+
+    found = None
+
+    if geocoded_address != mapping.normalize_address(address):
+        # the stored coordinates, if any, are for another address
+        lat_lng = None
+        try:
+            found = geocoder.geocode(address) or (None, None)
+            lat_lng = found if found[0] is not None else None
+        except Exception as exc:
+            # like the render_map job: draw from the address, geocode later
+            logger.warning('Geocoding stop %s failed: %r', stop_id, exc)
+
+    elif lat_lng[0] is None:
+        lat_lng = None
+
+    return mapping.save_map(stop_id, address, lat_lng), found
+
+
+@maps_cli.command('warm')
+@click.option('--hood', 'hoods', multiple=True,
+              help='Only stops in this neighborhood code (repeatable).')
+@click.option('--stop-id', 'stop_ids', multiple=True, type=int,
+              help='Only this stop (repeatable).')
+@click.option('--workers', default=8, show_default=True,
+              help='Concurrent map provider requests.')
+@click.option('--force', is_flag=True,
+              help='Re-render even if the map is up to date.')
+@click.option('--dry-run', is_flag=True,
+              help='List what would be rendered without fetching.')
+def warm_command(hoods, stop_ids, workers, force, dry_run):
+    """Render static maps for all (or filtered) stops concurrently.
+
+    Stops whose address hasn't been geocoded are geocoded first, as the
+    render_map job does. Up-to-date maps are skipped, so an interrupted run
+    can just be re-run.
+    """
+
+    query = Stop.query.with_entities(
+        Stop.id, Stop.address, Stop.map_key, Stop.latitude, Stop.longitude,
+        Stop.geocoded_address).order_by(Stop.id)
+    if hoods:
+        query = query.filter(Stop.hood_code.in_(hoods))
+    if stop_ids:
+        query = query.filter(Stop.id.in_(stop_ids))
+
+    stops = query.all()
+    todo = stops_needing_maps(stops, force=force)
+
+    click.echo(f'{len(todo)} of {len(stops)} stops need maps')
+
+    if dry_run:
+        for stop_id, address, _ in todo:
+            click.echo(f'  would render stop {stop_id}: {address}')
+        return
+
+    rendered = failed = 0
+
+    by_id = {stop.id: stop for stop in stops}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # workers only talk to the provider and the filesystem; all
+        # database writes stay on this thread
+        futures = {}
+        for stop_id, address, key in todo:
+            stop = by_id[stop_id]
+            future = pool.submit(
+                geocode_and_render, stop_id, address,
+                (stop.latitude, stop.longitude), stop.geocoded_address)
+            futures[future] = (stop_id, address, key)
+
+        with click.progressbar(as_completed(futures), length=len(futures),
+                               label='Rendering maps') as progress:
+            for future in progress:
+                stop_id, address, key = futures[future]
+                path, lat_lng = future.result()
+                stop = db.session.get(Stop, stop_id)
+
+                if lat_lng is not None:
+                    stop.latitude, stop.longitude = lat_lng
+                    stop.geocoded_address = mapping.normalize_address(address)
+
+                if path is None:
+                    failed += 1
+                else:
+                    rendered += 1
+                    stop.map_key = key
+                    stop.map_status = 'ready'
+
+                if (rendered + failed) % WARM_COMMIT_EVERY == 0:
+                    db.session.commit()
+
+    db.session.commit()
+    click.echo(f'Rendered {rendered}, failed {failed}, '
+               f'skipped {len(stops) - len(todo)}')
+
+
+@likes_cli.command('reconcile')
+def reconcile_command():
+    """Recount like_count for every stop from the likes table."""
+
+    fixed = Stop.reconcile_like_counts()
+    db.session.commit()
+    click.echo(f'Fixed like_count on {fixed} stops')
+
+
+@assets_cli.command('compress')
+def compress_command():
+    """Write .gz (and .br) variants of text assets for precompressed
+    serving. Run after changing static files."""
+
+    count = 0
+    for full in assets.compressible_files(assets.STATIC_DIR):
+        count += len(assets.compress_file(full))
+
+    if assets.brotli is None:
+        click.echo('brotli not installed; wrote .gz variants only')
+
+    click.echo(f'Wrote {count} compressed files')
+
+
+@data_cli.command('import')
+@click.argument('kind', type=click.Choice(list(importer.IMPORTERS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']),
+              help='File format. Default: from the file extension.')
+@click.option('--batch-size', default=importer.BATCH_SIZE, show_default=True,
+              help='Rows per INSERT and per transaction.')
+def import_command(kind, path, fmt, batch_size):
+    """Load neighborhoods, stops or likes from a CSV or NDJSON file.
+
+    Existing rows are updated in place, so a file can be re-imported. Bad
+    rows are reported on stderr and skipped.
+    """
+
+    if fmt is None:
+        fmt = 'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv'
+
+    with open(path, newline='', encoding='utf-8') as file:
+        result = importer.IMPORTERS[kind](
+            importer.read_records(file, fmt), batch_size=batch_size)
+
+    for bad in result.bad_rows:
+        problems = '; '.join(
+            f'{field}: {" ".join(messages)}'
+            for field, messages in bad.errors.items())
+        click.echo(f'line {bad.line}: {problems}', err=True)
+
+    click.echo(f'Inserted {result.inserted}, updated {result.updated}, '
+               f'unchanged {result.unchanged}, '
+               f'rejected {len(result.bad_rows)}, '
+               f'maps queued {result.maps_queued}')
+
+
+@data_cli.command('export')
+@click.argument('kind', type=click.Choice(list(exporter.EXPORTS)))
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8',
+                                                atomic=True), default='-',
+              help='File to write. Default: stdout.')
+@click.option('--format', 'fmt', type=click.Choice(list(exporter.FORMATS)),
+              help='File format. Default: from the file extension, or CSV.')
+@click.option('--batch-size', default=exporter.BATCH_SIZE, show_default=True,
+              help='Rows fetched from the database at a time.')
+def export_command(kind, output, fmt, batch_size):
+    """Write all neighborhoods, stops, users or likes as CSV or NDJSON.
+
+    Rows are streamed from a server-side cursor, so memory use doesn't grow
+    with the table.
+    """
+
+    if fmt is None:
+        fmt = 'ndjson' if output.name.endswith(('.ndjson', '.jsonl')) \
+            else 'csv'
+
+    for chunk in exporter.export_chunks(kind, fmt, batch_size=batch_size):
+        output.write(chunk)
@@ -0,0 +1,47 @@
+"""Conditional GET (ETag / If-None-Match) for Rich City Stops pages and APIs.
+
+Views build an ETag from the version columns of whatever they show (stop
+versions and like counts, the viewer's identity and likes version) using
+only cheap lookups, and skip rendering when the client already has that
+version. Pages vary by who is logged in, so responses are private and
+always revalidated.
+"""
+
+import hashlib
+import time
+
+from flask import make_response, request, session
+
+# rendered pages embed a CSRF token that expires after an hour; rotating
+# page ETags every half hour keeps revalidated copies' tokens valid
+PAGE_ETAG_PERIOD = 1800
+
+
+def make_etag(*parts):
+    """ Return an opaque tag for the given parts"""
+
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:32]
+
+
+def page_etag(*parts):
+    """ ETag for a rendered HTML page showing parts"""
+
+    return make_etag(int(time.time() // PAGE_ETAG_PERIOD), *parts)
+
+
+def conditional(etag, render, weak=False):
+    """ Return 304 if the request's If-None-Match has etag, else the
+        response from calling render()
+    """
+
+    # queued flash messages are only shown by rendering the page
+    if request.if_none_match.contains_weak(etag) and '_flashes' not in session:
+        response = make_response('', 304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag, weak=weak)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+
+    return response
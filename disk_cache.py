@@ -0,0 +1,81 @@
+"""Size-bounded on-disk cache for Rich City Stops.
+
+Entries are files named by a caller-supplied key. Reads bump the file's
+mtime, and writes evict least-recently-used files until the directory fits
+its quota.
+"""
+
+import os
+import tempfile
+
+
+class DiskCache:
+    """ Directory of cached blobs with LRU eviction by total size """
+
+    def __init__(self, directory, max_bytes, suffix=''):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+
+    def path(self, key):
+        """ Return filesystem path for key (whether or not it exists)"""
+
+        return os.path.join(self.directory, f'{key}{self.suffix}')
+
+    def get(self, key):
+        """ Return path for key and mark it recently used, or None"""
+
+        path = self.path(key)
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return path
+
+    def put(self, key, data):
+        """ Store bytes under key, evict if over quota, return path"""
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+
+        # write then rename so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp, path)
+
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """ Remove least-recently-used entries until under max_bytes"""
+
+        try:
+            entries = [e for e in os.scandir(self.directory)
+                       if e.is_file() and e.name.endswith(self.suffix)
+                       and not e.name.endswith('.tmp')]
+        except FileNotFoundError:
+            return 0
+
+        stats = [(e.stat().st_mtime, e.stat().st_size, e.path)
+                 for e in entries]
+        total = sum(size for _, size, _ in stats)
+        removed = 0
+
+        for _, size, path in sorted(stats):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            total -= size
+            removed += 1
+
+        return removed
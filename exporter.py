@@ -0,0 +1,85 @@
+"""Streaming bulk export of neighborhoods, stops, users and likes.
+
+Rows are read through a server-side cursor (yield_per), a batch at a time,
+and encoded as NDJSON or CSV chunks as they arrive, so memory stays flat
+however large the table is. The same generator backs `flask data export`
+and the admin /api/export endpoints.
+
+Stop, neighborhood and like exports use the field names `flask data
+import` reads, so an export can be loaded into another database. Users are
+exported without their password hashes.
+"""
+
+import csv
+import io
+import json
+
+from models import db, Neighborhood, Stop, User, Like
+from importer import STOP_FIELDS
+
+# rows fetched per round trip, and per chunk written
+BATCH_SIZE = 1000
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+EXPORTS = {
+    'neighborhoods': lambda: db.select(
+        Neighborhood.code, Neighborhood.name
+    ).order_by(Neighborhood.code),
+
+    'stops': lambda: db.select(
+        Stop.id, *[getattr(Stop, f) for f in STOP_FIELDS], Stop.like_count
+    ).order_by(Stop.id),
+
+    'users': lambda: db.select(
+        User.id, User.username, User.first_name, User.last_name,
+        User.email, User.description, User.image_url, User.admin
+    ).order_by(User.id),
+
+    # ordered by the primary key, so Postgres can walk its index
+    'likes': lambda: db.select(
+        User.username, Stop.name.label('stop')
+    ).select_from(Like).join(User).join(Stop)
+    .order_by(Like.user_id, Like.stop_id),
+}
+
+
+def encode_ndjson(fields, rows):
+    return ''.join(
+        json.dumps(dict(zip(fields, row))) + '\n' for row in rows)
+
+
+def encode_csv(rows):
+    out = io.StringIO()
+    csv.writer(out, lineterminator='\n').writerows(rows)
+    return out.getvalue()
+
+
+def export_chunks(kind, fmt, batch_size=BATCH_SIZE):
+    """ Yield kind's rows as fmt text, one chunk per batch of rows"""
+
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown format {fmt!r}')
+
+    stmt = EXPORTS[kind]()
+    fields = list(stmt.selected_columns.keys())
+
+    if fmt == 'csv':
+        yield encode_csv([fields])
+
+    result = db.session.execute(
+        stmt.execution_options(yield_per=batch_size))
+
+    try:
+        for rows in result.partitions():
+            if fmt == 'csv':
+                yield encode_csv(rows)
+            else:
+                yield encode_ndjson(fields, rows)
+
+    finally:
+        # release the server-side cursor even if the client went away
+        result.close()
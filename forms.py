@@ -1,10 +1,9 @@
 """Forms for Rich City Stops"""
 
 from flask_wtf import FlaskForm
-from wtforms import TextAreaField, SelectField, StringField, PasswordField
-from wtforms_sqlalchemy.fields import QuerySelectField
+from wtforms import TextAreaField, SelectField, StringField, PasswordField, \
+    SelectMultipleField
 from wtforms.validators import InputRequired, Email, Optional, URL, Length
-from models import Neighborhood
 
 
 class StopAddEditForm(FlaskForm):
@@ -108,12 +107,19 @@ class ProfileEditForm(FlaskForm):
     )
 
 
-def choice_query():
-    return Neighborhood.query
-
-
 class FilterForm(FlaskForm):
-    """ Form to filter by Neighborhood"""
+    """ Form to search and filter by Neighborhood.
+        Submitted by GET, so no CSRF
+    """
 
-    opts = QuerySelectField(query_factory=choice_query,
-                            allow_blank=True, get_label='name')
+    class Meta:
+        csrf = False
+
+    q = StringField(
+        'Search',
+        validators=[Optional(), Length(max=200)]
+    )
+    hood = SelectMultipleField(
+        'Neighborhood',
+        choices=[]
+    )
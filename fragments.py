@@ -0,0 +1,83 @@
+"""Fragment cache for rendered template snippets (stop cards).
+
+Rendered card HTML is stored per stop along with the row version and like
+count it was rendered from, so a stale entry can never be served: an edit
+bumps Stop.version and the next lookup misses. Views that change or delete
+a stop also drop its entry right away.
+
+The backend only needs get/set/delete; the default keeps a bounded LRU in
+each worker process.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from flask import render_template
+from markupsafe import Markup
+
+
+class LRUCache:
+    """ Thread-safe in-process cache holding at most max_entries """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+fragment_cache = LRUCache(int(os.environ.get('FRAGMENT_CACHE_SIZE', 5000)))
+
+
+def stop_card(stop):
+    """ Return card HTML for stop, rendering only on a cache miss"""
+
+    key = ('stop-card', stop.id)
+    version = (stop.version, stop.like_count)
+
+    cached = fragment_cache.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    html = Markup(render_template('stop/_card.html', stop=stop, hit=None))
+    fragment_cache.set(key, (version, html))
+
+    return html
+
+
+def invalidate_stop_card(stop_id):
+    """ Drop the cached card for stop_id"""
+
+    fragment_cache.delete(('stop-card', stop_id))
@@ -0,0 +1,74 @@
+"""Geocoders for Rich City Stops.
+
+Stops are geocoded once per address by the map worker and the coordinates
+are stored on the stop. GEOCODER picks the implementation: 'mapquest'
+(default) calls the MapQuest geocoding API through the shared provider
+client; 'local' is an offline stand-in for development and tests.
+"""
+
+import hashlib
+import os
+
+from mapping import API_KEY, MAPQUEST_BASE_URL, MAP_CITY, normalize_address, \
+    provider
+
+GEOCODE_URL = f'{MAPQUEST_BASE_URL}/geocoding/v1/address'
+
+# roughly the city of Richmond, CA: (south, west, north, east)
+RICHMOND_BOUNDS = (37.90, -122.42, 37.99, -122.30)
+
+
+class MapQuestGeocoder:
+    """ Geocode through the MapQuest geocoding API """
+
+    def geocode(self, address):
+        """ Return (lat, lng) for address, or None if it can't be found"""
+
+        resp = provider.get(
+            GEOCODE_URL,
+            params={'key': API_KEY, 'location': f'{address},{MAP_CITY}'}
+        )
+        resp.raise_for_status()
+
+        results = resp.json().get('results') or [{}]
+        locations = results[0].get('locations') or []
+
+        if not locations:
+            return None
+
+        lat_lng = locations[0]['latLng']
+        return (lat_lng['lat'], lat_lng['lng'])
+
+
+class LocalGeocoder:
+    """ Offline stand-in: places each address at a stable point in
+        Richmond derived from its normalized text. Addresses listed in
+        `known` get exact coordinates instead
+    """
+
+    def __init__(self, known=None):
+        self.known = {
+            normalize_address(address): lat_lng
+            for address, lat_lng in (known or {}).items()
+        }
+
+    def geocode(self, address):
+        normalized = normalize_address(address)
+
+        if normalized in self.known:
+            return self.known[normalized]
+
+        digest = hashlib.sha256(normalized.encode('utf-8')).digest()
+        south, west, north, east = RICHMOND_BOUNDS
+
+        lat = south + (north - south) * int.from_bytes(digest[:4]) / 2**32
+        lng = west + (east - west) * int.from_bytes(digest[4:8]) / 2**32
+        return (round(lat, 6), round(lng, 6))
+
+
+GEOCODERS = {
+    'mapquest': MapQuestGeocoder,
+    'local': LocalGeocoder,
+}
+
+geocoder = GEOCODERS[os.environ.get('GEOCODER', 'mapquest')]()
@@ -0,0 +1,203 @@
+"""Pooled, resilient HTTP client for outside services (e.g. MapQuest).
+
+One HttpClient is shared per provider. It keeps a keep-alive connection
+pool, always sends a timeout, retries transient failures with jittered
+backoff, and trips a circuit breaker so a dead provider fails fast instead
+of tying up workers.
+"""
+
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# errors worth retrying; a truncated body is usually a dropped connection
+TRANSIENT_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class CircuitOpenError(Exception):
+    """ Raised without calling the provider while the breaker is open """
+
+
+class CircuitBreaker:
+    """ Open after failure_threshold consecutive failures; after
+        reset_timeout seconds let one trial call through (half-open)
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        """ May a call go through right now?"""
+
+        with self._lock:
+            state = self.state
+
+            if state == 'closed':
+                return True
+
+            if state == 'half-open' and not self._trial_running:
+                self._trial_running = True
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class HttpClient:
+    """ Shared session for one provider, with stats for monitoring """
+
+    def __init__(
+        self,
+        name,
+        pool_size=10,
+        connect_timeout=3.05,
+        read_timeout=10,
+        retries=2,
+        backoff_base=0.2,
+        backoff_max=2,
+        breaker=None,
+        adapter_class=HTTPAdapter
+    ):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        adapter = adapter_class(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock = threading.Lock()
+        self.counts = {
+            'requests': 0,
+            'retries': 0,
+            'errors': 0,
+            'rejected': 0,
+        }
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def _observe(self, elapsed, error=False):
+        with self._lock:
+            self.counts['requests'] += 1
+            self.latency_sum += elapsed
+
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    self.latency_buckets[i] += 1
+                    break
+            else:
+                self.latency_buckets[-1] += 1
+
+            if error:
+                self.counts['errors'] += 1
+
+    def _sleep_before_retry(self, attempt):
+        """ Full jitter: sleep somewhere in [0, base * 2**attempt]"""
+
+        cap = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        time.sleep(random.uniform(0, cap))
+
+    def get(self, url, **kwargs):
+        """ GET url, retrying transient failures. Return response with a
+            2xx/3xx/4xx status, or raise the last error
+        """
+
+        kwargs.setdefault('timeout', self.timeout)
+
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                with self._lock:
+                    self.counts['rejected'] += 1
+                raise CircuitOpenError(f'{self.name} circuit is open')
+
+            if attempt:
+                with self._lock:
+                    self.counts['retries'] += 1
+
+            start = time.perf_counter()
+
+            try:
+                resp = self.session.get(url, **kwargs)
+
+            except TRANSIENT_ERRORS:
+                self._observe(time.perf_counter() - start, error=True)
+                self.breaker.record_failure()
+
+                if attempt == self.retries:
+                    raise
+                self._sleep_before_retry(attempt)
+                continue
+
+            except Exception:
+                # not worth retrying, but still a failed call: count it, and
+                # free the breaker's trial slot if this was the trial
+                self._observe(time.perf_counter() - start, error=True)
+                self.breaker.record_failure()
+                raise
+
+            if resp.status_code in RETRY_STATUSES:
+                self._observe(time.perf_counter() - start, error=True)
+                self.breaker.record_failure()
+
+                if attempt == self.retries:
+                    resp.raise_for_status()
+                self._sleep_before_retry(attempt)
+                continue
+
+            self._observe(time.perf_counter() - start)
+            self.breaker.record_success()
+            return resp
+
+    def stats(self):
+        """ Snapshot of counters, latency histogram and breaker state"""
+
+        with self._lock:
+            return {
+                'name': self.name,
+                **self.counts,
+                'latency_sum': self.latency_sum,
+                'latency_buckets': dict(zip(
+                    [*LATENCY_BUCKETS, float('inf')], self.latency_buckets)),
+                'circuit': self.breaker.state,
+            }
@@ -0,0 +1,141 @@
+"""Session-backed identity for the logged-in user.
+
+The signed session cookie carries a snapshot of the few User fields almost
+every request needs (id, username, admin) plus the row's version. g.user is
+a CurrentUser built from that snapshot, so most requests never query the
+users table; any other attribute loads the real User row on first use.
+
+A snapshot is refreshed when the user's version changes in this process,
+and re-checked against the database at most every REVALIDATE_SECONDS so
+changes made by other workers are picked up too.
+"""
+
+import os
+import time
+
+from sqlalchemy.orm import Session, object_session
+
+from fragments import LRUCache
+from models import db, User
+
+IDENTITY_KEY = 'curr_user_identity'
+
+REVALIDATE_SECONDS = int(os.environ.get('IDENTITY_REVALIDATE_SECONDS', 60))
+
+# latest User.version this process committed or read, by user id; bounded,
+# since a user evicted from it is still revalidated after
+# REVALIDATE_SECONDS
+known_versions = LRUCache(
+    int(os.environ.get('IDENTITY_KNOWN_VERSIONS', 10000)))
+
+# session.info key: versions written in the current transaction
+PENDING_KEY = 'identity_versions'
+
+
+@db.event.listens_for(User, 'after_update')
+def record_version(mapper, connection, target):
+    """ Note a user's new version, to publish if the transaction commits"""
+
+    session = object_session(target)
+    session.info.setdefault(PENDING_KEY, {})[target.id] = target.version
+
+
+@db.event.listens_for(Session, 'after_commit')
+def publish_versions(session):
+    """ Committed: this process now drops snapshots older than these"""
+
+    for user_id, version in session.info.pop(PENDING_KEY, {}).items():
+        known_versions.set(user_id, version)
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def discard_versions(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+class CurrentUser:
+    """ Lightweight stand-in for the logged-in User """
+
+    def __init__(self, snapshot, user=None):
+        self.id = snapshot['id']
+        self.username = snapshot['username']
+        self.admin = snapshot['admin']
+        self.version = snapshot['version']
+        self._user = user
+
+    @property
+    def user(self):
+        """ The full User row, loaded on first access"""
+
+        if self._user is None:
+            self._user = db.session.get(User, self.id)
+
+        return self._user
+
+    def __getattr__(self, name):
+        # only reached for attributes not in the snapshot
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        return getattr(self.user, name)
+
+    def __eq__(self, other):
+        if isinstance(other, (CurrentUser, User)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f'<CurrentUser id={self.id} username="{self.username}">'
+
+
+def snapshot(user):
+    """ Return the session snapshot for user"""
+
+    return {
+        'id': user.id,
+        'username': user.username,
+        'admin': user.admin,
+        'version': user.version,
+        'checked_at': int(time.time()),
+    }
+
+
+def remember(session, user):
+    """ Store a fresh snapshot of user in the session"""
+
+    session[IDENTITY_KEY] = snapshot(user)
+
+
+def forget(session):
+    """ Remove the snapshot from the session"""
+
+    session.pop(IDENTITY_KEY, None)
+
+
+def load_identity(session, user_id):
+    """ Return CurrentUser for user_id, querying only when the snapshot is
+        missing, stale, or due for revalidation. None if user is gone
+    """
+
+    snap = session.get(IDENTITY_KEY)
+
+    if (
+        snap
+        and snap['id'] == user_id
+        and known_versions.get(user_id) in (None, snap['version'])
+        and time.time() - snap['checked_at'] < REVALIDATE_SECONDS
+    ):
+        return CurrentUser(snap)
+
+    user = db.session.get(User, user_id)
+
+    if user is None:
+        forget(session)
+        return None
+
+    known_versions.set(user_id, user.version)
+    remember(session, user)
+    return CurrentUser(session[IDENTITY_KEY], user=user)
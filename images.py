@@ -0,0 +1,314 @@
+"""Image proxy and thumbnail cache for external stop and profile images.
+
+Stop and user images live on arbitrary hosts, often at full camera size.
+Templates link them through thumbnail_url()/thumbnail_srcset(), which point
+at /images/<sig>/<width>/<encoded url>. The proxy fetches each original
+once, keeps it in an on-disk cache, and serves resized WebP thumbnails from
+a second cache; both evict least-recently-used files to stay under quota.
+
+URLs are HMAC-signed with the app's secret key so the endpoint can't be
+used as an open proxy, and hosts that resolve to private or loopback
+addresses are refused unless IMAGE_PROXY_ALLOW_PRIVATE is set. The check
+is repeated when connecting, and the socket goes to the very address that
+was checked, so a DNS answer that changes in between (DNS rebinding) can't
+reach internal hosts. Proxy settings from the environment are ignored for
+the same reason.
+"""
+
+import base64
+import hashlib
+import hmac
+import io
+import ipaddress
+import logging
+import os
+import socket
+from urllib.parse import urljoin, urlsplit
+
+from flask import current_app
+from PIL import Image, UnidentifiedImageError
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NameResolutionError, \
+    NewConnectionError
+from urllib3.util.connection import create_connection
+
+from disk_cache import DiskCache
+from http_client import HttpClient, CircuitBreaker
+
+logger = logging.getLogger(__name__)
+
+# widths offered in srcset; THUMB_WIDTH is the plain src
+IMAGE_WIDTHS = (160, 320, 640, 960)
+THUMB_WIDTH = 320
+
+THUMB_QUALITY = int(os.environ.get('IMAGE_THUMB_QUALITY', 80))
+
+MAX_IMAGE_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 15 * 1024 * 1024))
+MAX_IMAGE_PIXELS = 50_000_000
+MAX_REDIRECTS = 3
+
+ALLOW_PRIVATE = os.environ.get('IMAGE_PROXY_ALLOW_PRIVATE') == '1'
+
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', os.path.abspath(
+    os.path.join(os.path.dirname(__file__), 'static', 'images', 'cache')))
+
+originals = DiskCache(
+    os.path.join(IMAGE_CACHE_DIR, 'originals'),
+    int(os.environ.get('IMAGE_ORIGINALS_MAX_BYTES', 512 * 1024 * 1024)),
+)
+
+thumbnails = DiskCache(
+    os.path.join(IMAGE_CACHE_DIR, 'thumbs'),
+    int(os.environ.get('IMAGE_THUMBS_MAX_BYTES', 256 * 1024 * 1024)),
+    suffix='.webp'
+)
+
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+class ImageProxyError(Exception):
+    """ The remote image couldn't be fetched or decoded """
+
+
+class NonPublicAddressError(ImageProxyError):
+    """ The image host resolved to a private, loopback or reserved address """
+
+
+def public_addresses(host, port):
+    """ Resolve host once; return its addresses, or raise
+        NonPublicAddressError if any isn't public (unless ALLOW_PRIVATE)
+    """
+
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    addresses = list(dict.fromkeys(sockaddr[0] for *_, sockaddr in infos))
+
+    if not ALLOW_PRIVATE:
+        for address in addresses:
+            if not ipaddress.ip_address(address).is_global:
+                raise NonPublicAddressError(
+                    f'Refusing non-public host {host} ({address})')
+
+    return addresses
+
+
+class PublicConnectionMixin:
+    """ Connect only to addresses public_addresses() approved. TLS still
+        verifies the certificate against the hostname
+    """
+
+    def _new_conn(self):
+        try:
+            addresses = public_addresses(self._dns_host, self.port)
+        except socket.gaierror as exc:
+            raise NameResolutionError(self.host, self, exc) from exc
+
+        error = None
+
+        for address in addresses:
+            try:
+                return create_connection(
+                    (address, self.port),
+                    self.timeout,
+                    source_address=self.source_address,
+                    socket_options=self.socket_options,
+                )
+            except socket.timeout as exc:
+                raise ConnectTimeoutError(
+                    self, f'Connection to {self.host} timed out') from exc
+            except OSError as exc:
+                error = exc
+
+        raise NewConnectionError(
+            self, f'Failed to establish a new connection: {error}')
+
+
+class PublicHTTPConnection(PublicConnectionMixin, HTTPConnection):
+    pass
+
+
+class PublicHTTPSConnection(PublicConnectionMixin, HTTPSConnection):
+    pass
+
+
+class PublicHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = PublicHTTPConnection
+
+
+class PublicHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = PublicHTTPSConnection
+
+
+class PublicAddressAdapter(HTTPAdapter):
+    """ Transport adapter whose connections refuse non-public addresses """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': PublicHTTPConnectionPool,
+            'https': PublicHTTPSConnectionPool,
+        }
+
+
+fetcher = HttpClient(
+    'images',
+    pool_size=int(os.environ.get('IMAGE_POOL_SIZE', 10)),
+    connect_timeout=float(os.environ.get('IMAGE_CONNECT_TIMEOUT', 3.05)),
+    read_timeout=float(os.environ.get('IMAGE_READ_TIMEOUT', 10)),
+    retries=1,
+    # many unrelated hosts share this client, so only trip on a broad outage
+    breaker=CircuitBreaker(failure_threshold=20, reset_timeout=30),
+    adapter_class=PublicAddressAdapter
+)
+
+# a proxy would resolve hosts itself, past the address check
+fetcher.session.trust_env = False
+
+
+def is_external(url):
+    return bool(url) and urlsplit(url).scheme in ('http', 'https')
+
+
+def sign(url):
+    """ Signature for proxying url"""
+
+    key = current_app.secret_key.encode('utf-8')
+    digest = hmac.new(key, url.encode('utf-8'), hashlib.sha256).digest()
+
+    return base64.urlsafe_b64encode(digest[:12]).decode('ascii')
+
+
+def encode_url(url):
+    return base64.urlsafe_b64encode(url.encode('utf-8')).decode().rstrip('=')
+
+
+def decode_url(encoded):
+    """ Inverse of encode_url; raise ValueError if malformed"""
+
+    padded = encoded + '=' * (-len(encoded) % 4)
+    return base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+
+
+def verify(sig, url):
+    return hmac.compare_digest(sig, sign(url))
+
+
+def thumbnail_url(url, width=THUMB_WIDTH):
+    """ Proxied URL for url resized to width; local and empty URLs are
+        returned unchanged
+    """
+
+    if not is_external(url):
+        return url
+
+    return f'/images/{sign(url)}/{width}/{encode_url(url)}'
+
+
+def thumbnail_srcset(url):
+    """ srcset attribute value offering url at each of IMAGE_WIDTHS, or ''
+        for URLs that aren't proxied
+    """
+
+    if not is_external(url):
+        return ''
+
+    return ', '.join(f'{thumbnail_url(url, w)} {w}w' for w in IMAGE_WIDTHS)
+
+
+def cache_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def check_host(url):
+    """ Raise ImageProxyError unless url is http(s) on a public address.
+        A quick early refusal; the connection checks again (see
+        PublicConnectionMixin), since DNS may answer differently by then
+    """
+
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageProxyError(f'Not an http(s) URL: {url!r}')
+
+    try:
+        public_addresses(parts.hostname, parts.port or 80)
+    except socket.gaierror as exc:
+        raise ImageProxyError(f'Cannot resolve {parts.hostname}') from exc
+
+
+def fetch(url):
+    """ Return the bytes of the image at url, following a few redirects"""
+
+    for _ in range(MAX_REDIRECTS + 1):
+        check_host(url)
+
+        try:
+            resp = fetcher.get(url, stream=True, allow_redirects=False)
+        except Exception as exc:
+            raise ImageProxyError(f'Fetching {url!r} failed: {exc!r}') from exc
+
+        with resp:
+            if resp.is_redirect:
+                url = urljoin(url, resp.headers['Location'])
+                continue
+
+            if resp.status_code != 200:
+                raise ImageProxyError(f'{url!r} returned {resp.status_code}')
+
+            if not resp.headers.get('Content-Type', '').startswith('image/'):
+                raise ImageProxyError(f'{url!r} is not an image')
+
+            data = bytearray()
+            for chunk in resp.iter_content(1 << 16):
+                data += chunk
+                if len(data) > MAX_IMAGE_BYTES:
+                    raise ImageProxyError(f'{url!r} is too large')
+
+            return bytes(data)
+
+    raise ImageProxyError(f'Too many redirects for {url!r}')
+
+
+def resize(data, width):
+    """ Return WebP bytes of image data scaled down to width (never up)"""
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.thumbnail((width, width * 4))
+
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'A' in image.getbands()
+                                      or 'transparency' in image.info
+                                      else 'RGB')
+
+            out = io.BytesIO()
+            image.save(out, 'WEBP', quality=THUMB_QUALITY, method=4)
+
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) \
+            as exc:
+        raise ImageProxyError(f'Cannot decode image: {exc!r}') from exc
+
+    return out.getvalue()
+
+
+def get_thumbnail(url, width):
+    """ Return path of url's thumbnail at width, fetching the original and
+        resizing only on a cache miss. Raise ImageProxyError on failure
+    """
+
+    key = cache_key(url)
+    thumb_key = f'{key}-{width}'
+
+    path = thumbnails.get(thumb_key)
+    if path:
+        return path
+
+    original = originals.get(key)
+    if original:
+        with open(original, 'rb') as f:
+            data = f.read()
+    else:
+        data = fetch(url)
+        originals.put(key, data)
+
+    return thumbnails.put(thumb_key, resize(data, width))
@@ -0,0 +1,389 @@
+"""Bulk import of neighborhoods, stops and likes for Rich City Stops.
+
+Records are streamed from CSV (with a header row) or NDJSON, validated,
+and written in batches with one INSERT ... ON CONFLICT per batch (stops
+are COPYed into a temp table first), each batch in its own transaction.
+Bad rows are reported and skipped; they never abort the import.
+
+Stops are validated with the same rules as StopAddEditForm and keyed by
+name: re-importing a file updates changed stops in place and leaves
+unchanged ones alone. New stops and stops whose address changed get a
+map render queued.
+"""
+
+import csv
+import io
+import json
+from collections import namedtuple
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from werkzeug.datastructures import MultiDict
+
+from forms import StopAddEditForm
+from models import db, Neighborhood, Stop, User, Like, Job, DEFAULT_STOP_URL
+from refdata import neighborhoods
+
+BATCH_SIZE = 1000
+
+STOP_FIELDS = ('name', 'description', 'url', 'address', 'hood_code',
+               'image_url')
+
+# temp table stop batches are COPYed into (see copy_to_staging)
+STAGING = db.table('stop_import', *[db.column(f) for f in STOP_FIELDS])
+
+# xmax is 0 only for a row version created by INSERT, not by the
+# ON CONFLICT ... DO UPDATE branch
+INSERTED = db.literal_column('xmax = 0').label('inserted')
+
+# line is the 1-based line number in the source file
+BadRow = namedtuple('BadRow', ['line', 'errors'])
+
+
+class ImportResult:
+    """ Counts and rejected rows from one import """
+
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.maps_queued = 0
+        self.bad_rows = []
+
+    def reject(self, line, errors):
+        self.bad_rows.append(BadRow(line, errors))
+
+    def count(self, stored, written):
+        """ Tally a batch: stored rows got past the database, and written
+            is [(key, inserted)] for those that were inserted or changed
+        """
+
+        inserted = sum(1 for _, is_new in written if is_new)
+        self.inserted += inserted
+        self.updated += len(written) - inserted
+        self.unchanged += stored - len(written)
+
+
+def read_records(file, fmt):
+    """ Yield (line, dict) for each record in an open text file, or
+        (line, None) for a record that can't be parsed
+    """
+
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        for record in reader:
+            yield reader.line_num, record
+
+    elif fmt == 'ndjson':
+        for line, text in enumerate(file, start=1):
+            if not text.strip():
+                continue
+
+            try:
+                record = json.loads(text)
+            except ValueError:
+                record = None
+
+            yield line, record if isinstance(record, dict) else None
+
+    else:
+        raise ValueError(f'Unknown format {fmt!r}')
+
+
+def batches(records, size):
+    """ Group an iterable into lists of at most size items"""
+
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def clean(record, fields):
+    """ Return record's fields as stripped strings ('' if missing)"""
+
+    return {
+        f: '' if record.get(f) is None else str(record[f]).strip()
+        for f in fields
+    }
+
+
+def write_batch(rows, write, result):
+    """ Write [(line, row)] with write(rows) in one savepoint. If the
+        database rejects the batch, retry row by row to find the bad ones.
+        Return (number of rows stored, what write returned for them)
+    """
+
+    try:
+        with db.session.begin_nested():
+            return len(rows), write([row for _, row in rows])
+
+    except IntegrityError:
+        pass
+
+    stored = 0
+    written = []
+
+    for line, row in rows:
+        try:
+            with db.session.begin_nested():
+                written.extend(write([row]))
+            stored += 1
+
+        except IntegrityError as exc:
+            result.reject(line, {'row': [str(exc.orig).splitlines()[0]]})
+
+    return stored, written
+
+
+#######################################
+# neighborhoods
+
+
+def upsert_neighborhoods(rows):
+    """ Insert or rename neighborhoods by code. Returns (code, inserted)
+        for each row that was written
+    """
+
+    stmt = insert(Neighborhood)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Neighborhood.code],
+        set_={'name': stmt.excluded.name},
+        where=Neighborhood.name.is_distinct_from(stmt.excluded.name),
+    ).returning(Neighborhood.code, INSERTED)
+
+    return db.session.execute(stmt, rows).all()
+
+
+def import_neighborhoods(records, batch_size=BATCH_SIZE):
+    """ Upsert neighborhoods (code, name) by code"""
+
+    result = ImportResult()
+
+    for batch in batches(records, batch_size):
+        rows = {}
+
+        for line, record in batch:
+            row = clean(record or {}, ('code', 'name'))
+            errors = {f: ['This field is required.']
+                      for f, v in row.items() if not v}
+
+            if record is None:
+                result.reject(line, {'row': ['Not a valid record.']})
+            elif errors:
+                result.reject(line, errors)
+            else:
+                rows[row['code']] = (line, row)
+
+        if rows:
+            result.count(*write_batch(
+                list(rows.values()), upsert_neighborhoods, result))
+
+        db.session.commit()
+
+    return result
+
+
+#######################################
+# stops
+
+
+def copy_to_staging(rows):
+    """ COPY rows into the stop_import temp table (emptied first)"""
+
+    cursor = db.session.connection().connection.cursor()
+
+    cursor.execute(
+        'CREATE TEMP TABLE IF NOT EXISTS stop_import '
+        f'({", ".join(f + " text" for f in STOP_FIELDS)}) ON COMMIT DROP')
+    cursor.execute('TRUNCATE stop_import')
+
+    data = io.StringIO()
+    # quote everything so empty strings don't load as NULL
+    csv.writer(data, quoting=csv.QUOTE_ALL).writerows(
+        [row[f] for f in STOP_FIELDS] for row in rows)
+    data.seek(0)
+
+    cursor.copy_expert('COPY stop_import FROM STDIN (FORMAT csv)', data)
+
+
+def upsert_stops(rows):
+    """ Insert or update stops by name. Returns (id, name, inserted) for
+        each row that was written; rows identical to the stored stop are not
+    """
+
+    copy_to_staging(rows)
+
+    stmt = insert(Stop).from_select(
+        [*STOP_FIELDS, 'map_status', 'version'],
+        db.select(*STAGING.c, db.literal('pending'), db.literal(1))
+    )
+    excluded = stmt.excluded
+    changed = db.tuple_(*[getattr(Stop, f) for f in STOP_FIELDS]) \
+        .is_distinct_from(db.tuple_(*[getattr(excluded, f)
+                                      for f in STOP_FIELDS]))
+
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Stop.name],
+        set_={
+            **{f: getattr(excluded, f) for f in STOP_FIELDS if f != 'name'},
+            # bulk writes skip the ORM hook, so bump it here
+            'version': Stop.version + 1,
+        },
+        where=changed,
+    ).returning(Stop.id, Stop.name, INSERTED)
+
+    return db.session.execute(stmt).all()
+
+
+def import_stops(records, batch_size=BATCH_SIZE):
+    """ Upsert stops by name, queueing map renders for new stops and
+        changed addresses
+    """
+
+    result = ImportResult()
+
+    form = StopAddEditForm(formdata=None, meta={'csrf': False})
+    form.hood_code.choices = neighborhoods.choices()
+
+    for batch in batches(records, batch_size):
+        rows = {}
+
+        for line, record in batch:
+            if record is None:
+                result.reject(line, {'row': ['Not a valid record.']})
+                continue
+
+            row = clean(record, STOP_FIELDS)
+            form.process(MultiDict(row))
+
+            if not form.validate():
+                result.reject(line, form.errors)
+                continue
+
+            row['image_url'] = row['image_url'] or DEFAULT_STOP_URL
+            # later rows for the same stop win
+            rows[row['name']] = (line, row)
+
+        if not rows:
+            continue
+
+        old_addresses = dict(db.session.execute(
+            db.select(Stop.name, Stop.address)
+            .where(Stop.name.in_(list(rows)))
+        ).all())
+
+        stored, written = write_batch(
+            list(rows.values()), upsert_stops, result)
+
+        need_maps = []
+        moved = []
+
+        for id, name, is_new in written:
+            if old_addresses.get(name) != rows[name][1]['address']:
+                need_maps.append(id)
+                if not is_new:
+                    moved.append(id)
+
+        # new stops already start out pending
+        if moved:
+            db.session.execute(
+                db.update(Stop)
+                .where(Stop.id.in_(moved))
+                .values(map_status='pending')
+                .execution_options(synchronize_session=False)
+            )
+
+        if need_maps:
+            Job.enqueue_many(
+                'render_map', [{'stop_id': id} for id in need_maps])
+
+        result.count(stored, [(id, is_new) for id, _, is_new in written])
+        result.maps_queued += len(need_maps)
+
+        db.session.commit()
+
+    return result
+
+
+#######################################
+# likes
+
+
+def insert_likes(rows):
+    stmt = insert(Like).on_conflict_do_nothing().returning(Like.user_id)
+
+    return db.session.execute(stmt, rows).scalars().all()
+
+
+def import_likes(records, batch_size=BATCH_SIZE):
+    """ Add likes (username, stop name); existing likes are left alone.
+        Like counts and likes versions are updated once at the end
+    """
+
+    result = ImportResult()
+    liking_users = set()
+
+    for batch in batches(records, batch_size):
+        cleaned = [(line, record, clean(record or {}, ('username', 'stop')))
+                   for line, record in batch]
+
+        user_ids = dict(db.session.execute(
+            db.select(User.username, User.id)
+            .where(User.username.in_({r['username'] for _, _, r in cleaned}))
+        ).all())
+        stop_ids = dict(db.session.execute(
+            db.select(Stop.name, Stop.id)
+            .where(Stop.name.in_({r['stop'] for _, _, r in cleaned}))
+        ).all())
+
+        rows = {}
+
+        for line, record, row in cleaned:
+            errors = {}
+            if record is None:
+                errors['row'] = ['Not a valid record.']
+            elif row['username'] not in user_ids:
+                errors['username'] = ['No such user.']
+            elif row['stop'] not in stop_ids:
+                errors['stop'] = ['No such stop.']
+
+            if errors:
+                result.reject(line, errors)
+                continue
+
+            key = (user_ids[row['username']], stop_ids[row['stop']])
+            rows[key] = (line, {'user_id': key[0], 'stop_id': key[1]})
+
+        if rows:
+            stored, added = write_batch(
+                list(rows.values()), insert_likes, result)
+            liking_users.update(added)
+            result.inserted += len(added)
+            result.unchanged += stored - len(added)
+
+        db.session.commit()
+
+    if result.inserted:
+        Stop.reconcile_like_counts()
+        db.session.execute(
+            db.update(User)
+            .where(User.id.in_(liking_users))
+            .values(likes_version=User.likes_version + 1)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+    return result
+
+
+IMPORTERS = {
+    'neighborhoods': import_neighborhoods,
+    'stops': import_stops,
+    'likes': import_likes,
+}
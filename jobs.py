@@ -0,0 +1,194 @@
+"""Background job worker for Rich City Stops.
+
+Jobs live in the Postgres `jobs` table (see models.Job). Web requests only
+insert rows; `flask jobs work` claims them with SELECT ... FOR UPDATE SKIP
+LOCKED, so any number of workers can run side by side.
+"""
+
+import logging
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from mapping import map_key
+from models import db, Job, Stop
+
+logger = logging.getLogger(__name__)
+
+BACKOFF_BASE = 5
+BACKOFF_MAX = 15 * 60
+LEASE_SECONDS = 10 * 60
+
+
+class JobError(Exception):
+    """ Raised by a handler when a job should be retried """
+
+
+def render_map(payload):
+    """ Fetch the static map for a stop and record the outcome on the stop"""
+
+    stop = db.session.get(Stop, payload['stop_id'])
+
+    if stop is None:
+        # stop was deleted after the job was queued; nothing to do
+        return
+
+    try:
+        stop.geocode()
+    except Exception as exc:
+        # a map can still be drawn from the address; retry geocoding later
+        logger.warning('Geocoding stop %s failed: %r', stop.id, exc)
+
+    if stop.save_map() is None:
+        raise JobError(f'map render failed for stop {stop.id}')
+
+    stop.map_key = map_key(stop.address)
+    stop.map_status = 'ready'
+
+
+def reconcile_like_counts(payload):
+    """ Repair any drift between Stop.like_count and the likes table"""
+
+    fixed = Stop.reconcile_like_counts()
+
+    if fixed:
+        logger.warning('Reconciled like_count on %s stops', fixed)
+
+
+HANDLERS = {
+    'render_map': render_map,
+    'reconcile_like_counts': reconcile_like_counts,
+}
+
+# kind -> seconds between runs; the worker keeps one of each queued
+PERIODIC = {
+    'reconcile_like_counts':
+        int(os.environ.get('LIKE_RECONCILE_INTERVAL', 60 * 60)),
+}
+
+
+def backoff(attempts):
+    """ Seconds to wait before the next attempt: exponential, with jitter"""
+
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def claim_next():
+    """ Claim the next runnable job, or return None if the queue is empty.
+
+        Jobs left 'running' past the lease by a crashed worker are reclaimed.
+    """
+
+    now = datetime.now(timezone.utc)
+
+    job = (
+        Job.query
+        .filter(
+            db.or_(
+                db.and_(Job.status == 'queued', Job.run_at <= now),
+                db.and_(Job.status == 'running',
+                        Job.locked_at < now - timedelta(seconds=LEASE_SECONDS))
+            )
+        )
+        .order_by(Job.run_at)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+
+    if job is None:
+        db.session.rollback()
+        return None
+
+    job.status = 'running'
+    job.locked_at = now
+    job.attempts += 1
+    db.session.commit()
+
+    return job
+
+
+def _fail(job, exc):
+    """ Record a failed attempt and schedule a retry or give up"""
+
+    job.last_error = repr(exc)
+    job.locked_at = None
+
+    if job.attempts >= job.max_attempts:
+        job.status = 'failed'
+
+        if job.kind == 'render_map':
+            stop = db.session.get(Stop, job.payload['stop_id'])
+            if stop is not None:
+                stop.map_status = 'failed'
+    else:
+        job.status = 'queued'
+        job.run_at = (datetime.now(timezone.utc)
+                      + timedelta(seconds=backoff(job.attempts)))
+
+
+def schedule_periodic(kind, delay=0):
+    """ Queue a periodic job unless one is already waiting"""
+
+    waiting = Job.query.filter(
+        Job.kind == kind, Job.status.in_(['queued', 'running'])).first()
+
+    if waiting is None:
+        Job.enqueue(kind, {}, delay=delay)
+
+
+def run_job(job):
+    """ Run a claimed job and commit its result"""
+
+    handler = HANDLERS.get(job.kind)
+
+    try:
+        if handler is None:
+            raise JobError(f'no handler for job kind "{job.kind}"')
+
+        handler(job.payload)
+
+    except Exception as exc:
+        logger.warning('Job %s (%s) attempt %s failed: %r',
+                       job.id, job.kind, job.attempts, exc)
+        db.session.rollback()
+        _fail(job, exc)
+
+    else:
+        job.status = 'done'
+        job.locked_at = None
+        job.last_error = None
+
+    if job.kind in PERIODIC and job.status != 'queued':
+        schedule_periodic(job.kind, delay=PERIODIC[job.kind])
+
+    db.session.commit()
+    return job
+
+
+def work(burst=False, poll_interval=1.0):
+    """ Process jobs until interrupted.
+        With burst=True, return once the queue is drained; periodic jobs
+        are only kicked off by long-running workers
+        Return number of jobs run
+    """
+
+    count = 0
+
+    if not burst:
+        for kind in PERIODIC:
+            schedule_periodic(kind)
+        db.session.commit()
+
+    while True:
+        job = claim_next()
+
+        if job is None:
+            if burst:
+                return count
+            time.sleep(poll_interval)
+            continue
+
+        run_job(job)
+        count += 1
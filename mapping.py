@@ -1,47 +1,232 @@
+import hashlib
+import io
+import logging
 import os
-import requests
+import re
+import shutil
+import uuid
 from dotenv import load_dotenv
+from PIL import Image, UnidentifiedImageError
+
+from assets import assets
+from disk_cache import DiskCache
+from http_client import HttpClient, CircuitBreaker
 env = load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 API_KEY = os.environ['MAPQUEST_API_KEY']
 
+# point at a stand-in (e.g. bench/stub_provider.py) for load tests
+MAPQUEST_BASE_URL = os.environ.get(
+    'MAPQUEST_BASE_URL', 'https://www.mapquestapi.com')
+
+MAP_CITY = 'Richmond,CA'
+MAP_SIZE = '600,400@2x'
+
+# one master render at MAP_SIZE (1200px wide); pages get these derived
+# widths, as WebP with an optimized PNG fallback
+MAP_WIDTHS = (300, 600, 1200)
+MAP_FORMATS = ('webp', 'png')
+MAP_WEBP_QUALITY = int(os.environ.get('MAP_WEBP_QUALITY', 85))
+
+MAPS_DIR = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), 'static', 'maps'))
+
+map_cache = DiskCache(
+    os.environ.get('MAP_CACHE_DIR', os.path.join(MAPS_DIR, 'cache')),
+    int(os.environ.get('MAP_CACHE_MAX_BYTES', 256 * 1024 * 1024)),
+    suffix='.png'
+)
+
+# derived sizes/formats of cached masters, keyed by master key
+variant_cache = DiskCache(
+    os.path.join(map_cache.directory, 'variants'),
+    int(os.environ.get('MAP_VARIANT_CACHE_MAX_BYTES', 256 * 1024 * 1024)),
+)
+
+provider = HttpClient(
+    'mapquest',
+    pool_size=int(os.environ.get('MAP_POOL_SIZE', 10)),
+    connect_timeout=float(os.environ.get('MAP_CONNECT_TIMEOUT', 3.05)),
+    read_timeout=float(os.environ.get('MAP_READ_TIMEOUT', 10)),
+    retries=int(os.environ.get('MAP_RETRIES', 2)),
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.environ.get('MAP_BREAKER_THRESHOLD', 5)),
+        reset_timeout=float(os.environ.get('MAP_BREAKER_RESET', 30))
+    )
+)
+
+STREET_ABBREVIATIONS = {
+    'avenue': 'ave',
+    'boulevard': 'blvd',
+    'drive': 'dr',
+    'parkway': 'pkwy',
+    'road': 'rd',
+    'street': 'st',
+}
+
+
+def normalize_address(address):
+    """Normalize address so trivially different spellings share a map."""
+
+    words = re.sub(r'[.,]', ' ', address.lower()).split()
+
+    return ' '.join(STREET_ABBREVIATIONS.get(w, w) for w in words)
+
+
+def map_key(address, size=MAP_SIZE, city=MAP_CITY):
+    """Return cache key for the static map of address at these settings."""
+
+    parts = f'{normalize_address(address)}|{normalize_address(city)}|{size}'
+
+    return hashlib.sha256(parts.encode('utf-8')).hexdigest()
+
+
+def get_map_url(address, lat_lng=None):
+    """Get MapQuest URL for a static map for this location.
+
+    Uses stored coordinates when we have them, so MapQuest does not have to
+    geocode the address again on every render.
+    """
+
+    base = f"{MAPQUEST_BASE_URL}/staticmap/v5/map?key={API_KEY}"
+
+    if lat_lng:
+        where = f"{lat_lng[0]},{lat_lng[1]}"
+    else:
+        where = f"{address},{MAP_CITY}"
+
+    return f"{base}&center={where}&size={MAP_SIZE}&locations={where}"
+
+
+def _link(src, dest):
+    """Point dest at src's bytes, sharing storage where the OS allows."""
+
+    tmp = f'{dest}.{uuid.uuid4().hex}.tmp'
+
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+
+    os.replace(tmp, dest)
+
+
+def map_name(id, width, fmt):
+    """File name of a stop's map variant, relative to static/maps."""
+
+    return f'map_{id}-{width}.{fmt}'
+
+
+def map_paths(id):
+    """Return {(width, fmt): path} of every map variant for a stop."""
+
+    return {
+        (width, fmt): os.path.join(MAPS_DIR, map_name(id, width, fmt))
+        for width in MAP_WIDTHS
+        for fmt in MAP_FORMATS
+    }
+
 
-def get_map_url(address):
-    """Get MapQuest URL for a static map for this location."""
+def map_srcset(id, fmt):
+    """srcset value listing a stop's map variants in fmt."""
+
+    return ', '.join(
+        f"{assets.url('maps/' + map_name(id, width, fmt))} {width}w"
+        for width in MAP_WIDTHS
+    )
+
+
+def encode_variant(image, width, fmt):
+    """Return bytes of image scaled to width and encoded as fmt."""
+
+    if image.width > width:
+        height = round(image.height * width / image.width)
+        image = image.resize((width, height), Image.LANCZOS)
+
+    out = io.BytesIO()
+
+    if fmt == 'webp':
+        image.save(out, 'WEBP', quality=MAP_WEBP_QUALITY, method=6)
+    else:
+        image.save(out, 'PNG', optimize=True)
 
-    base = f"https://www.mapquestapi.com/staticmap/v5/map?key={API_KEY}"
-    where = f"{address},Richmond,CA"
+    return out.getvalue()
 
-    return f"{base}&center={where}&size=600,400@2x&locations={where}"
 
+def open_master(master):
+    """Decode the master render at path master. A file that won't decode
+    is dropped from the cache so the next render fetches it again.
+    """
 
-def save_map(id, address):
-    """Get static map and save in static/maps directory of this app."""
     try:
-        map_img = get_map(address)
+        with Image.open(master) as opened:
+            return opened.convert('RGB')
+
+    except (UnidentifiedImageError, OSError):
+        os.remove(master)
+        raise
+
+
+def derive_variants(master, key):
+    """Return {(width, fmt): cached path} of variants of the master render
+    at path master, decoding it only if some variant isn't cached yet.
+    """
+
+    paths = {}
+    image = None
+
+    for width in MAP_WIDTHS:
+        for fmt in MAP_FORMATS:
+            variant_key = f'{key}-{width}.{fmt}'
+            path = variant_cache.get(variant_key)
+
+            if path is None:
+                if image is None:
+                    image = open_master(master)
+
+                path = variant_cache.put(
+                    variant_key, encode_variant(image, width, fmt))
+
+            paths[width, fmt] = path
+
+    return paths
+
+
+def save_map(id, address, lat_lng=None):
+    """Get static map and save its variants in static/maps directory of
+    this app. Returns path of the largest PNG variant.
+
+    Maps are fetched through the content-addressed cache, so stops that
+    share an address (or re-save an unchanged one) cost no API call; other
+    sizes and formats are derived from that one master render.
+    """
+    try:
+        key = map_key(address)
+        master = map_cache.get(key)
+
+        if master is None:
+            master = map_cache.put(key, get_map(address, lat_lng))
 
-        path = os.path.abspath(
-            os.path.join(os.path.dirname(__file__),
-                         'static',
-                         'maps',
-                         f'map_{id}.png'
-                         ))
+        variants = derive_variants(master, key)
+        dests = map_paths(id)
 
-        with open(path, 'wb') as file:
-            file.write(map_img)
+        for variant, path in variants.items():
+            _link(path, dests[variant])
 
-        return path
+        return dests[MAP_WIDTHS[-1], 'png']
 
-    except Exception:
-        print(f"Error saving map: {Exception}")
+    except Exception as exc:
+        logger.warning("Error saving map for stop %s: %r", id, exc)
         return None
 
 
-def get_map(address):
+def get_map(address, lat_lng=None):
     """ Makes request to API to get the map img. Returns img or error"""
 
-    map_url = get_map_url(address)
-    resp = requests.get(map_url)
+    map_url = get_map_url(address, lat_lng)
+    resp = provider.get(map_url)
 
     if resp.status_code == 200:
         map_img = resp.content
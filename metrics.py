@@ -0,0 +1,424 @@
+"""Prometheus metrics for Rich City Stops.
+
+Tracks request counts and latency per endpoint, SQL statements and SQL
+time per request (from engine events), time spent in hooks marked with
+@timed (e.g. add_user_to_g), the outside HTTP clients (map provider, image
+proxy), the database connection pools and the fragment cache. /metrics
+serves them all in the Prometheus text format.
+
+Metrics are kept in memory per worker process, so scrape every process
+(or run one worker per scrape target). Counters start from zero when a
+worker restarts, which rate() and histogram_quantile() handle.
+
+/metrics answers requests carrying METRICS_TOKEN as a bearer token, or,
+without a token, direct (not proxied) requests from localhost; everyone
+else gets a 404.
+"""
+
+import hmac
+import ipaddress
+import os
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from flask import request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import images
+import mapping
+from fragments import fragment_cache
+from models import db
+from query_guard import query_count
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+STATEMENT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+HTTP_CLIENTS = (mapping.provider, images.fetcher)
+
+# per-request state lives in the WSGI environ, like query_guard's count
+START_KEY = 'metrics.start'
+STATUS_KEY = 'metrics.status'
+SQL_SECONDS_KEY = 'metrics.sql_seconds'
+
+
+#######################################
+# text format
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+
+    pairs = ','.join(f'{name}="{escape(value)}"'
+                     for name, value in zip(names, values))
+    return f'{{{pairs}}}'
+
+
+def header(name, kind, help):
+    return [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+
+
+def sample_lines(name, label_names, samples):
+    """ Lines for [(label values, value)]"""
+
+    return [f'{name}{format_labels(label_names, values)} {format_value(v)}'
+            for values, v in samples]
+
+
+def histogram_lines(name, label_names, label_values, bounds, counts, total):
+    """ Lines for one histogram series. counts holds one (non-cumulative)
+        count per bound, plus one for values above the last
+    """
+
+    lines = []
+    seen = 0
+
+    for bound, count in zip([*bounds, float('inf')], counts):
+        seen += count
+        labels = format_labels(
+            [*label_names, 'le'], [*label_values, format_value(bound)])
+        lines.append(f'{name}_bucket{labels} {seen}')
+
+    labels = format_labels(label_names, label_values)
+    lines.append(f'{name}_sum{labels} {format_value(float(total))}')
+    lines.append(f'{name}_count{labels} {seen}')
+
+    return lines
+
+
+#######################################
+# metric types
+
+
+class Counter:
+    """ Monotonic count per combination of label values """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = \
+                self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def collect(self):
+        with self._lock:
+            samples = sorted(self._values.items())
+
+        if not samples and not self.labels:
+            samples = [((), 0)]
+
+        return [*header(self.name, self.kind, self.help),
+                *sample_lines(self.name, self.labels, samples)]
+
+
+class Histogram:
+    """ Distribution of observed values per combination of label values """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [counts per bucket, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0]
+                self._series[label_values] = series
+
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def collect(self):
+        with self._lock:
+            series = sorted(
+                (values, (list(counts), total))
+                for values, (counts, total) in self._series.items())
+
+        lines = header(self.name, self.kind, self.help)
+        for values, (counts, total) in series:
+            lines.extend(histogram_lines(
+                self.name, self.labels, values, self.buckets, counts, total))
+
+        return lines
+
+
+class Registry:
+    """ Metrics owned by this module plus collectors that read other
+        components' stats at scrape time
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """ Register fn, which returns exposition lines (decorator)"""
+
+        self.collectors.append(fn)
+        return fn
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect())
+        for collect in self.collectors:
+            lines.extend(collect())
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUESTS = registry.counter(
+    'http_requests_total', 'HTTP requests handled.',
+    ('endpoint', 'method', 'status'))
+
+REQUEST_SECONDS = registry.histogram(
+    'http_request_duration_seconds', 'Time to handle an HTTP request.',
+    ('endpoint', 'method'))
+
+REQUEST_STATEMENTS = registry.histogram(
+    'http_request_sql_statements', 'SQL statements run per HTTP request.',
+    ('endpoint',), buckets=STATEMENT_BUCKETS)
+
+REQUEST_SQL_SECONDS = registry.histogram(
+    'http_request_sql_seconds', 'Time spent in SQL per HTTP request.',
+    ('endpoint',))
+
+STATEMENTS = registry.counter(
+    'db_statements_total',
+    'SQL statements run, including by CLI commands and jobs.')
+
+STATEMENT_SECONDS = registry.counter(
+    'db_statement_seconds_total', 'Time spent running SQL statements.')
+
+FUNCTION_SECONDS = registry.histogram(
+    'function_duration_seconds', 'Time spent in @timed functions.',
+    ('function',))
+
+
+#######################################
+# collectors
+
+
+@registry.collector
+def http_client_lines():
+    stats = [client.stats() for client in HTTP_CLIENTS]
+    labels = ('client',)
+    lines = []
+
+    for key, help in (
+        ('requests', 'Calls made to the service, retries included.'),
+        ('retries', 'Calls that were retries.'),
+        ('errors', 'Calls that failed or returned a retryable status.'),
+        ('rejected', 'Calls refused by an open circuit breaker.'),
+    ):
+        name = f'http_client_{key}_total'
+        lines.extend(header(name, 'counter', help))
+        lines.extend(sample_lines(
+            name, labels, [((s['name'],), s[key]) for s in stats]))
+
+    name = 'http_client_request_duration_seconds'
+    lines.extend(header(name, 'histogram', 'Latency of calls to the service.'))
+    for s in stats:
+        buckets = s['latency_buckets']
+        lines.extend(histogram_lines(
+            name, labels, (s['name'],), list(buckets)[:-1],
+            list(buckets.values()), s['latency_sum']))
+
+    name = 'http_client_circuit_open'
+    lines.extend(header(
+        name, 'gauge', '1 while the circuit breaker is open or half-open.'))
+    lines.extend(sample_lines(
+        name, labels,
+        [((s['name'],), int(s['circuit'] != 'closed')) for s in stats]))
+
+    return lines
+
+
+@registry.collector
+def pool_lines():
+    pools = [(bind or 'default', engine.pool)
+             for bind, engine in db.engines.items()
+             if hasattr(engine.pool, 'checkedout')]
+    labels = ('bind',)
+    lines = []
+
+    for key, help, read in (
+        ('size', 'Connections the pool keeps open.',
+         lambda pool: pool.size()),
+        ('checkedout', 'Connections in use.',
+         lambda pool: pool.checkedout()),
+        ('checkedin', 'Idle connections in the pool.',
+         lambda pool: pool.checkedin()),
+        # QueuePool counts overflow from -size up
+        ('overflow', 'Connections opened beyond the pool size.',
+         lambda pool: max(pool.overflow(), 0)),
+    ):
+        name = f'db_pool_{key}'
+        lines.extend(header(name, 'gauge', help))
+        lines.extend(sample_lines(
+            name, labels, [((bind,), read(pool)) for bind, pool in pools]))
+
+    return lines
+
+
+@registry.collector
+def fragment_cache_lines():
+    lines = []
+
+    for key, help in (('hits', 'Stop card cache hits.'),
+                      ('misses', 'Stop card cache misses.')):
+        name = f'fragment_cache_{key}_total'
+        lines.extend(header(name, 'counter', help))
+        lines.extend(sample_lines(
+            name, (), [((), getattr(fragment_cache, key))]))
+
+    name = 'fragment_cache_entries'
+    lines.extend(header(name, 'gauge', 'Stop cards in the cache.'))
+    lines.extend(sample_lines(name, (), [((), len(fragment_cache))]))
+
+    return lines
+
+
+#######################################
+# instrumentation
+
+
+def timed(fn):
+    """ Record fn's run time in function_duration_seconds"""
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            FUNCTION_SECONDS.observe(time.perf_counter() - start, fn.__name__)
+
+    return wrapper
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    context.metrics_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'metrics_start', None)
+    if start is None:
+        return
+
+    elapsed = time.perf_counter() - start
+
+    STATEMENTS.inc()
+    STATEMENT_SECONDS.inc(amount=elapsed)
+
+    if has_request_context():
+        environ = request.environ
+        environ[SQL_SECONDS_KEY] = environ.get(SQL_SECONDS_KEY, 0) + elapsed
+
+
+def start_request():
+    request.environ[START_KEY] = time.perf_counter()
+
+
+def record_status(response):
+    request.environ[STATUS_KEY] = response.status_code
+    return response
+
+
+def finish_request(exc):
+    environ = request.environ
+    # popped, so a context torn down twice (as in tests) counts once
+    start = environ.pop(START_KEY, None)
+    if start is None:
+        return
+
+    endpoint = request.endpoint or 'unmatched'
+    status = 500 if exc else environ.get(STATUS_KEY, 500)
+
+    REQUESTS.inc(endpoint, request.method, str(status))
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - start, endpoint, request.method)
+    REQUEST_STATEMENTS.observe(query_count(), endpoint)
+    REQUEST_SQL_SECONDS.observe(environ.get(SQL_SECONDS_KEY, 0), endpoint)
+
+
+def init_app(app):
+    """ Time every request. Call before registering other before_request
+        hooks, so their time is counted too
+    """
+
+    app.before_request(start_request)
+    app.after_request(record_status)
+    app.teardown_request(finish_request)
+
+
+def scrape_allowed():
+    """ May the current request read /metrics?"""
+
+    if METRICS_TOKEN:
+        return hmac.compare_digest(
+            request.headers.get('Authorization', ''),
+            f'Bearer {METRICS_TOKEN}')
+
+    # behind a reverse proxy every request looks local; trust only
+    # requests that weren't forwarded
+    if 'X-Forwarded-For' in request.headers:
+        return False
+
+    try:
+        return ipaddress.ip_address(request.remote_addr).is_loopback
+    except ValueError:
+        return False
@@ -1,14 +1,17 @@
 """Data models for Rich City Stops"""
 
+from datetime import datetime, timedelta, timezone
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert, TSVECTOR
 DEFAULT_IMG_URL = 'https://i.etsystatic.com/16944493/r/il/4f0938/3037341557/il_1588xN.3037341557_8qcl.jpg'
 DEFAULT_STOP_URL = 'https://www.nps.gov/subjects/urban/images/richmond.PNG'
-from mapping import save_map
+from mapping import save_map, map_key as address_map_key, normalize_address
+from geocoding import geocoder
+from passwords import hash_password, check_password, needs_rehash
+from replicas import RoutingSession
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 
 class Like(db.Model):
@@ -28,6 +31,71 @@ class Like(db.Model):
         primary_key=True
     )
 
+    # the primary key (user_id, stop_id) serves per-user lookups;
+    # this one serves per-stop lookups
+    __table_args__ = (
+        db.Index('ix_likes_stop_id', 'stop_id'),
+    )
+
+    @classmethod
+    def exists(cls, user_id, stop_id):
+        """ Does user like stop? One primary key probe"""
+
+        return db.session.query(
+            db.exists().where(cls.user_id == user_id, cls.stop_id == stop_id)
+        ).scalar()
+
+    @classmethod
+    def add(cls, user_id, stop_id):
+        """ Like stop; a no-op if already liked. Return True if added.
+            Keeps Stop.like_count and User.likes_version in step, in the
+            caller's transaction
+        """
+
+        result = db.session.execute(
+            insert(cls)
+            .values(user_id=user_id, stop_id=stop_id)
+            .on_conflict_do_nothing()
+        )
+
+        if result.rowcount == 1:
+            Stop.adjust_like_count(stop_id, 1)
+            User.bump_likes_version(user_id)
+            return True
+
+        return False
+
+    @classmethod
+    def remove(cls, user_id, stop_id):
+        """ Unlike stop; a no-op if not liked. Return True if removed.
+            Keeps Stop.like_count and User.likes_version in step, in the
+            caller's transaction
+        """
+
+        result = db.session.execute(
+            db.delete(cls)
+            .where(cls.user_id == user_id, cls.stop_id == stop_id)
+        )
+
+        if result.rowcount == 1:
+            Stop.adjust_like_count(stop_id, -1)
+            User.bump_likes_version(user_id)
+            return True
+
+        return False
+
+    @classmethod
+    def liked_stop_ids(cls, user_id, stop_ids):
+        """ Return set of those stop_ids the user likes, in one query"""
+
+        if not stop_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(cls.stop_id)
+            .where(cls.user_id == user_id, cls.stop_id.in_(stop_ids))
+        ))
+
 
 class User(db.Model):
     """"User for app"""
@@ -84,6 +152,20 @@ class User(db.Model):
         nullable=False
     )
 
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1
+    )
+
+    # bumped whenever the user likes or unlikes a stop
+    likes_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1'
+    )
+
     liked_stops = db.relationship(
         'Stop', secondary='likes', backref='liking_users')
 
@@ -105,7 +187,7 @@ class User(db.Model):
     ):
         """ Register new user and handle password hashing"""
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hash_password(password)
 
         user = cls(
             username=username,
@@ -123,18 +205,39 @@ class User(db.Model):
 
     @classmethod
     def authenticate(cls, username, password):
-        """ Authenicate user to site. Return user instance or False"""
+        """ Authenicate user to site. Return user instance or False.
+            Upgrades a hash made at an old cost; the caller commits
+        """
 
         user = User.query.filter_by(username=username).one_or_none()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(
-                user.hashed_password, password)
-            if is_auth:
-                return user
+        if user and check_password(user.hashed_password, password):
+            if needs_rehash(user.hashed_password):
+                user.hashed_password = hash_password(password)
+
+            return user
 
         return False
 
+    @classmethod
+    def bump_likes_version(cls, user_id):
+        """ Atomically mark a user's likes as changed"""
+
+        db.session.execute(
+            db.update(cls)
+            .where(cls.id == user_id)
+            .values(likes_version=cls.likes_version + 1)
+            .execution_options(synchronize_session=False)
+        )
+
+
+@db.event.listens_for(User, 'before_update')
+def bump_user_version(mapper, connection, target):
+    """ Any change to a user's row invalidates cached identity snapshots"""
+
+    if db.session.is_modified(target, include_collections=False):
+        target.version += 1
+
 
 class Neighborhood(db.Model):
     """Neighborhood for stop."""
@@ -197,15 +300,268 @@ class Stop(db.Model):
 
     )
 
+    map_status = db.Column(
+        db.Text,
+        nullable=False,
+        default='pending'
+    )
+
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1
+    )
+
+    latitude = db.Column(
+        db.Float,
+        nullable=True,
+    )
+
+    longitude = db.Column(
+        db.Float,
+        nullable=True,
+    )
+
+    # normalized address the coordinates were looked up for
+    geocoded_address = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    # maintained by Postgres; deferred so normal loads don't fetch it
+    search_vector = db.deferred(db.Column(
+        TSVECTOR,
+        db.Computed(
+            "setweight(to_tsvector('english', name), 'A') || "
+            "setweight(to_tsvector('english', address), 'B') || "
+            "setweight(to_tsvector('english', description), 'C')",
+            persisted=True
+        )
+    ))
+
+    map_key = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
     def save_map(self):
-        return save_map(self.id, self.address)
+        lat_lng = None
+        if self.latitude is not None:
+            lat_lng = (self.latitude, self.longitude)
+
+        return save_map(self.id, self.address, lat_lng)
+
+    def geocode(self):
+        """ Look up and store coordinates, unless already done for this
+            address. Return True if the stop has coordinates
+        """
+
+        normalized = normalize_address(self.address)
+
+        if self.geocoded_address != normalized:
+            lat_lng = geocoder.geocode(self.address)
+
+            self.latitude, self.longitude = lat_lng or (None, None)
+            self.geocoded_address = normalized
+
+        return self.latitude is not None
+
+    def map_is_current(self):
+        """ Is the saved map already rendered for this stop's address?"""
+
+        return self.map_key == address_map_key(self.address)
+
+    def queue_map(self):
+        """ Enqueue a background render of this stop's static map.
+            The worker writes static/maps/map_{id}.png and flips map_status
+        """
+
+        self.map_status = 'pending'
+        return Job.enqueue('render_map', {'stop_id': self.id})
 
     neighborhood = db.relationship("Neighborhood", backref='stops')
 
+    __table_args__ = (
+        # keyset pagination for the 'neighborhood' and 'popular' sorts
+        db.Index('ix_stops_hood_code_name_id', 'hood_code', 'name', 'id'),
+        db.Index('ix_stops_like_count_id', 'like_count', 'id'),
+        db.Index('ix_stops_search_vector', 'search_vector',
+                 postgresql_using='gin'),
+    )
+
+    @classmethod
+    def adjust_like_count(cls, stop_id, delta):
+        """ Atomically add delta to a stop's like_count"""
+
+        db.session.execute(
+            db.update(cls)
+            .where(cls.id == stop_id)
+            .values(like_count=cls.like_count + delta)
+            .execution_options(synchronize_session=False)
+        )
+
+    @classmethod
+    def reconcile_like_counts(cls):
+        """ Reset any like_count that drifted from the likes table.
+            Return number of stops fixed
+        """
+
+        actual = (
+            db.select(db.func.count(Like.stop_id))
+            .where(Like.stop_id == cls.id)
+            .scalar_subquery()
+        )
+
+        result = db.session.execute(
+            db.update(cls)
+            .where(cls.like_count != actual)
+            .values(like_count=actual)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+    def serialize(self):
+        """ Serialize to dictionary """
+
+        return {
+            'id': self.id,
+            'name': self.name,
+            'description': self.description,
+            'url': self.url,
+            'address': self.address,
+            'hood_code': self.hood_code,
+            'image_url': self.image_url,
+            'like_count': self.like_count,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+        }
+
     def __repr__(self):
         return f'<Neighborhood id={self.id} name="{self.name}">'
 
 
+@db.event.listens_for(Stop, 'before_update')
+def bump_stop_version(mapper, connection, target):
+    """ Any ORM change to a stop's row invalidates cached fragments of it"""
+
+    if db.session.is_modified(target, include_collections=False):
+        target.version += 1
+
+
+class Job(db.Model):
+    """ A unit of background work, claimed and run by the worker """
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued'
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5
+    )
+
+    run_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=lambda: datetime.now(timezone.utc)
+    )
+
+    locked_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=True,
+    )
+
+    last_error = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    created_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=lambda: datetime.now(timezone.utc)
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    @classmethod
+    def enqueue(cls, kind, payload, delay=0):
+        """ Add a job to the session; it is durable once the caller commits"""
+
+        job = cls(
+            kind=kind,
+            payload=payload,
+            run_at=datetime.now(timezone.utc) + timedelta(seconds=delay)
+        )
+
+        db.session.add(job)
+        return job
+
+    @classmethod
+    def enqueue_many(cls, kind, payloads):
+        """ Add one job per payload, runnable now, in a single INSERT ...
+            SELECT. Durable once the caller commits
+        """
+
+        if not payloads:
+            return
+
+        elements = db.func.json_array_elements(
+            db.cast(payloads, db.JSON)).table_valued('value')
+        now = db.func.now()
+
+        db.session.execute(
+            insert(cls).from_select(
+                ['kind', 'payload', 'status', 'attempts', 'max_attempts',
+                 'run_at', 'created_at'],
+                db.select(
+                    db.literal(kind), elements.c.value, db.literal('queued'),
+                    db.literal(0), db.literal(cls.max_attempts.default.arg),
+                    now, now,
+                )
+            )
+        )
+
+    def __repr__(self):
+        return f'<Job id={self.id} kind="{self.kind}" status="{self.status}">'
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -0,0 +1,88 @@
+"""Keyset (cursor) pagination for Rich City Stops.
+
+Instead of OFFSET, each page starts strictly after the sort key of the last
+row on the previous page, so every page is one index range scan no matter
+how deep the reader has scrolled. Cursors are opaque url-safe strings.
+"""
+
+import base64
+import json
+from collections import namedtuple
+
+from models import db, Stop
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+SortKey = namedtuple('SortKey', ['columns', 'descending'])
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+# every key ends in Stop.id so rows never tie; each has a matching index
+STOP_SORTS = {
+    'name': SortKey([Stop.name, Stop.id], False),
+    'newest': SortKey([Stop.id], True),
+    'neighborhood': SortKey([Stop.hood_code, Stop.name, Stop.id], False),
+    'popular': SortKey([Stop.like_count, Stop.id], True),
+}
+
+
+class InvalidCursor(ValueError):
+    """ Raised for a cursor we did not issue or that does not fit the sort """
+
+
+def encode_cursor(values):
+    """ Return opaque cursor string for a list of sort key values"""
+
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """ Return list of sort key values from cursor, checked against columns"""
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except ValueError:
+        raise InvalidCursor(cursor)
+
+    if (
+        not isinstance(values, list)
+        or len(values) != len(columns)
+        or not all(isinstance(v, c.type.python_type)
+                   for v, c in zip(values, columns))
+    ):
+        raise InvalidCursor(cursor)
+
+    return values
+
+
+def keyset_page(query, sort_key, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """ Return Page of up to limit rows of query ordered by sort_key,
+        starting after cursor
+    """
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    columns = sort_key.columns
+
+    if sort_key.descending:
+        query = query.order_by(*[c.desc() for c in columns])
+    else:
+        query = query.order_by(*columns)
+
+    if cursor:
+        after = db.tuple_(*columns)
+        values = db.tuple_(*decode_cursor(cursor, columns))
+        query = query.filter(after < values if sort_key.descending
+                             else after > values)
+
+    # one extra row tells us whether there is a next page
+    rows = query.limit(limit + 1).all()
+    items = rows[:limit]
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = encode_cursor([getattr(last, c.key) for c in columns])
+
+    return Page(items, next_cursor)
@@ -0,0 +1,150 @@
+"""Password hashing for Rich City Stops, off the request thread.
+
+bcrypt is deliberately slow, so hashing and checking run in a small
+dedicated process pool instead of the web worker. At most QUEUE_LIMIT
+operations may be queued or running; beyond that PasswordPoolBusy is
+raised right away (the app answers 503) rather than letting a login burst
+tie up every worker. Work that takes longer than TIMEOUT seconds raises it
+too. If a pool process dies, the pool is replaced and the call retried
+once.
+
+BCRYPT_LOG_ROUNDS sets the work factor. Hashes made at another cost are
+upgraded on the user's next successful login (see needs_rehash).
+
+This module is imported by the pool's child processes, so it must not
+import the app or models.
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+
+# 0 hashes inline, in the calling thread
+WORKERS = int(os.environ.get(
+    'PASSWORD_WORKERS', min(4, os.cpu_count() or 1)))
+QUEUE_LIMIT = int(os.environ.get('PASSWORD_QUEUE_LIMIT', max(1, WORKERS) * 8))
+TIMEOUT = float(os.environ.get('PASSWORD_TIMEOUT', 10))
+
+
+class PasswordPoolBusy(Exception):
+    """ Too many hash operations already queued; try again later """
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(
+        password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+class PasswordPool:
+    """ Bounded process pool for bcrypt """
+
+    def __init__(self, workers=WORKERS, queue_limit=QUEUE_LIMIT,
+                 timeout=TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(queue_limit)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # started on first use, so importing this module forks nothing;
+        # 'spawn' keeps children free of the parent's sockets and threads
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+
+            return self._executor
+
+    def _discard(self, executor):
+        """ Drop a broken executor, so the next call starts a new one"""
+
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+        executor.shutdown(wait=False)
+
+    def _submit(self, fn, *args):
+        # a child that died (OOM kill, segfault) breaks the whole executor;
+        # replace it and try once more
+        for attempt in range(2):
+            executor = self._get_executor()
+            try:
+                future = executor.submit(fn, *args)
+                future.result(timeout=self.timeout)
+                return future
+
+            except BrokenProcessPool:
+                self._discard(executor)
+                if attempt:
+                    raise
+
+            except TimeoutError:
+                # hold the slot until the work is really done
+                future.add_done_callback(lambda _: self._slots.release())
+                raise PasswordPoolBusy()
+
+    def run(self, fn, *args):
+        """ Return fn(*args) computed in the pool; raise PasswordPoolBusy
+            if the queue is full or the work doesn't finish in time
+        """
+
+        if not self._slots.acquire(blocking=False):
+            raise PasswordPoolBusy()
+
+        if not self.workers:
+            try:
+                return fn(*args)
+            finally:
+                self._slots.release()
+
+        try:
+            future = self._submit(fn, *args)
+        except PasswordPoolBusy:
+            raise
+        except BaseException:
+            self._slots.release()
+            raise
+
+        self._slots.release()
+        return future.result()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+pool = PasswordPool()
+
+
+def hash_password(password):
+    """ Return bcrypt hash of password at the configured cost"""
+
+    return pool.run(_hash, password, LOG_ROUNDS)
+
+
+def check_password(hashed, password):
+    """ Does password match the bcrypt hash?"""
+
+    return pool.run(_check, hashed, password)
+
+
+def needs_rehash(hashed):
+    """ Was hashed made at a different cost than LOG_ROUNDS?"""
+
+    # $2b$<cost>$<salt+hash>
+    return int(hashed.split('$')[2]) != LOG_ROUNDS
@@ -0,0 +1,61 @@
+"""Per-request SQL statement budget, to catch N+1 queries early.
+
+Every statement run while handling a request is counted. With
+QUERY_GUARD_MAX set, a request that goes over budget is logged
+(QUERY_GUARD_MODE=log, the default) or fails on the statement that crossed
+the limit (QUERY_GUARD_MODE=raise), so the traceback points at the loop
+that caused it. Meant for tests and staging; off unless QUERY_GUARD_MAX is
+set.
+"""
+
+import logging
+import os
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# kept in the WSGI environ: g can outlive a request (e.g. in tests)
+COUNT_KEY = 'query_guard.count'
+
+# 0 disables the guard
+MAX_QUERIES = int(os.environ.get('QUERY_GUARD_MAX', 0))
+MODE = os.environ.get('QUERY_GUARD_MODE', 'log')
+
+
+class TooManyQueries(Exception):
+    """ A request ran more SQL statements than MAX_QUERIES """
+
+
+def query_count():
+    """ Statements run so far by the current request"""
+
+    return request.environ.get(COUNT_KEY, 0) if has_request_context() else 0
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if not has_request_context():
+        return
+
+    count = request.environ.get(COUNT_KEY, 0) + 1
+    request.environ[COUNT_KEY] = count
+
+    if MAX_QUERIES and MODE == 'raise' and count > MAX_QUERIES:
+        raise TooManyQueries(
+            f'{request.method} {request.path} ran more than {MAX_QUERIES} '
+            f'SQL statements; this one was: {statement[:200]}')
+
+
+def check_query_count(response):
+    """ after_request hook: log requests that went over budget"""
+
+    count = query_count()
+
+    if MAX_QUERIES and count > MAX_QUERIES:
+        logger.warning('%s %s ran %d SQL statements (limit %d)',
+                       request.method, request.path, count, MAX_QUERIES)
+
+    return response
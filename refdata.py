@@ -0,0 +1,204 @@
+"""Process-local cache of reference data (neighborhoods and the like).
+
+Lookup tables change rarely but are read on almost every page. Each
+ReferenceCache loads its table once per worker and hands out plain tuples,
+so forms, views and templates share it without touching the database.
+
+Writes through any session in this process invalidate the cache right away;
+writes made by other processes are picked up after `ttl` seconds. A cache
+given a `stamp` query only reloads then if the stamp changed, so it can use
+a short ttl without rebuilding for nothing.
+"""
+
+import os
+import threading
+import time
+from collections import defaultdict, namedtuple
+from itertools import chain
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, Neighborhood
+
+REFDATA_TTL = int(os.environ.get('REFDATA_TTL', 300))
+
+# model class -> [ReferenceCache], for invalidation
+_caches = defaultdict(list)
+
+
+class ReferenceCache:
+    """ All rows of a small table, keyed by primary key.
+
+        Subclasses can override build() to keep some other structure
+        derived from the rows, and pass `watch` to only be invalidated by
+        ORM changes to those columns (bulk UPDATEs are then ignored).
+
+        `stamp` is a cheap query whose result changes whenever the cached
+        rows do; on expiry it's run first and the rows only reloaded if it
+        changed. While one thread reloads, others keep the old data.
+    """
+
+    def __init__(self, model, key, fields, order=None, where=None,
+                 watch=None, stamp=None, ttl=REFDATA_TTL):
+        self.model = model
+        self.key = key
+        self.fields = fields
+        self.order = order or key
+        self.where = where
+        self.watch = watch
+        self.stamp = stamp
+        self.ttl = ttl
+        self.row_type = namedtuple(f'{model.__name__}Ref', fields)
+
+        self._data = None
+        self._loaded_at = 0
+        self._loaded_stamp = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+        _caches[model].append(self)
+
+    def _load(self):
+        columns = [getattr(self.model, f) for f in self.fields]
+        query = db.select(*columns).order_by(getattr(self.model, self.order))
+        if self.where is not None:
+            query = query.where(self.where)
+
+        # shared by the whole process and kept past this request, so always
+        # read from the primary, never a lagging replica (see replicas)
+        result = db.session.execute(
+            query, bind_arguments={'bind': db.engine})
+        return self.build([self.row_type(*r) for r in result])
+
+    def build(self, rows):
+        """ Return the cached structure for rows: dict of key -> row"""
+
+        return {getattr(row, self.key): row for row in rows}
+
+    def data(self):
+        """ Return cached structure, loading if missing or expired"""
+
+        data = self._data
+
+        if data is None or time.monotonic() - self._loaded_at > self.ttl:
+            # expired but present: if another thread is already reloading,
+            # serve the old data rather than queue behind it
+            if not self._lock.acquire(blocking=data is None):
+                return data
+
+            try:
+                data = self._refresh(data)
+            finally:
+                self._lock.release()
+
+        return data
+
+    def _refresh(self, data):
+        # another thread may have loaded while we waited
+        if self._data is not None and self._data is not data and \
+                time.monotonic() - self._loaded_at <= self.ttl:
+            return self._data
+
+        generation = self._generation
+        # read before the rows, so a change in between shows up next time
+        stamp = None if self.stamp is None else \
+            tuple(db.session.execute(
+                self.stamp, bind_arguments={'bind': db.engine}).one())
+
+        if data is not None and data is self._data and \
+                stamp is not None and stamp == self._loaded_stamp:
+            self._loaded_at = time.monotonic()
+            return data
+
+        data = self._load()
+
+        # don't keep data if a write invalidated us mid-load
+        if generation == self._generation:
+            self._data = data
+            self._loaded_stamp = stamp
+            self._loaded_at = time.monotonic()
+
+        return data
+
+    def all(self):
+        return list(self.data().values())
+
+    def get(self, key):
+        return self.data().get(key)
+
+    def changed_by(self, obj):
+        """ Does this updated object change what we cache?"""
+
+        if self.watch is None:
+            return True
+
+        state = db.inspect(obj)
+        return any(state.attrs[f].history.has_changes() for f in self.watch)
+
+    def invalidate(self):
+        self._generation += 1
+        self._data = None
+
+
+class NeighborhoodCache(ReferenceCache):
+    """ Neighborhoods by code """
+
+    def __init__(self):
+        super().__init__(Neighborhood, 'code', ['code', 'name'], order='name')
+
+    def choices(self):
+        """ (code, name) pairs for select fields"""
+
+        return [(n.code, n.name) for n in self.all()]
+
+    def name(self, code):
+        """ Display name for code, or '' if unknown"""
+
+        hood = self.get(code)
+        return hood.name if hood else ''
+
+
+neighborhoods = NeighborhoodCache()
+
+
+@event.listens_for(Session, 'after_flush')
+def invalidate_flushed(session, flush_context):
+    """ Drop caches for any reference model written in this flush"""
+
+    dirty = session.info.setdefault('refdata_dirty', set())
+
+    for obj in chain(session.new, session.deleted):
+        for cache in _caches.get(type(obj), ()):
+            cache.invalidate()
+            dirty.add(cache)
+
+    for obj in session.dirty:
+        for cache in _caches.get(type(obj), ()):
+            if cache.changed_by(obj):
+                cache.invalidate()
+                dirty.add(cache)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed(session):
+    """ Drop them again at commit, in case another request reloaded the
+        old rows between our flush and commit
+    """
+
+    for cache in session.info.pop('refdata_dirty', ()):
+        cache.invalidate()
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def invalidate_bulk(orm_execute_state):
+    """ Drop caches for bulk INSERT/UPDATE/DELETE statements"""
+
+    state = orm_execute_state
+
+    if state.is_insert or state.is_update or state.is_delete:
+        mapper = state.bind_mapper
+
+        for cache in _caches.get(mapper and mapper.class_, ()):
+            if not (state.is_update and cache.watch):
+                cache.invalidate()
@@ -0,0 +1,132 @@
+"""Connection pool settings and read-replica routing.
+
+DATABASE_URL is the primary. With DATABASE_REPLICA_URL set, views marked
+@read_only send their SELECTs to the replica (a second bind, 'replica');
+writes, and everything outside those views, still go to the primary. The
+replica's connections are opened read-only, so a stray write there fails
+loudly instead of diverging.
+
+Replicas lag the primary, so a browser that just wrote something (liked a
+stop, edited a profile) is pinned to the primary for REPLICA_STICKY_SECONDS
+and reads its own writes. The pin lives in the session cookie, so it holds
+whichever worker serves the next request.
+
+Pool size, overflow, timeout, recycle, pre-ping and a statement timeout
+come from DB_* environment variables and apply to both binds.
+"""
+
+import os
+import time
+from functools import wraps
+
+from flask import request, session, has_request_context
+from flask_sqlalchemy.session import Session
+
+REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+REPLICA_BIND = 'replica'
+
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+# seconds; recycle before servers/proxies drop idle connections
+POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+# milliseconds; 0 means no limit
+STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+
+# request.environ: route this request's reads to the replica / it wrote
+READ_ONLY_KEY = 'replicas.read_only'
+WROTE_KEY = 'replicas.wrote'
+
+# session: time until which this browser reads from the primary
+PIN_KEY = 'replica_pin_until'
+
+
+def engine_options(read_only=False):
+    """ SQLAlchemy create_engine options for one bind"""
+
+    settings = []
+    if STATEMENT_TIMEOUT:
+        settings.append(f'-c statement_timeout={STATEMENT_TIMEOUT}')
+    if read_only:
+        settings.append('-c default_transaction_read_only=on')
+
+    options = {
+        'pool_size': POOL_SIZE,
+        'max_overflow': MAX_OVERFLOW,
+        'pool_timeout': POOL_TIMEOUT,
+        'pool_recycle': POOL_RECYCLE,
+        'pool_pre_ping': POOL_PRE_PING,
+    }
+    if settings:
+        options['connect_args'] = {'options': ' '.join(settings)}
+
+    return options
+
+
+def configure(app):
+    """ Set engine options, and the replica bind if there is one. Call
+        before connect_db(app)
+    """
+
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
+
+    if REPLICA_URL:
+        # binds don't inherit SQLALCHEMY_ENGINE_OPTIONS
+        app.config['SQLALCHEMY_BINDS'] = {
+            REPLICA_BIND: {'url': REPLICA_URL, **engine_options(True)},
+        }
+
+
+def pinned():
+    """ Did this browser write recently enough to need the primary?"""
+
+    return session.get(PIN_KEY, 0) > time.time()
+
+
+def read_only(view):
+    """ Serve view's reads from the replica, unless the browser is pinned
+        to the primary (decorator)
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if REPLICA_URL and not pinned():
+            request.environ[READ_ONLY_KEY] = True
+
+        try:
+            return view(*args, **kwargs)
+        finally:
+            request.environ.pop(READ_ONLY_KEY, None)
+
+    return wrapper
+
+
+def pin_after_write(response):
+    """ after_request hook: pin a browser that wrote to the primary"""
+
+    if REPLICA_URL and request.environ.get(WROTE_KEY):
+        session[PIN_KEY] = time.time() + REPLICA_STICKY_SECONDS
+
+    return response
+
+
+class RoutingSession(Session):
+    """ Session sending SELECTs in @read_only views to the replica """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            environ = request.environ
+            is_select = getattr(clause, 'is_select', False)
+
+            if self._flushing or getattr(clause, 'is_dml', False):
+                environ[WROTE_KEY] = True
+
+            elif is_select and environ.get(READ_ONLY_KEY):
+                replica = self._db.engines.get(REPLICA_BIND)
+                if replica is not None:
+                    return replica
+
+        return super().get_bind(mapper, clause, bind, **kwargs)
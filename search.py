@@ -0,0 +1,86 @@
+"""Full-text search over stops for Rich City Stops.
+
+Stop.search_vector is a stored tsvector (name weighted over address over
+description) with a GIN index. Matching and ranking happen in one index
+scan; snippets are only built for the page of hits actually returned.
+"""
+
+from collections import namedtuple
+
+from markupsafe import Markup, escape
+
+from models import db, Stop
+
+MAX_SEARCH_RESULTS = 500
+
+# control characters stand in for <mark> so ts_headline output can be
+# escaped before the real tags go in
+START_SEL = '\x02'
+STOP_SEL = '\x03'
+
+HEADLINE_OPTIONS = (
+    f'StartSel={START_SEL}, StopSel={STOP_SEL}, '
+    'MaxWords=30, MinWords=10, MaxFragments=2, FragmentDelimiter=" ... "'
+)
+
+SearchHit = namedtuple('SearchHit', ['stop', 'rank', 'name', 'snippet'])
+SearchPage = namedtuple('SearchPage', ['hits', 'next_offset'])
+
+
+def highlight(text):
+    """ Escape ts_headline output and turn its markers into <mark> tags"""
+
+    return Markup(
+        str(escape(text))
+        .replace(START_SEL, '<mark>')
+        .replace(STOP_SEL, '</mark>')
+    )
+
+
+def search_stops(q, hood_codes=(), limit=20, offset=0):
+    """ Return SearchPage of stops matching q (web search syntax: words,
+        "quoted phrases", -exclusions, or), best match first
+    """
+
+    tsquery = db.func.websearch_to_tsquery('english', q)
+    rank = db.func.ts_rank_cd(Stop.search_vector, tsquery)
+
+    offset = max(0, min(offset, MAX_SEARCH_RESULTS))
+    limit = max(1, min(limit, MAX_SEARCH_RESULTS - offset))
+
+    matches = (
+        db.select(Stop.id, rank.label('rank'))
+        .where(Stop.search_vector.op('@@')(tsquery))
+        .order_by(rank.desc(), Stop.id)
+        .limit(limit + 1)
+        .offset(offset)
+    )
+    if hood_codes:
+        matches = matches.where(Stop.hood_code.in_(hood_codes))
+    matches = matches.subquery()
+
+    # headlines are costly, so build them only for this page's rows
+    rows = db.session.execute(
+        db.select(
+            Stop,
+            matches.c.rank,
+            db.func.ts_headline(
+                'english', Stop.name, tsquery,
+                HEADLINE_OPTIONS + ', HighlightAll=true'),
+            db.func.ts_headline(
+                'english', Stop.description, tsquery, HEADLINE_OPTIONS),
+        )
+        .join(matches, matches.c.id == Stop.id)
+        .order_by(matches.c.rank.desc(), Stop.id)
+    ).all()
+
+    hits = [
+        SearchHit(stop, rank, highlight(name), highlight(snippet))
+        for stop, rank, name, snippet in rows[:limit]
+    ]
+
+    next_offset = None
+    if len(rows) > limit and offset + limit < MAX_SEARCH_RESULTS:
+        next_offset = offset + limit
+
+    return SearchPage(hits, next_offset)
@@ -2,7 +2,7 @@
 
 
 from app import db
-from models import Neighborhood, Stop, User
+from models import Neighborhood, Stop, User, Like
 
 
 db.drop_all()
@@ -11,7 +11,6 @@ db.create_all()
 
 #######################################
 # add neighborhoods
-all = Neighborhood(code='all', name='All neighborhoods')
 point = Neighborhood(code='point', name='Point Richmond')
 marina = Neighborhood(code='marina', name='Marina Bay')
 hills = Neighborhood(code='hills', name='Richmond Hills')
@@ -20,7 +19,7 @@ northeast = Neighborhood(code='northeast', name='North and East')
 north = Neighborhood(code='north', name='North Richmond')
 annex = Neighborhood(code='annex', name='Richmond Annex')
 
-db.session.add_all([all, point, marina, hills, pablo, northeast, north, annex])
+db.session.add_all([point, marina, hills, pablo, northeast, north, annex])
 db.session.commit()
 
 
@@ -94,17 +93,17 @@ db.session.commit()
 #######################################
 # add likes
 
-u1.liked_stops.append(s1)
-u1.liked_stops.append(s2)
-ua.liked_stops.append(s1)
+Like.add(u1.id, s1.id)
+Like.add(u1.id, s2.id)
+Like.add(ua.id, s1.id)
 db.session.commit()
 
 
 #######################################
-# stop maps
+# stop maps (rendered by `flask jobs work`)
 
-s1.save_map()
-s2.save_map()
-s3.save_map()
+s1.queue_map()
+s2.queue_map()
+s3.queue_map()
 
 db.session.commit()
@@ -2,76 +2,52 @@
 
 const API_URL = '/api/';
 const $likeBtn = $('#likebtn');
+const $likeCount = $('#like-count');
 
-/** API GET call, does user like stop; Return Array of [Boolean and stopId]*/
+/** Render button (and count, if known) for this liked state */
 
-async function checkIfLiked() {
-  const stopId = $likeBtn.attr('data-id');
-  const params = new URLSearchParams({ 'stop_id': stopId });
-
-  const resp = await fetch(`${API_URL}likes?${params}`);
-  const json = await resp.json();
-
-  return [json.likes, stopId];
-
-}
+function renderHTML(isLiked, likeCount) {
+  $likeBtn.attr('data-liked', String(isLiked));
 
-function renderHTML(isLiked) {
-  if (isLiked === 'true') {
+  if (isLiked) {
     $likeBtn.html('UnLike Stop');
 
   } else {
     $likeBtn.html('Like Stop');
   }
 
+  if (likeCount !== undefined) {
+    $likeCount.text(likeCount);
+  }
 }
 
+/** API PUT/DELETE call, like or unlike stop; Return {liked, like_count} */
 
-async function userLikesStop(stopId) {
+async function setLiked(stopId, isLiked) {
   const resp = await fetch(
-    `${API_URL}like`,
-    {
-      method: 'POST',
-      body: JSON.stringify({ 'stop_id': stopId }),
-      headers: {
-        'Content-Type': 'application/json'
-      }
-    });
+    `${API_URL}stops/${stopId}/like`,
+    { method: isLiked ? 'PUT' : 'DELETE' });
+
+  if (!resp.ok) throw new Error(`Like failed: ${resp.status}`);
 
-  $likeBtn.html('UnLike Stop');
+  return await resp.json();
 }
 
+/** Flip the button right away, then settle on what the server says */
 
-async function userUnlikesStop(stopId) {
-  const resp = await fetch(
-    `${API_URL}unlike`,
-    {
-      method: 'POST',
-      body: JSON.stringify({ 'stop_id': stopId }),
-      headers: {
-        'Content-Type': 'application/json'
-      }
-    });
+async function handleClick() {
+  const stopId = $likeBtn.attr('data-id');
+  const wasLiked = $likeBtn.attr('data-liked') === 'true';
+  const count = Number($likeCount.text());
 
-  $likeBtn.html('Like Stop');
-}
+  renderHTML(!wasLiked, count + (wasLiked ? -1 : 1));
 
-async function handleClick() {
-  const [isLiked, stopId] = await checkIfLiked();
-  if (isLiked === 'true') {
-    userUnlikesStop(stopId);
-  } else {
-    userLikesStop(stopId);
+  try {
+    const json = await setLiked(stopId, !wasLiked);
+    renderHTML(json.liked, json.like_count);
+  } catch (err) {
+    renderHTML(wasLiked, count);
   }
 }
 
 $likeBtn.on('click', handleClick);
-
-async function onLoad() {
-  const [isLiked, stopId] = await checkIfLiked();
-  const renderHTMl = renderHTML(isLiked);
-}
-
-
-onLoad();
-
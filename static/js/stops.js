@@ -0,0 +1,90 @@
+"use strict";
+
+const STOPS_API_URL = '/api/stops';
+const $moreStops = $('#more-stops');
+const $stopCards = $('#stop-cards');
+
+// keep in step with the sizes attribute in stop/_card.html
+const CARD_IMAGE_SIZES = '(min-width: 992px) 25vw, (min-width: 768px) 33vw, 50vw';
+
+let loadingStops = false;
+
+/** Build a stop card matching the server-rendered markup in list.html */
+
+function makeStopCard(stop) {
+  const $card = $(`
+    <div class="col-6 col-md-4 col-lg-3">
+      <div class="card mb-3">
+        <img class="card-img-top image-fluid" style="height: 10em">
+        <div class="card-body">
+          <h5 class="card-title"><a></a></h5>
+          <p class="card-text"></p>
+          <p class="card-text text-muted like-count"></p>
+        </div>
+      </div>
+    </div>`);
+
+  $card.find('img').attr({
+    src: stop.thumbnail_url,
+    srcset: stop.thumbnail_srcset,
+    sizes: CARD_IMAGE_SIZES,
+    alt: stop.name,
+  });
+  $card.find('a').attr('href', `/stops/${stop.id}`).text(stop.name);
+  $card.find('.card-text').first().text(stop.description);
+  $card.find('.like-count').text(`${stop.like_count} likes`);
+
+  return $card;
+}
+
+/** API GET call for the next page; append its cards and advance cursor */
+
+async function loadMoreStops() {
+  const cursor = $moreStops.attr('data-cursor');
+  if (loadingStops || !cursor) return;
+  loadingStops = true;
+
+  // the link carries the sort and filters the cursor was made for, even
+  // on pages like /stops/popular whose own URL has no query string
+  const link = new URL($moreStops.attr('href'), window.location.href);
+  const params = link.searchParams;
+  params.set('cursor', cursor);
+
+  try {
+    const resp = await fetch(`${STOPS_API_URL}?${params}`);
+    if (!resp.ok) {
+      // let the server-rendered next page take over
+      window.location.href = link.href;
+      return;
+    }
+    const json = await resp.json();
+
+    $stopCards.append(json.stops.map(makeStopCard));
+
+    if (json.next_cursor) {
+      params.set('cursor', json.next_cursor);
+      $moreStops.attr({
+        'data-cursor': json.next_cursor,
+        href: `${link.pathname}?${params}`,
+      });
+    } else {
+      $moreStops.remove();
+    }
+  } finally {
+    loadingStops = false;
+  }
+}
+
+function handleMoreClick(evt) {
+  evt.preventDefault();
+  loadMoreStops();
+}
+
+$moreStops.on('click', handleMoreClick);
+
+if ('IntersectionObserver' in window) {
+  const observer = new IntersectionObserver(entries => {
+    if (entries.some(entry => entry.isIntersecting)) loadMoreStops();
+  });
+  observer.observe($moreStops[0]);
+}
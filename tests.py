@@ -5,13 +5,53 @@ import os
 
 os.environ["DATABASE_URL"] = "postgresql:///rich_city_test"
 os.environ["FLASK_DEBUG"] = "0"
-
+os.environ["GEOCODER"] = "local"
+os.environ["BCRYPT_LOG_ROUNDS"] = "4"
+# fail any request that runs more SQL statements than this
+os.environ["QUERY_GUARD_MAX"] = "10"
+os.environ["QUERY_GUARD_MODE"] = "raise"
+# read-only views read through a second, read-only bind to the same database
+os.environ["DATABASE_REPLICA_URL"] = "postgresql:///rich_city_test"
+
+import csv
+import gzip
+import io
+import json
 import re
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest import TestCase
+from unittest.mock import patch, Mock
+
+import requests
+from PIL import Image
 
 from flask import session
+from sqlalchemy import event
+from sqlalchemy.exc import InternalError
 from app import app, CURR_USER_KEY
-from models import db, Stop, Neighborhood, User
+from models import db, Stop, Neighborhood, User, Job, Like, DEFAULT_STOP_URL
+from disk_cache import DiskCache
+from refdata import neighborhoods
+from geocoding import LocalGeocoder
+from spatial import KDTree, stop_locations
+from fragments import fragment_cache
+from assets import assets, compress_file
+from images import thumbnail_url, thumbnail_srcset
+from http_client import HttpClient, CircuitBreaker, CircuitOpenError
+from query_guard import TooManyQueries
+import identity
+import images
+import jobs
+import mapping
+import metrics
+import passwords
+import replicas
+from bench import dataset as bench_dataset, load as bench_load
+from bench.stub_provider import make_server as make_stub_provider
 
 # Make Flask errors be real errors, rather than HTML pages with error info
 app.config['TESTING'] = True
@@ -149,8 +189,32 @@ class NeighborhoodModelTestCase(TestCase):
         Neighborhood.query.delete()
         db.session.commit()
 
-    # depending on how you solve exercise, you may have things to test on
-    # the Neighborhood model, so here's a good place to put that stuff.
+    def test_reference_cache(self):
+        self.assertEqual(neighborhoods.choices(), [("point", "Point Richmond")])
+
+        db.session.add(Neighborhood(code="annex", name="Richmond Annex"))
+        db.session.commit()
+        self.assertEqual(neighborhoods.name("annex"), "Richmond Annex")
+
+        Neighborhood.query.filter_by(code="annex").delete()
+        db.session.commit()
+        self.assertIsNone(neighborhoods.get("annex"))
+
+    def test_reference_cache_skips_query(self):
+        neighborhoods.all()
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.assertEqual(neighborhoods.name("point"), "Point Richmond")
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(statements, [])
 
 
 #######################################
@@ -232,6 +296,203 @@ class StopViewsTestCase(TestCase):
             self.assertIn(b'teststop.com', resp.data)
 
 
+class StopPaginationTestCase(TestCase):
+    """Tests for keyset-paginated stop listings."""
+
+    def setUp(self):
+        """Before each test, add three stops and a user."""
+
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        User.query.delete()
+
+        db.session.add(Neighborhood(**NEIGHBORHOOD_DATA))
+        for name in ["Charlie", "Alpha", "Bravo"]:
+            db.session.add(
+                Stop(**{**STOP_DATA, 'name': name, 'address': name}))
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove stops and users."""
+
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_api_pages(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get('/api/stops?limit=2')
+            names = [s['name'] for s in resp.json['stops']]
+            self.assertEqual(names, ["Alpha", "Bravo"])
+
+            cursor = resp.json['next_cursor']
+            resp = client.get(f'/api/stops?limit=2&cursor={cursor}')
+            names = [s['name'] for s in resp.json['stops']]
+            self.assertEqual(names, ["Charlie"])
+            self.assertIsNone(resp.json['next_cursor'])
+
+    def test_api_newest(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get('/api/stops?sort=newest')
+            names = [s['name'] for s in resp.json['stops']]
+            self.assertEqual(names, ["Bravo", "Alpha", "Charlie"])
+
+    def test_list_next_link(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get('/stops?limit=1')
+            self.assertIn(b'Alpha', resp.data)
+            self.assertNotIn(b'Bravo', resp.data)
+            self.assertIn(b'More stops', resp.data)
+
+    def test_popular_scrolls_through_api(self):
+        for name, likes in [("Alpha", 1), ("Bravo", 3), ("Charlie", 2)]:
+            Stop.query.filter_by(name=name).update({'like_count': likes})
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get('/stops/popular?limit=1')
+            self.assertIn(b'Bravo', resp.data)
+
+            # stops.js asks the API for the "More stops" link's query
+            href = re.search(
+                r'id="more-stops"[^>]*href="([^"]+)"', resp.text).group(1)
+            query = href.split('?', 1)[1].replace('&amp;', '&')
+
+            resp = client.get(f'/api/stops?{query}&limit=1')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['stops'][0]['name'], "Charlie")
+
+            cursor = resp.json['next_cursor']
+            resp = client.get(f'/api/stops?sort=popular&cursor={cursor}')
+            names = [s['name'] for s in resp.json['stops']]
+            self.assertEqual(names, ["Alpha"])
+
+    def test_filter_by_hoods(self):
+        db.session.add(Neighborhood(code="marina", name="Marina Bay"))
+        db.session.add(Neighborhood(code="hills", name="Richmond Hills"))
+        db.session.add(Stop(**{**STOP_DATA, 'name': "Delta",
+                               'address': "Delta", 'hood_code': "marina"}))
+        db.session.add(Stop(**{**STOP_DATA, 'name': "Echo",
+                               'address': "Echo", 'hood_code': "hills"}))
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get('/stops?hood=marina')
+            self.assertIn(b'Delta', resp.data)
+            self.assertNotIn(b'Alpha', resp.data)
+
+            resp = client.get('/stops?hood=marina&hood=hills&limit=1')
+            self.assertIn(b'Delta', resp.data)
+            self.assertIn(b'hood=marina&amp;hood=hills', resp.data)
+
+            resp = client.get('/api/stops?hood=marina&hood=hills')
+            names = [s['name'] for s in resp.json['stops']]
+            self.assertEqual(names, ["Delta", "Echo"])
+
+    def test_unknown_hood_dropped(self):
+        db.session.add(Neighborhood(code="marina", name="Marina Bay"))
+        db.session.add(Stop(**{**STOP_DATA, 'name': "Delta",
+                               'address': "Delta", 'hood_code': "marina"}))
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get('/stops?hood=marina&hood=gone')
+            self.assertIn(b'Delta', resp.data)
+            self.assertNotIn(b'Alpha', resp.data)
+            self.assertIn(b'Unknown neighborhood: gone', resp.data)
+
+            resp = client.get('/stops?q=' + 'x' * 201)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_bad_cursor(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get('/api/stops?cursor=bm9wZQ')
+            self.assertEqual(resp.status_code, 400)
+
+
+class StopSearchTestCase(TestCase):
+    """Tests for full-text stop search."""
+
+    def setUp(self):
+        """Before each test, add stops and a user."""
+
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        User.query.delete()
+
+        db.session.add(Neighborhood(**NEIGHBORHOOD_DATA))
+        db.session.add(Stop(**{
+            **STOP_DATA, 'name': "Bird Sanctuary", 'address': "1 Bay Trail",
+            'description': "Herons and egrets."}))
+        db.session.add(Stop(**{
+            **STOP_DATA, 'name': "Marina Walk", 'address': "2 Harbor Way",
+            'description': "<b>Views</b> of the bay; bring birding glasses."}))
+        db.session.add(Stop(**{
+            **STOP_DATA, 'name': "Good Hot", 'address': "3 Stenmark Dr",
+            'description': "Saunas by the water."}))
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove stops and users."""
+
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_search_api_ranked(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get('/api/stops/search?q=birds')
+            results = resp.json['results']
+
+            self.assertEqual(
+                [r['name'] for r in results], ["Bird Sanctuary", "Marina Walk"])
+            self.assertEqual(
+                results[0]['name_html'], "<mark>Bird</mark> Sanctuary")
+            self.assertIn("<mark>birding</mark>", results[1]['snippet_html'])
+            self.assertNotIn("<b>", results[1]["snippet_html"])
+
+    def test_search_list(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get('/stops?q=sauna')
+            self.assertIn(b'<mark>Saunas</mark>', resp.data)
+            self.assertNotIn(b'Bird Sanctuary', resp.data)
+
+    def test_search_requires_q(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get('/api/stops/search')
+            self.assertEqual(resp.status_code, 400)
+
+
 class StopAdminViewsTestCase(TestCase):
     """Tests for add/edit views on stops."""
 
@@ -259,6 +520,7 @@ class StopAdminViewsTestCase(TestCase):
     def tearDown(self):
         """After each test, delete the cities."""
 
+        Job.query.delete()
         Stop.query.delete()
         Neighborhood.query.delete()
         User.query.delete()
@@ -270,11 +532,20 @@ class StopAdminViewsTestCase(TestCase):
             resp = client.get(f"/stops/add")
             self.assertIn(b'Add Stop', resp.data)
 
-            resp = client.post(
-                f"/stops/add",
-                data=STOP_DATA_EDIT,
-                follow_redirects=True)
+            with patch('models.save_map') as save_map:
+                resp = client.post(
+                    f"/stops/add",
+                    data=STOP_DATA_EDIT,
+                    follow_redirects=True)
+                save_map.assert_not_called()
+
             self.assertIn(b'added', resp.data)
+            self.assertIn(b'Map is being generated', resp.data)
+
+            stop = Stop.query.filter_by(name="new-name").one()
+            job = Job.query.one()
+            self.assertEqual(job.kind, 'render_map')
+            self.assertEqual(job.payload, {'stop_id': stop.id})
 
     def test_dynamic_cities_vocab(self):
         id = self.stop_id
@@ -307,6 +578,56 @@ class StopAdminViewsTestCase(TestCase):
                 follow_redirects=True)
             self.assertIn(b'edited', resp.data)
 
+    def test_edit_same_address_skips_map(self):
+        stop = db.session.get(Stop, self.stop_id)
+        stop.map_key = mapping.map_key(stop.address)
+        stop.map_status = 'ready'
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.post(
+                f"/stops/{self.stop_id}/edit",
+                data={**STOP_DATA, "address": "500 andrade avenue."},
+                follow_redirects=True)
+
+            self.assertIn(b'edited', resp.data)
+            self.assertEqual(Job.query.count(), 0)
+
+    def test_edit_requeues_failed_map(self):
+        # the render for another address failed; map_key still matches
+        stop = db.session.get(Stop, self.stop_id)
+        stop.map_key = mapping.map_key(stop.address)
+        stop.map_status = 'failed'
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.post(f"/stops/{self.stop_id}/edit", data=STOP_DATA)
+
+        self.assertEqual(Job.query.filter_by(kind='render_map').count(), 1)
+        self.assertEqual(
+            db.session.get(Stop, self.stop_id).map_status, 'pending')
+
+    def test_edit_invalidates_card(self):
+        fragment_cache.clear()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            client.get("/stops")
+            client.get("/stops")
+            self.assertGreaterEqual(fragment_cache.hits, 1)
+
+            client.post(
+                f"/stops/{self.stop_id}/edit",
+                data=STOP_DATA_EDIT,
+                follow_redirects=True)
+
+            resp = client.get("/stops")
+            self.assertIn(b'new-description', resp.data)
+            self.assertNotIn(b'Test description', resp.data)
+
     def test_edit_form_shows_curr_data(self):
         id = self.stop_id
 
@@ -317,153 +638,1466 @@ class StopAdminViewsTestCase(TestCase):
 
 
 #######################################
-# users
+# jobs
 
 
-class UserModelTestCase(TestCase):
-    """Tests for the user model."""
+class JobQueueTestCase(TestCase):
+    """Tests for the background job worker."""
 
     def setUp(self):
-        """Before each test, add sample users."""
+        """Before each test, add a stop with a queued map render."""
 
-        User.query.delete()
-        user = User.register(**TEST_USER_DATA)
-        db.session.add(user)
+        Job.query.delete()
+        Stop.query.delete()
+        Neighborhood.query.delete()
+
+        point = Neighborhood(**NEIGHBORHOOD_DATA)
+        stop = Stop(**STOP_DATA)
+        db.session.add_all([point, stop])
+        db.session.flush()
 
+        stop.queue_map()
         db.session.commit()
 
-        self.user = user
+        self.stop_id = stop.id
 
     def tearDown(self):
-        """After each test, remove all users."""
+        """After each test, remove jobs and stops."""
+
         db.session.rollback()
-        User.query.delete()
-        db.session.flush()
+        Job.query.delete()
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        db.session.commit()
 
-    def test_authenticate(self):
-        rez = User.authenticate("test", "secret")
-        self.assertEqual(rez, self.user)
+    def test_render_map(self):
+        with patch('models.save_map', return_value='/tmp/map.png') as save_map:
+            self.assertEqual(jobs.work(burst=True), 1)
+            save_map.assert_called_once()
+            self.assertEqual(
+                save_map.call_args.args[:2], (self.stop_id, "500 Andrade Ave"))
+
+        self.assertEqual(Job.query.one().status, 'done')
+        self.assertEqual(db.session.get(Stop, self.stop_id).map_status, 'ready')
+
+    def test_render_map_retries(self):
+        with patch('models.save_map', return_value=None):
+            jobs.work(burst=True)
+
+        job = Job.query.one()
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(job.attempts, 1)
+        self.assertIn('map render failed', job.last_error)
+        self.assertIsNone(jobs.claim_next())
+
+    def test_periodic_job_reschedules(self):
+        Job.query.delete()
+        jobs.schedule_periodic('reconcile_like_counts')
+        db.session.commit()
 
-    def test_authenticate_fail(self):
-        rez = User.authenticate("no-such-user", "secret")
-        self.assertFalse(rez)
+        jobs.run_job(jobs.claim_next())
 
-        rez = User.authenticate("test", "password")
-        self.assertFalse(rez)
+        statuses = [j.status for j in Job.query.order_by(Job.id)]
+        self.assertEqual(statuses, ['done', 'queued'])
+        self.assertIsNone(jobs.claim_next())
 
-    def test_full_name(self):
-        self.assertEqual(self.user.get_full_name(), "Testy MacTest")
+    def test_render_map_gives_up(self):
+        job = Job.query.one()
+        job.max_attempts = 1
+        db.session.commit()
 
-    def test_register(self):
-        u = User.register(**TEST_USER_DATA)
-        # test that password gets bcrypt-hashed (all start w/$2b$)
-        self.assertEqual(u.hashed_password[:4], "$2b$")
-        db.session.rollback()
+        with patch('models.save_map', return_value=None):
+            jobs.work(burst=True)
 
+        self.assertEqual(Job.query.one().status, 'failed')
+        self.assertEqual(
+            db.session.get(Stop, self.stop_id).map_status, 'failed')
+
+
+#######################################
+# geocoding & nearby stops
 
-class AuthViewsTestCase(TestCase):
-    """Tests for views on logging in/logging out/registration."""
+
+class NearbyStopsTestCase(TestCase):
+    """Tests for geocoding and the nearby stops index."""
 
     def setUp(self):
-        """Before each test, add sample users."""
+        """Before each test, add geocoded stops and a user."""
 
+        Job.query.delete()
+        Stop.query.delete()
+        Neighborhood.query.delete()
         User.query.delete()
 
-        user = User.register(**TEST_USER_DATA)
-        db.session.add(user)
+        db.session.add(Neighborhood(**NEIGHBORHOOD_DATA))
+
+        geocoder = LocalGeocoder(known={
+            "1 Near St": (37.9000, -122.3800),
+            "2 Mid St": (37.9100, -122.3800),
+            "3 Far St": (37.9900, -122.3800),
+        })
+
+        with patch('models.geocoder', geocoder):
+            for address in ["3 Far St", "1 Near St", "2 Mid St"]:
+                stop = Stop(**{**STOP_DATA, 'name': address, 'address': address})
+                stop.geocode()
+                db.session.add(stop)
 
+        user = User.register(**TEST_USER_DATA)
         db.session.commit()
 
         self.user_id = user.id
 
     def tearDown(self):
-        """After each test, remove all users."""
+        """After each test, remove stops and users."""
 
+        Stop.query.delete()
+        Neighborhood.query.delete()
         User.query.delete()
         db.session.commit()
 
-    def test_signup(self):
-        with app.test_client() as client:
-            resp = client.get("/signup")
-            self.assertIn(b'Sign Up', resp.data)
+    def test_geocode_once_per_address(self):
+        stop = Stop.query.filter_by(address="1 Near St").one()
+        stop.address = "1 near street"
 
-            resp = client.post(
-                "/signup",
-                data=TEST_USER_DATA_NEW,
-                follow_redirects=True,
-            )
+        with patch('models.geocoder') as geocoder:
+            stop.geocode()
+            geocoder.geocode.assert_not_called()
 
-            self.assertIn(b"Hello, new-username", resp.data)
-            self.assertTrue(session.get(CURR_USER_KEY))
+        self.assertEqual((stop.latitude, stop.longitude), (37.9, -122.38))
 
-    def test_signup_username_taken(self):
+    def test_nearby(self):
         with app.test_client() as client:
-            resp = client.get("/signup")
-            self.assertIn(b'Sign Up', resp.data)
+            login_for_test(client, self.user_id)
 
-            # signup with same data as the already-added user
-            resp = client.post(
-                "/signup",
-                data=TEST_USER_DATA,
-                follow_redirects=True,
-            )
+            resp = client.get('/api/stops/near?lat=37.9&lng=-122.38&limit=2')
+            stops = resp.json['stops']
 
-            self.assertIn(b"Username already taken", resp.data)
+            self.assertEqual(
+                [s['name'] for s in stops], ["1 Near St", "2 Mid St"])
+            self.assertEqual(stops[0]['distance_km'], 0)
+            self.assertAlmostEqual(stops[1]['distance_km'], 1.112, places=2)
 
-    def test_login(self):
-        with app.test_client() as client:
-            resp = client.get("/login")
-            self.assertIn(b'Welcome Back!', resp.data)
+            resp = client.get(
+                '/api/stops/near?lat=37.9&lng=-122.38&radius_km=5')
+            self.assertEqual(len(resp.json['stops']), 2)
 
-            resp = client.post(
-                "/login",
-                data={"username": "test", "password": "WRONG"},
-                follow_redirects=True,
-            )
+            # only stops right at the point
+            resp = client.get(
+                '/api/stops/near?lat=37.9&lng=-122.38&radius_km=0')
+            self.assertEqual(
+                [s['name'] for s in resp.json['stops']], ["1 Near St"])
 
-            self.assertIn(b"Invalid credentials", resp.data)
+            resp = client.get('/api/stops/near?lat=north')
+            self.assertEqual(resp.status_code, 400)
 
-            resp = client.post(
-                "/login",
-                data={"username": "test", "password": "secret"},
-                follow_redirects=True,
-            )
+            resp = client.get(
+                '/api/stops/near?lat=37.9&lng=-122.38&radius_km=-1')
+            self.assertEqual(resp.status_code, 400)
 
-            self.assertIn(b"Hello, test", resp.data)
-            self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
+    def test_index_follows_moves(self):
+        stop_locations.nearest(37.9, -122.38)
 
-    def test_logout(self):
-        with app.test_client() as client:
-            login_for_test(client, self.user_id)
-            resp = client.post("/logout", follow_redirects=True)
+        stop = Stop.query.filter_by(address="3 Far St").one()
+        stop.latitude = 37.8999
+        db.session.commit()
 
-            self.assertIn(b"Successfully logged out", resp.data)
-            self.assertEqual(session.get(CURR_USER_KEY), None)
+        nearest = stop_locations.nearest(37.8999, -122.38, limit=1)
+        self.assertEqual(nearest[0].stop.name, "3 Far St")
 
+    def test_index_follows_other_processes(self):
+        stop_locations.nearest(37.9, -122.38)
 
-class NavBarTestCase(TestCase):
-    """Tests navigation bar."""
+        # the job worker moves a stop; this process hears nothing of it
+        with db.engine.begin() as conn:
+            conn.execute(
+                db.update(Stop)
+                .where(Stop.address == "3 Far St")
+                .values(latitude=37.8999, version=Stop.version + 1))
 
-    def setUp(self):
-        """Before tests, add sample user."""
+        nearest = stop_locations.nearest(37.8999, -122.38, limit=1)
+        self.assertEqual(nearest[0].stop.name, "1 Near St")
 
-        User.query.delete()
+        stop_locations._loaded_at -= stop_locations.ttl + 1
 
-        user = User.register(**TEST_USER_DATA)
+        nearest = stop_locations.nearest(37.8999, -122.38, limit=1)
+        self.assertEqual(nearest[0].stop.name, "3 Far St")
 
-        db.session.add_all([user])
-        db.session.commit()
+        # nothing changed since: expiring again doesn't rebuild
+        stop_locations._loaded_at -= stop_locations.ttl + 1
 
-        self.user_id = user.id
+        with patch.object(stop_locations, 'build') as build:
+            stop_locations.nearest(37.8999, -122.38, limit=1)
+            build.assert_not_called()
 
-    def tearDown(self):
-        """After tests, remove all users."""
+    def test_kd_tree_matches_brute_force(self):
+        points = [((x / 10, y / 10, 0), (x, y))
+                  for x in range(10) for y in range(10)]
+        tree = KDTree(points)
 
-        User.query.delete()
-        db.session.commit()
+        hits = tree.nearest((0.42, 0.57, 0), 3)
+        self.assertEqual([item for _, item in hits], [(4, 6), (4, 5), (5, 6)])
 
-    def test_anon_navbar(self):
-        with app.test_client() as client:
+
+#######################################
+# map cache
+
+
+class AssetTestCase(TestCase):
+    """Tests for fingerprinted static assets."""
+
+    def setUp(self):
+        """Before each test, serve assets from a temp directory."""
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.patch = patch.object(assets, 'directory', self.tmp.name)
+        self.patch.start()
+
+        os.mkdir(f'{self.tmp.name}/css')
+        self.write('css/site.css', b'body { color: red; }' * 50)
+
+    def tearDown(self):
+        """After each test, remove the temp directory."""
+
+        self.patch.stop()
+        self.tmp.cleanup()
+
+    def write(self, path, data):
+        with open(f'{self.tmp.name}/{path}', 'wb') as f:
+            f.write(data)
+
+    def test_url_follows_content(self):
+        url = assets.url('css/site.css')
+        self.assertRegex(url, r'^/assets/css/site\.[0-9a-f]{12}\.css$')
+
+        self.write('css/site.css', b'body { color: blue; }')
+        os.utime(f'{self.tmp.name}/css/site.css', ns=(0, 0))
+        self.assertNotEqual(assets.url('css/site.css'), url)
+
+        self.assertEqual(assets.url('css/none.css'), '/static/css/none.css')
+        self.assertIsNone(assets.digest('../tests.py'))
+
+    def test_serve_immutable(self):
+        url = assets.url('css/site.css')
+
+        with app.test_client() as client:
+            resp = client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            self.assertEqual(resp.mimetype, 'text/css')
+            resp.close()
+
+            stale = url.replace('.css', '').rsplit('.', 1)[0]
+            resp = client.get(f'{stale}.000000000000.css')
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, url)
+
+            resp = client.get('/assets/css/none.000000000000.css')
+            self.assertEqual(resp.status_code, 404)
+
+    def test_serve_precompressed(self):
+        compress_file(f'{self.tmp.name}/css/site.css')
+        url = assets.url('css/site.css')
+
+        with app.test_client() as client:
+            resp = client.get(url, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.content_encoding, 'gzip')
+            self.assertIn('Accept-Encoding', resp.vary)
+            self.assertEqual(
+                gzip.decompress(resp.data), b'body { color: red; }' * 50)
+            resp.close()
+
+            resp = client.get(url)
+            self.assertIsNone(resp.content_encoding)
+            resp.close()
+
+
+def png_bytes(width, height):
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 30, 30)).save(out, 'PNG')
+    return out.getvalue()
+
+
+class RemoteImageHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the external hosts stop images live on."""
+
+    requests_seen = []
+
+    def do_GET(self):
+        self.requests_seen.append(self.path)
+
+        if self.path == '/big.png':
+            body, content_type = png_bytes(1200, 800), 'image/png'
+        elif self.path == '/moved.png':
+            self.send_response(302)
+            self.send_header('Location', '/big.png')
+            self.end_headers()
+            return
+        else:
+            body, content_type = b'not an image', 'text/plain'
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageProxyTestCase(TestCase):
+    """Tests for the external image proxy."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), RemoteImageHandler)
+        cls.base = f'http://127.0.0.1:{cls.server.server_port}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        """Before each test, cache images in a temp directory."""
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.patches = [
+            patch('images.originals', DiskCache(self.tmp.name + '/o', 10**7)),
+            patch('images.thumbnails',
+                  DiskCache(self.tmp.name + '/t', 10**7, suffix='.webp')),
+            patch('images.ALLOW_PRIVATE', True),
+        ]
+        for p in self.patches:
+            p.start()
+        RemoteImageHandler.requests_seen.clear()
+
+    def tearDown(self):
+        """After each test, remove the temp directory."""
+
+        for p in self.patches:
+            p.stop()
+        self.tmp.cleanup()
+
+    def test_helpers(self):
+        with app.test_request_context():
+            url = thumbnail_url(f'{self.base}/big.png', 160)
+            self.assertTrue(url.startswith('/images/'))
+            self.assertIn('/160/', url)
+            self.assertEqual(
+                thumbnail_srcset(f'{self.base}/big.png').count('w,'), 3)
+
+            self.assertEqual(thumbnail_url('/static/a.jpg'), '/static/a.jpg')
+            self.assertEqual(thumbnail_srcset('/static/a.jpg'), '')
+
+    def test_resizes_and_fetches_once(self):
+        with app.test_request_context():
+            small = thumbnail_url(f'{self.base}/big.png', 160)
+            large = thumbnail_url(f'{self.base}/big.png', 640)
+
+        with app.test_client() as client:
+            for url, width in [(small, 160), (small, 160), (large, 640)]:
+                resp = client.get(url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.mimetype, 'image/webp')
+
+                image = Image.open(io.BytesIO(resp.data))
+                self.assertEqual(image.size, (width, round(width * 2 / 3)))
+                resp.close()
+
+        self.assertEqual(RemoteImageHandler.requests_seen, ['/big.png'])
+
+    def test_follows_redirect(self):
+        with app.test_request_context():
+            url = thumbnail_url(f'{self.base}/moved.png', 160)
+
+        with app.test_client() as client:
+            resp = client.get(url)
+            self.assertEqual(resp.mimetype, 'image/webp')
+            resp.close()
+
+    def test_rejects_bad_signature(self):
+        with app.test_request_context():
+            url = thumbnail_url(f'{self.base}/big.png', 160)
+
+        with app.test_client() as client:
+            resp = client.get(url.replace('/160/', '/161/'))
+            self.assertEqual(resp.status_code, 404)
+
+            sig = url.split('/')[2]
+            resp = client.get(url.replace(sig, 'A' * len(sig)))
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertEqual(RemoteImageHandler.requests_seen, [])
+
+    def test_falls_back_to_original(self):
+        with app.test_request_context():
+            not_image = thumbnail_url(f'{self.base}/page.html')
+            private = thumbnail_url(f'{self.base}/big.png')
+
+        with app.test_client() as client:
+            resp = client.get(not_image)
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, f'{self.base}/page.html')
+
+            with patch('images.ALLOW_PRIVATE', False):
+                resp = client.get(private)
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(RemoteImageHandler.requests_seen, ['/page.html'])
+
+    def test_connects_to_checked_address(self):
+        real_getaddrinfo = socket.getaddrinfo
+        answers = iter(['93.184.216.34', '127.0.0.1', '127.0.0.1'])
+
+        def rebinding_dns(host, port, *args, **kwargs):
+            # public for the first lookup, then internal
+            if host == 'rebind.test':
+                host = next(answers)
+            return real_getaddrinfo(host, port, *args, **kwargs)
+
+        with patch('images.ALLOW_PRIVATE', False), \
+                patch('socket.getaddrinfo', side_effect=rebinding_dns), \
+                patch('images.create_connection',
+                      side_effect=OSError('unreachable')) as connect:
+            with self.assertRaises(images.ImageProxyError):
+                images.fetch(
+                    f'http://rebind.test:{self.server.server_port}/big.png')
+
+        # the check at connect time saw the internal answer; nothing was
+        # dialed, and nothing reached our local server
+        connect.assert_not_called()
+        self.assertEqual(RemoteImageHandler.requests_seen, [])
+
+    def test_connection_pinned_to_resolved_address(self):
+        port = self.server.server_port
+
+        with patch('socket.getaddrinfo',
+                   return_value=[(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                                  ('127.0.0.1', port))]) as resolve, \
+                patch('images.create_connection',
+                      wraps=images.create_connection) as connect:
+            data = images.fetch(f'http://pinned.test:{port}/big.png')
+
+        self.assertEqual(data[:4], b'\x89PNG')
+        # dialed the address the name resolved to, not the name
+        self.assertEqual(connect.call_args[0][0], ('127.0.0.1', port))
+        self.assertEqual(resolve.call_args_list[0][0][0], 'pinned.test')
+
+
+class MapCacheTestCase(TestCase):
+    """Tests for the content-addressed map cache."""
+
+    def setUp(self):
+        """Before each test, point maps and cache at a temp directory."""
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = DiskCache(self.tmp.name + '/cache', 10, suffix='.png')
+
+        self.patches = [
+            patch('mapping.MAPS_DIR', self.tmp.name),
+            patch('mapping.map_cache', self.cache),
+            patch('mapping.variant_cache',
+                  DiskCache(self.tmp.name + '/variants', 10**7)),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        """After each test, remove the temp directory."""
+
+        for p in self.patches:
+            p.stop()
+        self.tmp.cleanup()
+
+    def test_key_normalizes_address(self):
+        self.assertEqual(
+            mapping.map_key("500 Andrade Avenue"),
+            mapping.map_key(" 500  andrade ave. "))
+        self.assertNotEqual(
+            mapping.map_key("500 Andrade Ave"),
+            mapping.map_key("500 Andrade Ave", size='300,200'))
+
+    def test_shared_address_fetches_once(self):
+        master = png_bytes(1200, 800)
+
+        with patch('mapping.get_map', return_value=master) as get_map:
+            path1 = mapping.save_map(1, "500 Andrade Ave")
+            path2 = mapping.save_map(2, "500 ANDRADE AVENUE")
+
+            get_map.assert_called_once()
+
+        with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_derives_variants(self):
+        with patch('mapping.get_map', return_value=png_bytes(1200, 800)):
+            mapping.save_map(1, "500 Andrade Ave")
+
+        for (width, fmt), path in mapping.map_paths(1).items():
+            with Image.open(path) as image:
+                self.assertEqual(image.format, fmt.upper())
+                self.assertEqual(image.size, (width, width * 2 // 3))
+
+    def test_bad_master_refetched(self):
+        with patch('mapping.get_map', return_value=b'not a png') as get_map:
+            self.assertIsNone(mapping.save_map(1, "500 Andrade Ave"))
+            self.assertIsNone(mapping.save_map(1, "500 Andrade Ave"))
+
+            self.assertEqual(get_map.call_count, 2)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put('a', b'1234')
+        self.cache.put('b', b'1234')
+        self.assertIsNotNone(self.cache.get('a'))
+
+        # pretend 'b' was used long ago, then push over the 10 byte quota
+        os.utime(self.cache.path('b'), (0, 0))
+        self.cache.put('c', b'1234')
+
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('c'))
+
+
+class MapWarmCommandTestCase(TestCase):
+    """Tests for `flask maps warm`."""
+
+    def setUp(self):
+        """Before each test, add two stops and a temp maps directory."""
+
+        Job.query.delete()
+        Stop.query.delete()
+        Neighborhood.query.delete()
+
+        db.session.add(Neighborhood(**NEIGHBORHOOD_DATA))
+        stop1 = Stop(**STOP_DATA)
+        stop2 = Stop(**{**STOP_DATA_EDIT, 'name': 'Other Stop'})
+        db.session.add_all([stop1, stop2])
+        db.session.commit()
+
+        self.stop_ids = [stop1.id, stop2.id]
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.maps_dir = patch('mapping.MAPS_DIR', self.tmp.name)
+        self.maps_dir.start()
+
+    def tearDown(self):
+        """After each test, remove stops and the temp directory."""
+
+        self.maps_dir.stop()
+        self.tmp.cleanup()
+
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        db.session.commit()
+
+    def fake_save_map(self, id, address, lat_lng=None):
+        for path in mapping.map_paths(id).values():
+            with open(path, 'wb') as file:
+                file.write(b'png')
+        return path
+
+    def test_dry_run(self):
+        runner = app.test_cli_runner()
+
+        with patch('mapping.save_map') as save_map:
+            result = runner.invoke(args=['maps', 'warm', '--dry-run'])
+            save_map.assert_not_called()
+
+        self.assertIn('2 of 2 stops need maps', result.output)
+        self.assertIn('500 Andrade Ave', result.output)
+
+    def test_warm_skips_up_to_date(self):
+        runner = app.test_cli_runner()
+
+        with patch('mapping.save_map', side_effect=self.fake_save_map):
+            result = runner.invoke(
+                args=['maps', 'warm', '--stop-id', str(self.stop_ids[0])])
+
+        self.assertIn('Rendered 1, failed 0', result.output)
+        self.assertEqual(
+            db.session.get(Stop, self.stop_ids[0]).map_status, 'ready')
+
+        with patch('mapping.save_map') as save_map:
+            result = runner.invoke(args=['maps', 'warm'])
+            save_map.assert_called_once_with(
+                self.stop_ids[1], STOP_DATA_EDIT['address'],
+                LocalGeocoder().geocode(STOP_DATA_EDIT['address']))
+
+        self.assertIn('skipped 1', result.output)
+
+    def test_warm_geocodes(self):
+        runner = app.test_cli_runner()
+
+        with patch('mapping.save_map', side_effect=self.fake_save_map):
+            runner.invoke(args=['maps', 'warm'])
+
+        stop = db.session.get(Stop, self.stop_ids[0])
+        db.session.refresh(stop)
+
+        self.assertEqual((stop.latitude, stop.longitude),
+                         LocalGeocoder().geocode(STOP_DATA['address']))
+        self.assertEqual(stop.geocoded_address,
+                         mapping.normalize_address(STOP_DATA['address']))
+
+        # already geocoded: the stored coordinates are used
+        with patch('commands.geocoder.geocode') as geocode, \
+                patch('mapping.save_map') as save_map:
+            runner.invoke(args=['maps', 'warm', '--force', '--stop-id',
+                                str(self.stop_ids[0])])
+
+        geocode.assert_not_called()
+        save_map.assert_called_once_with(
+            self.stop_ids[0], STOP_DATA['address'],
+            (stop.latitude, stop.longitude))
+
+        # a failed lookup still renders, from the address
+        stop = db.session.get(Stop, self.stop_ids[1])
+        stop.latitude = stop.longitude = stop.geocoded_address = None
+        db.session.commit()
+
+        with patch('commands.geocoder.geocode', side_effect=ValueError), \
+                patch('mapping.save_map') as save_map:
+            runner.invoke(args=['maps', 'warm', '--force', '--stop-id',
+                                str(self.stop_ids[1])])
+
+        save_map.assert_called_once_with(
+            self.stop_ids[1], STOP_DATA_EDIT['address'], None)
+
+
+class ImportCommandTestCase(TestCase):
+    """Tests for `flask data import`."""
+
+    def setUp(self):
+        """Before each test, clear stops and make a temp directory."""
+
+        Like.query.delete()
+        Job.query.delete()
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.runner = app.test_cli_runner()
+
+    def tearDown(self):
+        """After each test, remove imported rows and the temp directory."""
+
+        self.tmp.cleanup()
+
+        Like.query.delete()
+        Job.query.delete()
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as file:
+            file.write(text)
+        return path
+
+    def import_file(self, kind, name, text, *args):
+        return self.runner.invoke(
+            args=['data', 'import', kind, self.write(name, text), *args])
+
+    def import_stops(self, *stops):
+        text = ''.join(json.dumps(stop) + '\n' for stop in stops)
+        return self.import_file('stops', 'stops.ndjson', text)
+
+    def import_hoods(self):
+        return self.import_file(
+            'neighborhoods', 'hoods.csv',
+            'code,name\npoint,Point Richmond\nmarina,Marina Bay\n,Nameless\n')
+
+    def test_import_neighborhoods(self):
+        result = self.import_hoods()
+
+        self.assertIn('Inserted 2, updated 0, unchanged 0, rejected 1',
+                      result.output)
+        self.assertIn('line 4: code: This field is required.', result.output)
+        self.assertEqual(neighborhoods.name('marina'), 'Marina Bay')
+
+        result = self.import_file('neighborhoods', 'hoods.csv',
+                                  'code,name\nmarina,Marina Bay Park\n')
+
+        self.assertIn('Inserted 0, updated 1', result.output)
+        self.assertEqual(neighborhoods.name('marina'), 'Marina Bay Park')
+
+    def test_import_stops(self):
+        self.import_hoods()
+
+        result = self.import_stops(
+            STOP_DATA,
+            {**STOP_DATA, 'name': 'Bad Hood', 'hood_code': 'nowhere'},
+            {**STOP_DATA_EDIT, 'image_url': ''},
+        )
+
+        self.assertIn('Inserted 2, updated 0, unchanged 0, rejected 1, '
+                      'maps queued 2', result.output)
+        self.assertIn('line 2: hood_code:', result.output)
+
+        stop = Stop.query.filter_by(name=STOP_DATA_EDIT['name']).one()
+        self.assertEqual(stop.image_url, DEFAULT_STOP_URL)
+        self.assertEqual(stop.map_status, 'pending')
+        self.assertEqual(Job.query.filter_by(kind='render_map').count(), 2)
+
+    def test_reimport_stops(self):
+        self.import_hoods()
+        self.import_stops(STOP_DATA, STOP_DATA_EDIT)
+
+        Job.query.delete()
+        Stop.query.update({'map_status': 'ready'})
+        db.session.commit()
+
+        moved = {**STOP_DATA, 'address': '1 Marina Way', 'hood_code': 'marina'}
+        result = self.import_stops(moved, STOP_DATA_EDIT)
+
+        self.assertIn('Inserted 0, updated 1, unchanged 1, rejected 0, '
+                      'maps queued 1', result.output)
+
+        stop = Stop.query.filter_by(name=STOP_DATA['name']).one()
+        self.assertEqual(stop.address, '1 Marina Way')
+        self.assertEqual(stop.version, 2)
+        self.assertEqual(stop.map_status, 'pending')
+        self.assertEqual(Job.query.one().payload, {'stop_id': stop.id})
+
+        other = Stop.query.filter_by(name=STOP_DATA_EDIT['name']).one()
+        self.assertEqual(other.version, 1)
+        self.assertEqual(other.map_status, 'ready')
+
+    def test_bad_batch_falls_back_to_rows(self):
+        self.import_hoods()
+        self.import_stops(STOP_DATA)
+
+        # a second stop at a taken address fails the unique constraint;
+        # the rest of its batch still goes in
+        result = self.import_stops(
+            {**STOP_DATA_EDIT, 'address': STOP_DATA['address']},
+            {**STOP_DATA_EDIT, 'name': 'Fine Stop'},
+        )
+
+        self.assertIn('Inserted 1, updated 0, unchanged 0, rejected 1',
+                      result.output)
+        self.assertIn('line 1: row:', result.output)
+        self.assertEqual(Stop.query.count(), 2)
+
+    def test_import_likes(self):
+        self.import_hoods()
+        self.import_stops(STOP_DATA, STOP_DATA_EDIT)
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+
+        result = self.import_file(
+            'likes', 'likes.csv',
+            'username,stop\n'
+            f'test,{STOP_DATA["name"]}\n'
+            f'test,{STOP_DATA["name"]}\n'
+            'nobody,Test Stop\n'
+            'test,No Such Stop\n')
+
+        self.assertIn('Inserted 1, updated 0, unchanged 0, rejected 2',
+                      result.output)
+        self.assertIn('line 4: username: No such user.', result.output)
+        self.assertIn('line 5: stop: No such stop.', result.output)
+
+        stop = Stop.query.filter_by(name=STOP_DATA['name']).one()
+        self.assertEqual(stop.like_count, 1)
+        self.assertEqual(db.session.get(User, user.id).likes_version, 2)
+
+
+class ExportTestCase(TestCase):
+    """Tests for `flask data export` and /api/export."""
+
+    def setUp(self):
+        """Before each test, add a hood, a stop, two users and a like."""
+
+        Like.query.delete()
+        Job.query.delete()
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        User.query.delete()
+
+        db.session.add(Neighborhood(**NEIGHBORHOOD_DATA))
+        stop = Stop(**STOP_DATA)
+        user = User.register(**TEST_USER_DATA)
+        admin = User.register(**ADMIN_USER_DATA)
+        db.session.add_all([stop, user, admin])
+        db.session.flush()
+        Like.add(user.id, stop.id)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.admin_id = admin.id
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        """After each test, remove everything and the temp directory."""
+
+        self.tmp.cleanup()
+
+        Like.query.delete()
+        Job.query.delete()
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_cli_round_trip(self):
+        path = os.path.join(self.tmp.name, 'stops.csv')
+        runner = app.test_cli_runner()
+
+        result = runner.invoke(args=['data', 'export', 'stops', '-o', path])
+        self.assertEqual(result.exit_code, 0)
+
+        with open(path) as file:
+            rows = list(csv.DictReader(file))
+        self.assertEqual(rows[0]['address'], STOP_DATA['address'])
+        self.assertEqual(rows[0]['like_count'], '1')
+
+        Like.query.delete()
+        Stop.query.delete()
+        db.session.commit()
+
+        result = runner.invoke(args=['data', 'import', 'stops', path])
+        self.assertIn('Inserted 1, updated 0, unchanged 0, rejected 0',
+                      result.output)
+
+    def test_api_users_omit_passwords(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.get('/api/export/users')
+
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(resp.mimetype, 'application/x-ndjson')
+            self.assertIn('filename="users.ndjson"',
+                          resp.headers['Content-Disposition'])
+
+            users = [json.loads(line) for line in resp.text.splitlines()]
+
+        self.assertEqual({u['username'] for u in users}, {'test', 'admin'})
+        self.assertNotIn('hashed_password', users[0])
+        self.assertNotIn('$2b$', resp.text)
+
+    def test_api_likes_csv(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.get('/api/export/likes?format=csv')
+
+        self.assertEqual(resp.mimetype, 'text/csv')
+        self.assertEqual(
+            resp.text, f'username,stop\ntest,{STOP_DATA["name"]}\n')
+
+    def test_api_admin_only(self):
+        with app.test_client() as client:
+            self.assertEqual(client.get('/api/export/stops').status_code, 401)
+
+            login_for_test(client, self.user_id)
+            self.assertEqual(client.get('/api/export/stops').status_code, 403)
+
+            login_for_test(client, self.admin_id)
+            self.assertEqual(client.get('/api/export/nope').status_code, 404)
+            self.assertEqual(
+                client.get('/api/export/stops?format=xml').status_code, 400)
+
+
+class QueryGuardTestCase(TestCase):
+    """Tests for per-view loading and the per-request query budget."""
+
+    def setUp(self):
+        """Before each test, add a user who likes ten stops."""
+
+        Like.query.delete()
+        Job.query.delete()
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        User.query.delete()
+
+        db.session.add(Neighborhood(**NEIGHBORHOOD_DATA))
+        user = User.register(**TEST_USER_DATA)
+        stops = [
+            Stop(**{**STOP_DATA, 'name': f'Stop {i}', 'address': f'{i} Main'})
+            for i in range(10)
+        ]
+        db.session.add_all(stops)
+        db.session.flush()
+
+        for stop in stops:
+            Like.add(user.id, stop.id)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.stop_id = stops[0].id
+
+        # start requests from an empty identity map, like a real worker
+        db.session.expunge_all()
+
+    def tearDown(self):
+        """After each test, remove users, likes and stops."""
+
+        Like.query.delete()
+        Job.query.delete()
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_profile_loads_likes_eagerly(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            # one for the identity check, one for the user and their likes
+            with patch('query_guard.MAX_QUERIES', 2), \
+                    patch('query_guard.MODE', 'raise'):
+                resp = client.get(f'/users/{self.user_id}')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.text.count('class="card-title"'), 10)
+
+    def test_raise_mode(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            with patch('query_guard.MAX_QUERIES', 1), \
+                    patch('query_guard.MODE', 'raise'):
+                with self.assertRaises(TooManyQueries):
+                    client.get(f'/stops/{self.stop_id}')
+
+    def test_log_mode(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            with patch('query_guard.MAX_QUERIES', 1), \
+                    patch('query_guard.MODE', 'log'), \
+                    self.assertLogs('query_guard', 'WARNING') as logs:
+                resp = client.get(f'/stops/{self.stop_id}')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(f'GET /stops/{self.stop_id} ran', logs.output[0])
+
+
+class MetricsTestCase(TestCase):
+    """Tests for request/database metrics and /metrics."""
+
+    def setUp(self):
+        """Before each test, add a hood, a stop and a user."""
+
+        Like.query.delete()
+        Job.query.delete()
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        User.query.delete()
+
+        db.session.add(Neighborhood(**NEIGHBORHOOD_DATA))
+        stop = Stop(**STOP_DATA)
+        user = User.register(**TEST_USER_DATA)
+        db.session.add_all([stop, user])
+        db.session.commit()
+
+        self.stop_id = stop.id
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove users and stops."""
+
+        Job.query.delete()
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_request_metrics(self):
+        before = metrics.REQUESTS.value('stop_detail', 'GET', '200')
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.get(f'/stops/{self.stop_id}')
+
+            resp = client.get('/metrics')
+
+        self.assertEqual(
+            metrics.REQUESTS.value('stop_detail', 'GET', '200'), before + 1)
+
+        self.assertEqual(resp.content_type, metrics.CONTENT_TYPE)
+        for line in (
+            'http_request_duration_seconds_count'
+            '{endpoint="stop_detail",method="GET"}',
+            'http_request_sql_statements_count{endpoint="stop_detail"}',
+            'function_duration_seconds_count{function="add_user_to_g"}',
+            'http_client_requests_total{client="mapquest"}',
+            'db_pool_checkedout{bind="default"}',
+            'fragment_cache_hits_total',
+        ):
+            self.assertIn(line, resp.text)
+
+    def test_histogram_format(self):
+        hist = metrics.Histogram('t', 'Test.', ('x',), buckets=(1, 5))
+        for value in (0.5, 3, 10):
+            hist.observe(value, 'a"b')
+
+        lines = hist.collect()
+
+        self.assertEqual(lines[:2], ['# HELP t Test.', '# TYPE t histogram'])
+        self.assertEqual(lines[2:], [
+            't_bucket{x="a\\"b",le="1"} 1',
+            't_bucket{x="a\\"b",le="5"} 2',
+            't_bucket{x="a\\"b",le="+Inf"} 3',
+            't_sum{x="a\\"b"} 13.5',
+            't_count{x="a\\"b"} 3',
+        ])
+
+    def test_scrape_access(self):
+        with app.test_client() as client:
+            self.assertEqual(client.get('/metrics').status_code, 200)
+
+            resp = client.get(
+                '/metrics', environ_base={'REMOTE_ADDR': '203.0.113.9'})
+            self.assertEqual(resp.status_code, 404)
+
+            resp = client.get(
+                '/metrics', headers={'X-Forwarded-For': '203.0.113.9'})
+            self.assertEqual(resp.status_code, 404)
+
+            with patch('metrics.METRICS_TOKEN', 's3cret'):
+                self.assertEqual(client.get('/metrics').status_code, 404)
+
+                resp = client.get(
+                    '/metrics', headers={'Authorization': 'Bearer s3cret'})
+                self.assertEqual(resp.status_code, 200)
+
+
+class BenchHarnessTestCase(TestCase):
+    """Tests for the load-test dataset generator, stub and driver."""
+
+    def tearDown(self):
+        """After each test, remove generated rows and cached copies."""
+
+        Like.query.delete()
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        neighborhoods.invalidate()
+        stop_locations.invalidate()
+
+    def test_generate_dataset(self):
+        with patch('click.echo'):
+            info = bench_dataset.generate(
+                hoods=3, stops=50, users=5, likes=100, password='pw', seed=7)
+
+        self.assertEqual(Neighborhood.query.count(), 3)
+        self.assertEqual(Stop.query.count(), 50)
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(Like.query.count(), info['likes'])
+
+        # like counts match the likes, and new rows get fresh ids
+        stop = Stop.query.get(1)
+        self.assertEqual(stop.like_count,
+                         Like.query.filter_by(stop_id=1).count())
+
+        db.session.add(Stop(**{**STOP_DATA, 'hood_code': 'hood1'}))
+        db.session.commit()
+
+        self.assertTrue(User.authenticate('user1', 'pw'))
+
+    def test_stub_provider_serves_maps(self):
+        server = make_stub_provider()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address
+
+        try:
+            with patch('mapping.MAPQUEST_BASE_URL', f'http://{host}:{port}'):
+                master = mapping.get_map("500 Andrade Ave")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        with Image.open(io.BytesIO(master)) as image:
+            self.assertEqual(image.size, (1200, 800))
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+
+        self.assertEqual(bench_load.percentile(values, 50), 50)
+        self.assertEqual(bench_load.percentile(values, 99), 99)
+        self.assertEqual(bench_load.percentile([3], 95), 3)
+        self.assertEqual(bench_load.percentile([], 95), 0.0)
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Tests for read-replica routing and read-your-writes pinning."""
+
+    def setUp(self):
+        """Before each test, add a hood, a stop and a user, and count
+        statements run on the replica."""
+
+        Like.query.delete()
+        Job.query.delete()
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        User.query.delete()
+
+        db.session.add(Neighborhood(**NEIGHBORHOOD_DATA))
+        stop = Stop(**STOP_DATA)
+        user = User.register(**TEST_USER_DATA)
+        db.session.add_all([stop, user])
+        db.session.commit()
+
+        self.stop_id = stop.id
+        self.user_id = user.id
+
+        self.replica_statements = []
+        self.replica = db.engines[replicas.REPLICA_BIND]
+        event.listen(self.replica, 'before_cursor_execute', self.on_replica)
+
+    def tearDown(self):
+        """After each test, remove users, likes and stops."""
+
+        event.remove(self.replica, 'before_cursor_execute', self.on_replica)
+
+        Like.query.delete()
+        Job.query.delete()
+        Stop.query.delete()
+        Neighborhood.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def on_replica(self, conn, cursor, statement, *args):
+        self.replica_statements.append(statement)
+
+    def test_read_only_views_use_replica(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get(f'/stops/{self.stop_id}')
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(any('FROM stops' in statement
+                                for statement in self.replica_statements))
+
+            # not a read-only view
+            del self.replica_statements[:]
+            client.get(f'/stops/{self.stop_id}/edit')
+            self.assertEqual(self.replica_statements, [])
+
+    def test_reference_data_loads_from_primary(self):
+        neighborhoods.invalidate()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get('/stops')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(any('FROM stops' in statement
+                            for statement in self.replica_statements))
+        self.assertFalse(any('FROM neighborhoods' in statement
+                             for statement in self.replica_statements))
+        self.assertIsNotNone(neighborhoods._data)
+
+    def test_pinned_to_primary_after_write(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.put(f'/api/stops/{self.stop_id}/like')
+            self.assertEqual(resp.status_code, 200)
+
+            with client.session_transaction() as sess:
+                self.assertIn(replicas.PIN_KEY, sess)
+
+            resp = client.get('/api/likes', query_string={
+                'stop_id': self.stop_id})
+            self.assertEqual(resp.json, {'likes': 'true'})
+            self.assertEqual(self.replica_statements, [])
+
+            # once the pin expires, reads go back to the replica
+            with client.session_transaction() as sess:
+                sess[replicas.PIN_KEY] = 0
+
+            client.get('/api/likes', query_string={'stop_id': self.stop_id})
+            self.assertNotEqual(self.replica_statements, [])
+
+    def test_replica_is_read_only(self):
+        with self.replica.connect() as conn:
+            with self.assertRaises(InternalError):
+                conn.execute(db.text('DELETE FROM likes'))
+
+
+#######################################
+# map provider client
+
+
+class HttpClientTestCase(TestCase):
+    """Tests for the pooled, resilient provider client."""
+
+    def setUp(self):
+        """Before each test, make a client that never really sleeps."""
+
+        self.client = HttpClient(
+            'test',
+            retries=2,
+            backoff_base=0,
+            breaker=CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        )
+        self.client.session.get = Mock()
+
+    def test_retries_then_succeeds(self):
+        ok = Mock(status_code=200, content=b'png')
+        self.client.session.get.side_effect = [requests.Timeout(), ok]
+
+        self.assertIs(self.client.get('http://maps.test/'), ok)
+        self.assertEqual(self.client.session.get.call_count, 2)
+
+        _, kwargs = self.client.session.get.call_args
+        self.assertEqual(kwargs['timeout'], self.client.timeout)
+
+        stats = self.client.stats()
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['retries'], 1)
+
+    def test_breaker_fails_fast(self):
+        self.client.session.get.side_effect = requests.ConnectionError()
+
+        with self.assertRaises(requests.ConnectionError):
+            self.client.get('http://maps.test/')
+
+        with self.assertRaises(CircuitOpenError):
+            self.client.get('http://maps.test/')
+
+        self.assertEqual(self.client.session.get.call_count, 3)
+        self.assertEqual(self.client.stats()['circuit'], 'open')
+        self.assertEqual(self.client.stats()['rejected'], 1)
+
+    def test_unexpected_error_ends_trial(self):
+        self.client.session.get.side_effect = requests.ConnectionError()
+        with self.assertRaises(requests.ConnectionError):
+            self.client.get('http://maps.test/')
+
+        # half-open: the trial call fails in a way that isn't retried
+        self.client.breaker.opened_at -= 60
+        self.client.session.get.side_effect = \
+            requests.exceptions.ContentDecodingError()
+        with self.assertRaises(requests.exceptions.ContentDecodingError):
+            self.client.get('http://maps.test/')
+
+        self.assertEqual(self.client.session.get.call_count, 4)
+        self.assertEqual(self.client.stats()['errors'], 4)
+        self.assertFalse(self.client.breaker._trial_running)
+
+        # the next trial is let through, and closes the breaker
+        self.client.breaker.opened_at -= 60
+        ok = Mock(status_code=200, content=b'png')
+        self.client.session.get.side_effect = [ok]
+
+        self.assertIs(self.client.get('http://maps.test/'), ok)
+        self.assertEqual(self.client.stats()['circuit'], 'closed')
+
+    def test_save_map_logs_error(self):
+        with patch('mapping.get_map', side_effect=CircuitOpenError('down')):
+            with self.assertLogs('mapping', 'WARNING') as logs:
+                self.assertIsNone(mapping.save_map(1, "no-such-address"))
+
+        self.assertIn("CircuitOpenError('down')", logs.output[0])
+
+
+#######################################
+# users
+
+
+class UserModelTestCase(TestCase):
+    """Tests for the user model."""
+
+    def setUp(self):
+        """Before each test, add sample users."""
+
+        User.query.delete()
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.user = user
+
+    def tearDown(self):
+        """After each test, remove all users."""
+        db.session.rollback()
+        User.query.delete()
+        db.session.flush()
+
+    def test_authenticate(self):
+        rez = User.authenticate("test", "secret")
+        self.assertEqual(rez, self.user)
+
+    def test_authenticate_fail(self):
+        rez = User.authenticate("no-such-user", "secret")
+        self.assertFalse(rez)
+
+        rez = User.authenticate("test", "password")
+        self.assertFalse(rez)
+
+    def test_full_name(self):
+        self.assertEqual(self.user.get_full_name(), "Testy MacTest")
+
+    def test_register(self):
+        u = User.register(**TEST_USER_DATA)
+        # test that password gets bcrypt-hashed (all start w/$2b$)
+        self.assertEqual(u.hashed_password[:4], "$2b$")
+        db.session.rollback()
+
+    def test_rehash_on_new_cost(self):
+        self.assertEqual(self.user.hashed_password[:7], "$2b$04$")
+
+        with patch('passwords.LOG_ROUNDS', 5):
+            user = User.authenticate("test", "secret")
+            self.assertEqual(user.hashed_password[:7], "$2b$05$")
+            self.assertTrue(User.authenticate("test", "secret"))
+
+    def test_pool_busy(self):
+        full = passwords.PasswordPool(workers=0, queue_limit=1)
+        full._slots.acquire()
+
+        with patch('passwords.pool', full):
+            with self.assertRaises(passwords.PasswordPoolBusy):
+                User.authenticate("test", "secret")
+
+            with app.test_client() as client:
+                resp = client.post(
+                    '/login', data={'username': 'test', 'password': 'secret'})
+                self.assertEqual(resp.status_code, 503)
+                self.assertEqual(resp.headers['Retry-After'], '1')
+
+
+    def test_pool_replaced_after_child_dies(self):
+        pool = passwords.PasswordPool(workers=1, queue_limit=2)
+        self.addCleanup(pool.shutdown)
+
+        hashed = pool.run(passwords._hash, 'secret', 4)
+        for process in list(pool._executor._processes.values()):
+            process.kill()
+            process.join()
+
+        self.assertTrue(pool.run(passwords._check, hashed, 'secret'))
+
+    def test_pool_timeout_is_busy(self):
+        pool = passwords.PasswordPool(workers=1, queue_limit=1, timeout=0.05)
+        self.addCleanup(pool.shutdown)
+
+        with self.assertRaises(passwords.PasswordPoolBusy):
+            pool.run(time.sleep, 0.5)
+
+        # the slow call keeps its slot until it finishes
+        with self.assertRaises(passwords.PasswordPoolBusy):
+            pool.run(passwords._hash, 'secret', 4)
+
+
+class AuthViewsTestCase(TestCase):
+    """Tests for views on logging in/logging out/registration."""
+
+    def setUp(self):
+        """Before each test, add sample users."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_signup(self):
+        with app.test_client() as client:
+            resp = client.get("/signup")
+            self.assertIn(b'Sign Up', resp.data)
+
+            resp = client.post(
+                "/signup",
+                data=TEST_USER_DATA_NEW,
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"Hello, new-username", resp.data)
+            self.assertTrue(session.get(CURR_USER_KEY))
+
+    def test_signup_username_taken(self):
+        with app.test_client() as client:
+            resp = client.get("/signup")
+            self.assertIn(b'Sign Up', resp.data)
+
+            # signup with same data as the already-added user
+            resp = client.post(
+                "/signup",
+                data=TEST_USER_DATA,
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"Username already taken", resp.data)
+
+    def test_login(self):
+        with app.test_client() as client:
+            resp = client.get("/login")
+            self.assertIn(b'Welcome Back!', resp.data)
+
+            resp = client.post(
+                "/login",
+                data={"username": "test", "password": "WRONG"},
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"Invalid credentials", resp.data)
+
+            resp = client.post(
+                "/login",
+                data={"username": "test", "password": "secret"},
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"Hello, test", resp.data)
+            self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
+
+    def test_logout(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.post("/logout", follow_redirects=True)
+
+            self.assertIn(b"Successfully logged out", resp.data)
+            self.assertEqual(session.get(CURR_USER_KEY), None)
+
+
+class NavBarTestCase(TestCase):
+    """Tests navigation bar."""
+
+    def setUp(self):
+        """Before tests, add sample user."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+
+        db.session.add_all([user])
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After tests, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_anon_navbar(self):
+        with app.test_client() as client:
             resp = client.get('/')
 
             self.assertIn(b"Log In", resp.data)
@@ -536,6 +2170,94 @@ class ProfileViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
 
 
+class IdentityTestCase(TestCase):
+    """Tests for the session identity snapshot."""
+
+    def setUp(self):
+        """Before each test, add sample user."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.statements = []
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def user_queries(self):
+        return [s for s in self.statements if 'FROM users' in s]
+
+    def test_snapshot_skips_user_query(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.get('/')
+
+            event.listen(db.engine, 'before_cursor_execute', self.record)
+            try:
+                resp = client.get('/')
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', self.record)
+
+            self.assertIn(b'Log Out', resp.data)
+            self.assertIn(b'>test</a>', resp.data)
+            self.assertEqual(self.user_queries(), [])
+
+    def test_profile_edit_refreshes_snapshot(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.get('/')
+            version = session['curr_user_identity']['version']
+
+            client.post(
+                f'/users/{self.user_id}/edit',
+                data=TEST_USER_DATA_EDIT,
+                follow_redirects=True
+            )
+
+            self.assertEqual(
+                session['curr_user_identity']['version'], version + 1)
+
+    def test_version_bump_invalidates_snapshot(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.get('/')
+
+            user = db.session.get(User, self.user_id)
+            user.admin = True
+            db.session.commit()
+
+            resp = client.get('/')
+            self.assertIn(b'ADMINISTRATOR', resp.data)
+
+    def test_rolled_back_version_not_recorded(self):
+        user = db.session.get(User, self.user_id)
+        version = user.version
+
+        user.first_name = 'Rolled'
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertIn(identity.known_versions.get(self.user_id),
+                      (None, version))
+
+        user = db.session.get(User, self.user_id)
+        user.first_name = 'Kept'
+        db.session.commit()
+
+        self.assertEqual(
+            identity.known_versions.get(self.user_id), version + 1)
+
+
 #######################################
 # likes
 
@@ -564,11 +2286,167 @@ class LikeViewsTestCase(TestCase):
     def tearDown(self):
         """After each test, remove all users and stops"""
 
+        Like.query.delete()
         User.query.delete()
         Stop.query.delete()
         Neighborhood.query.delete()
         db.session.commit()
 
+    def test_check_like(self):
+        db.session.add(Like(user_id=self.user_id, stop_id=self.stop_id))
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get(f'/api/likes?stop_id={self.stop_id}')
+            self.assertEqual(resp.json, {'likes': 'true'})
+
+            resp = client.get(f'/api/likes?stop_id={self.stop_id + 1}')
+            self.assertEqual(resp.json, {'likes': 'false'})
+
+    def test_check_likes_batch(self):
+        db.session.add(Like(user_id=self.user_id, stop_id=self.stop_id))
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get(
+                f'/api/likes/batch?stop_id={self.stop_id}'
+                f'&stop_id={self.stop_id + 1}')
+
+            self.assertEqual(resp.json, {'likes': {
+                str(self.stop_id): True,
+                str(self.stop_id + 1): False,
+            }})
+
+            resp = client.get('/api/likes/batch?stop_id=nope')
+            self.assertEqual(resp.status_code, 400)
+
+    def test_put_delete_like_idempotent(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            url = f'/api/stops/{self.stop_id}/like'
+
+            for _ in range(2):
+                resp = client.put(url)
+                self.assertEqual(resp.json, {
+                    'stop_id': self.stop_id, 'liked': True, 'like_count': 1})
+
+            for _ in range(2):
+                resp = client.delete(url)
+                self.assertEqual(resp.json, {
+                    'stop_id': self.stop_id, 'liked': False, 'like_count': 0})
+
+            resp = client.put(f'/api/stops/{self.stop_id + 1}/like')
+            self.assertEqual(resp.status_code, 404)
+
+    def test_like_count_maintained(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.put(f'/api/stops/{self.stop_id}/like')
+            client.put(f'/api/stops/{self.stop_id}/like')
+
+        self.assertEqual(db.session.get(Stop, self.stop_id).like_count, 1)
+
+    def test_reconcile_like_counts(self):
+        db.session.add(Like(user_id=self.user_id, stop_id=self.stop_id))
+        db.session.commit()
+
+        self.assertEqual(Stop.reconcile_like_counts(), 1)
+        db.session.commit()
+
+        self.assertEqual(db.session.get(Stop, self.stop_id).like_count, 1)
+        self.assertEqual(Stop.reconcile_like_counts(), 0)
+
+    def test_popular(self):
+        other = Stop(**{**STOP_DATA, 'name': "Liked Stop", 'address': "1 A"})
+        db.session.add(other)
+        db.session.commit()
+        Like.add(self.user_id, other.id)
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get('/stops/popular')
+            html = resp.data.decode('utf8')
+
+            self.assertLess(html.index("Liked Stop"), html.index("Test Stop"))
+            self.assertIn("1 likes", html)
+
+    def test_check_like_etag(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            url = f'/api/likes?stop_id={self.stop_id}'
+
+            resp = client.get(url)
+            etag = resp.headers['ETag']
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+
+            resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b'')
+
+            client.put(f'/api/stops/{self.stop_id}/like')
+
+            resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {'likes': 'true'})
+
+    def test_detail_etag(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            url = f'/stops/{self.stop_id}'
+
+            etag = client.get(url).headers['ETag']
+            self.assertTrue(etag.startswith('W/'))
+
+            resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            # liking changes the button and the count
+            client.put(f'/api/stops/{self.stop_id}/like')
+            resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b'UnLike Stop', resp.data)
+
+            # an edit bumps the stop's version
+            etag = resp.headers['ETag']
+            stop = db.session.get(Stop, self.stop_id)
+            stop.description = "Changed"
+            db.session.commit()
+
+            resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_list_etag(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            etag = client.get('/stops').headers['ETag']
+            resp = client.get('/stops', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            resp = client.get(
+                '/stops?sort=newest', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+
+            client.put(f'/api/stops/{self.stop_id}/like')
+            resp = client.get('/stops', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b'1 likes', resp.data)
+
+    def test_legacy_like_twice(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            for _ in range(2):
+                resp = client.post('/api/like', json={'stop_id': self.stop_id})
+                self.assertEqual(resp.status_code, 201)
+
+            self.assertTrue(Like.exists(self.user_id, self.stop_id))
+
     def test_user_no_liked_stops(self):
         with app.test_client() as client:
             login_for_test(client, self.user_id)